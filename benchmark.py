@@ -0,0 +1,255 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import statistics
+import subprocess
+from pathlib import Path
+from itertools import accumulate
+from collections import Counter
+
+# Benchmarks for scanning, the DB, cold loads and search on a synthetic tree.
+# Every run uses its own temporary DB, so the user's index is never touched.
+# Results are printed (or written) as JSON to compare commits on one machine:
+#   python benchmark.py --depth 4 --fanout 8 --files 20 --output before.json
+
+EXTENSIONS = ["txt", "py", "c", "h", "md", "json", "jpg", "png", "log", "cfg"]
+
+
+def make_vocabulary(size, rng):
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(letters) for _ in range(rng.randint(3, 10))))
+    return sorted(words)
+
+
+class NameSource:
+    """
+    Draws file and directory names from a vocabulary. With 'zipf', word k is picked with
+    weight 1/k, so a few names are very common like in real trees. With 'uniform', every
+    word is equally likely.
+    """
+
+    def __init__(self, vocabulary, distribution, rng):
+        self.vocabulary = vocabulary
+        self.rng = rng
+        self.used = Counter()
+        if distribution == "zipf":
+            # Cumulative, so choices does not sum the whole vocabulary on every draw
+            self.weights = list(accumulate(1 / (rank + 1) for rank in range(len(vocabulary))))
+        else:
+            self.weights = None
+
+    def word(self):
+        if self.weights is None:
+            word = self.rng.choice(self.vocabulary)
+        else:
+            word = self.rng.choices(self.vocabulary, cum_weights=self.weights)[0]
+        self.used[word] += 1
+        return word
+
+    def name(self, i):
+        # The counter keeps names unique within a directory
+        return f"{self.word()}_{self.word()}{i}"
+
+
+def build_tree(root, depth, fanout, files_per_dir, symlinks, names, rng):
+    """Creates the synthetic tree and returns (directory count, file count, symlink count)."""
+    dirs = [root]
+    level = [root]
+    file_count = 0
+    for d in range(depth + 1):
+        next_level = []
+        for parent in level:
+            for i in range(files_per_dir):
+                open(os.path.join(parent, f"{names.name(i)}.{rng.choice(EXTENSIONS)}"), "w").close()
+                file_count += 1
+            if d < depth:
+                for i in range(fanout):
+                    path = os.path.join(parent, names.name(i))
+                    os.mkdir(path)
+                    next_level.append(path)
+        dirs.extend(next_level)
+        level = next_level
+
+    # Links to random directories, which include ancestors and so create loops
+    for i in range(symlinks):
+        parent = rng.choice(dirs)
+        os.symlink(rng.choice(dirs), os.path.join(parent, f"link{i}"))
+    return len(dirs), file_count, symlinks
+
+
+def timed(func, repeat=1):
+    """Runs func repeat times and returns (last result, sorted list of durations)."""
+    durations = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        durations.append(time.perf_counter() - start)
+    durations.sort()
+    return result, durations
+
+
+def summary(durations, **extra):
+    data = {"min": durations[0], "median": statistics.median(durations), "max": durations[-1], "runs": len(durations)}
+    data.update(extra)
+    return data
+
+
+def pick_queries(names, rng):
+    """
+    Queries by length and selectivity: the most used word matches many names, the least
+    used one only a few, and random letters usually nothing.
+    """
+    ranked = names.used.most_common()
+    common = ranked[0][0]
+    rare = ranked[-1][0]
+    noise = "".join(rng.choice("qxzjv") for _ in range(6))
+    return {
+        "1_char": common[:1],
+        "2_chars": common[:2],
+        "3_chars_common": common[:3],
+        "common_word": common,
+        "rare_word": rare,
+        "long_rare": rare + "_",
+        "no_match": noise,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix="fstasearch-bench-")
+    bench_db = os.path.join(workdir, "bench.db")
+    # The global DB is opened when database is first imported, so it is pointed at the
+    # temporary one first. The user's own DB is never opened or switched to WAL.
+    os.environ["FSTASEARCH_DB"] = bench_db
+    import database
+    from indexer import Indexer
+    del os.environ["FSTASEARCH_DB"]
+
+    tree = os.path.join(workdir, "tree")
+    os.mkdir(tree)
+    results = {}
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "params": vars(args),
+        },
+        "results": results,
+    }
+
+    try:
+        vocabulary = make_vocabulary(args.vocabulary, rng)
+        names = NameSource(vocabulary, args.names, rng)
+        counts, durations = timed(lambda: build_tree(tree, args.depth, args.fanout, args.files, args.symlinks, names, rng))
+        dir_count, file_count, link_count = counts
+        report["meta"]["tree"] = {"dirs": dir_count, "files": file_count, "symlinks": link_count,
+                                  "build_seconds": durations[0]}
+
+        original_db = database.db
+        if original_db.db_path != bench_db:
+            # Imported before run was called: swap the global for the run instead
+            database.db = database.DatabaseManager(bench_db)
+        try:
+            indexer = Indexer([tree])
+            _, durations = timed(lambda: indexer.scan(full=True))
+            entries = len(indexer.files) + len(indexer.directories)
+            results["scan_full"] = summary(durations, entries=entries, entries_per_second=entries / durations[0])
+            _, durations = timed(indexer.scan, args.repeat)
+            results["scan_incremental_unchanged"] = summary(durations)
+
+            files, dirs = database.db.get_index()
+            _, durations = timed(database.db.get_index, args.repeat)
+            results["db_get_index"] = summary(durations, rows=len(files) + len(dirs))
+            _, durations = timed(lambda: database.db.update_index(files, dirs), args.repeat)
+            results["db_update_index_unchanged"] = summary(durations)
+
+            fresh = database.DatabaseManager(os.path.join(workdir, "fresh.db"))
+            _, durations = timed(lambda: fresh.update_index(files, dirs))
+            results["db_update_index_into_empty"] = summary(durations)
+            fresh.close()
+
+            cold, durations = timed(lambda: Indexer([tree]), args.repeat)
+            results["cold_load_snapshot"] = summary(durations)
+            # Only the load itself, a startup without a snapshot then also writes one
+            _, durations = timed(lambda: cold._set_index(*database.db.get_index()), args.repeat)
+            results["cold_load_db"] = summary(durations)
+
+            queries = pick_queries(names, rng)
+            for matcher in args.matchers:
+                indexer.set_matcher(matcher)
+                for label, query in queries.items():
+                    # A fresh query cache per run, so repeats do not just hit it
+                    def search():
+                        indexer._query_cache.clear()
+                        return indexer.search(query, args.limit)
+                    found, durations = timed(search, args.repeat)
+                    results[f"search_{matcher}_{label}"] = summary(durations, query=query, results=len(found))
+
+            if args.low_memory:
+                database.db.set_setting('low_memory_mode', True)
+                _, durations = timed(lambda: Indexer([tree]))
+                results["low_memory_enable"] = summary(durations)
+                low = Indexer([tree])
+                for label, query in queries.items():
+                    found, durations = timed(lambda: low.search(query, args.limit), args.repeat)
+                    results[f"search_sqlite_{label}"] = summary(durations, query=query, results=len(found))
+        finally:
+            database.db.close()
+            database.db = original_db
+
+        report["meta"]["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    finally:
+        if args.keep:
+            report["meta"]["workdir"] = workdir
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark fstasearch on a synthetic directory tree.")
+    parser.add_argument("--depth", type=int, default=3, help="Levels of directories below the root")
+    parser.add_argument("--fanout", type=int, default=8, help="Subdirectories per directory")
+    parser.add_argument("--files", type=int, default=20, help="Files per directory")
+    parser.add_argument("--symlinks", type=int, default=10, help="Directory symlinks, placed at random")
+    parser.add_argument("--names", choices=["zipf", "uniform"], default="zipf", help="Name distribution")
+    parser.add_argument("--vocabulary", type=int, default=2000, help="Number of distinct words in names")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per timing, min/median/max are reported")
+    parser.add_argument("--limit", type=int, default=2000, help="Result limit for searches")
+    parser.add_argument("--matchers", nargs="+", default=["substring", "packed", "fuzzy"])
+    parser.add_argument("--low-memory", action="store_true", help="Also time the SQLite backend")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated tree and DBs")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,14 @@ DEFAULT_CONFIG = {
     "path_display_depth": 3,
     "window_size": [1000, 400],
     "display_tooltips": True,
+    "scan_workers": 8,
+    "scan_use_processes": False,
+    "watch_filesystem": True,
+    "matcher": "substring",
+    "low_memory_mode": False,
+    "refresh_interval_days": 7,
+    "refresh_intervals": {},
+    "collect_stats": False,
     "last_scan": 0 
 }
 
@@ -19,6 +27,5 @@ def load_config():
     return config
 
 def save_config(config):
-    for key, value in config.items():
-        database.db.set_setting(key, value)
+    database.db.set_settings(config)
 
@@ -1,28 +1,110 @@
 import sqlite3
 import os
+import threading
+import functools
 import json
 import logging
+import time
 from pathlib import Path
+import stats
 
 DB_DIR = os.path.join(str(Path.home()), ".config", "fstasearch")
 DB_FILE = os.path.join(DB_DIR, "fstasearch.db")
+SNAPSHOT_FILE = os.path.join(DB_DIR, "index.snapshot")
+
+# Connection tuning applied by DatabaseManager.connect. The index is rebuildable from
+# disk, so trading a little durability (synchronous=NORMAL under WAL) for fewer
+# fsyncs is safe. Pass a different dict as `profile` to override.
+PERFORMANCE_PROFILE = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -64 * 1024,  # Negative means KiB, i.e. 64 MiB
+    "temp_store": "MEMORY",
+    "cached_statements": 256,  # Size of sqlite3's prepared statement cache
+}
+
+# Usage history: each pick adds 1 to a path's score, which halves every USAGE_HALF_LIFE
+# seconds. Only the USAGE_HISTORY_SIZE most recently used paths are kept.
+USAGE_HALF_LIFE = 7 * 24 * 3600
+USAGE_HISTORY_SIZE = 5000
+
+# FTS5 tokenizer of the low-memory name index. trigram needs SQLite 3.34 or newer.
+NAME_TOKENIZER = "trigram"
+
+def frecency(score, last_used, now):
+    """Decays a usage score stored at time last_used to its value at time now."""
+    return score * 0.5 ** (max(now - last_used, 0) / USAGE_HALF_LIFE)
+
+def _subtree_args(path):
+    # Everything below path sorts between 'path/' and 'path0' ('0' follows '/').
+    # A trailing separator is dropped first, so '/' gives '/' to '0'.
+    prefix = path.rstrip(os.sep) + os.sep
+    return (path, prefix, prefix[:-1] + chr(ord(os.sep) + 1))
+
+def _serialized(method):
+    """Runs a DatabaseManager method holding its lock."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+def _reading(method):
+    """Runs a read-only DatabaseManager method on read_conn, holding read_lock."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.read_lock:
+            return method(self, *args, **kwargs)
+    return wrapper
 
 class DatabaseManager:
-    def __init__(self, db_path=None):
+    def __init__(self, db_path=None, profile=None):
+        self.profile = PERFORMANCE_PROFILE if profile is None else profile
+        # The GUI, scheduler, watcher, search and IPC threads share one connection for
+        # writes. Each method runs alone, so e.g. a commit can't land between a sync's
+        # DELETE and INSERT. Reads go through a second connection with its own lock: under
+        # WAL they see the last commit and never wait for a long sync to finish.
+        self.lock = threading.RLock()
+        self.read_lock = threading.RLock()
         if db_path is None:
             # Ensure config dir exists
             if not os.path.exists(DB_DIR):
                 os.makedirs(DB_DIR)
             self.db_path = DB_FILE
+            self.snapshot_path = SNAPSHOT_FILE
         else:
             self.db_path = db_path
+            self.snapshot_path = None if db_path == ":memory:" else db_path + ".snapshot"
             
         self.connect()
         self.init_db()
 
+    @_serialized
     def connect(self):
-        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.conn = self._open()
+        if self.db_path == ":memory:":
+            # A second connection would open a second, empty database
+            self.read_conn, self.read_lock = self.conn, self.lock
+        else:
+            self.read_conn = self._open()
+            self.read_conn.execute("PRAGMA query_only = 1")
+
+    def _open(self):
+        profile = dict(self.profile)
+        cached_statements = profile.pop("cached_statements", 128)
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, cached_statements=cached_statements)
+        # SQLite's lower() and LIKE only fold ASCII, names are matched like the in-memory index does
+        conn.create_function("py_lower", 1, lambda text: None if text is None else text.lower(), deterministic=True)
+        cursor = conn.cursor()
+        for pragma, value in profile.items():
+            try:
+                cursor.execute(f"PRAGMA {pragma} = {value}")
+            except sqlite3.Error as e:
+                logging.warning(f"Could not apply PRAGMA {pragma}: {e}")
+        return conn
 
+    @_serialized
     def init_db(self):
         cursor = self.conn.cursor()
         
@@ -41,11 +123,46 @@ class DatabaseManager:
                 type TEXT
             )
         ''')
+
+        # Directory State Table (path, mtime, inode, device) - lets rescans skip unchanged directories
+        cursor.execute("SELECT 1 FROM pragma_table_info('dir_state') WHERE name = 'real_path'")
+        if cursor.fetchone():
+            # Older layout. The table is only a cache, the next scan lists everything once.
+            cursor.execute('DROP TABLE dir_state')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS dir_state (
+                path TEXT PRIMARY KEY,
+                mtime INTEGER,
+                inode INTEGER,
+                device INTEGER
+            )
+        ''')
+
+        # Usage History Table (path, score, last_used, count) - score is frecency as of last_used
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS usage_history (
+                path TEXT PRIMARY KEY,
+                score REAL,
+                last_used REAL,
+                count INTEGER
+            )
+        ''')
+
+        # Shards Table (root, last_scan, entries, scan_seconds) - one row per include root
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS shards (
+                root TEXT PRIMARY KEY,
+                last_scan REAL,
+                entries INTEGER,
+                scan_seconds REAL
+            )
+        ''')
         
         self.conn.commit()
 
+    @_reading
     def get_setting(self, key, default=None):
-        cursor = self.conn.cursor()
+        cursor = self.read_conn.cursor()
         cursor.execute('SELECT value FROM settings WHERE key = ?', (key,))
         row = cursor.fetchone()
         if row:
@@ -55,39 +172,310 @@ class DatabaseManager:
                 return row[0]
         return default
 
+    @_serialized
     def set_setting(self, key, value):
         cursor = self.conn.cursor()
         json_val = json.dumps(value)
         cursor.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', (key, json_val))
         self.conn.commit()
 
-    def get_index(self):
+    @_serialized
+    def set_settings(self, settings):
+        """Saves every key of the settings dict in a single transaction."""
         cursor = self.conn.cursor()
-        cursor.execute('SELECT path, type FROM file_index')
-        rows = cursor.fetchall()
-        
-        files = []
-        dirs = []
-        for path, dtype in rows:
-            if dtype == 'file':
-                files.append(path)
+        data = [(key, json.dumps(value)) for key, value in settings.items()]
+        cursor.executemany('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', data)
+        self.conn.commit()
+
+    @_reading
+    def index_generation(self):
+        """Counter bumped by every write that changes file_index; snapshots record it."""
+        return int(self.get_setting('index_generation', 0))
+
+    def _bump_generation(self, cursor):
+        cursor.execute("""
+            INSERT OR REPLACE INTO settings (key, value)
+            VALUES ('index_generation', CAST(COALESCE((SELECT value FROM settings WHERE key = 'index_generation'), 0) + 1 AS TEXT))
+        """)
+
+    @_reading
+    def get_index(self, root=None):
+        with stats.timer("db.get_index"):
+            cursor = self.read_conn.cursor()
+            if root is None:
+                # Insertion order, i.e. the order scans found the paths in, parents first
+                cursor.execute('SELECT path, type FROM file_index ORDER BY rowid')
             else:
-                dirs.append(path)
-        return files, dirs
+                cursor.execute('SELECT path, type FROM file_index WHERE path = ? OR (path > ? AND path < ?) ORDER BY path',
+                               _subtree_args(root))
+            rows = cursor.fetchall()
+
+            files = []
+            dirs = []
+            for path, dtype in rows:
+                if dtype == 'file':
+                    files.append(path)
+                else:
+                    dirs.append(path)
+            return files, dirs
+
+    @_reading
+    def index_size(self):
+        cursor = self.read_conn.cursor()
+        cursor.execute('SELECT COUNT(*) FROM file_index')
+        return cursor.fetchone()[0]
+
+    @_reading
+    def has_path(self, path):
+        cursor = self.read_conn.cursor()
+        cursor.execute('SELECT 1 FROM file_index WHERE path = ?', (path,))
+        return cursor.fetchone() is not None
 
-    def update_index(self, files, dirs):
+    @_reading
+    def path_type(self, path):
+        """Returns 'file' or 'dir' for an indexed path, or None if it is not indexed."""
+        cursor = self.read_conn.cursor()
+        cursor.execute('SELECT type FROM file_index WHERE path = ?', (path,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    @_serialized
+    def enable_name_index(self):
+        """
+        Creates the FTS5 trigram tables dir_names and file_names next to file_index, keyed
+        by its rowid and holding each path's last component. Triggers keep them in step
+        with every write to file_index. They are filled from file_index if they are new.
+        Returns False if this SQLite lacks FTS5 or its trigram tokenizer.
+        """
         cursor = self.conn.cursor()
-        # Full replace strategy for simplicity? Or differential?
-        # Full replace is safer for consistency.
-        cursor.execute('DELETE FROM file_index')
-        
-        data = [(f, 'file') for f in files] + [(d, 'dir') for d in dirs]
-        # Batch insert
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'file_names'")
+        if cursor.fetchone():
+            return True
+        try:
+            cursor.execute(f"CREATE VIRTUAL TABLE temp.name_index_probe USING fts5(name, tokenize = '{NAME_TOKENIZER}')")
+            cursor.execute("DROP TABLE temp.name_index_probe")
+        except sqlite3.OperationalError as e:
+            logging.error(f"The name index needs SQLite 3.34 or newer with FTS5 (this is {sqlite3.sqlite_version}): {e}")
+            return False
+        # rtrim strips the trailing characters that are not '/', leaving the parent part
+        name = "substr({0}.path, length(rtrim({0}.path, replace({0}.path, '/', ''))) + 1)"
+        for table, kind in (('dir_names', 'dir'), ('file_names', 'file')):
+            cursor.execute(f"CREATE VIRTUAL TABLE {table} USING fts5(name, tokenize = '{NAME_TOKENIZER}')")
+            cursor.execute(f"INSERT INTO {table} (rowid, name) SELECT rowid, {name.format('file_index')} FROM file_index WHERE type = '{kind}'")
+            cursor.execute(f"""
+                CREATE TRIGGER {table}_insert AFTER INSERT ON file_index WHEN new.type = '{kind}' BEGIN
+                    INSERT INTO {table} (rowid, name) VALUES (new.rowid, {name.format('new')});
+                END
+            """)
+            cursor.execute(f"""
+                CREATE TRIGGER {table}_delete AFTER DELETE ON file_index WHEN old.type = '{kind}' BEGIN
+                    DELETE FROM {table} WHERE rowid = old.rowid;
+                END
+            """)
+        self.conn.commit()
+        return True
+
+    @_reading
+    def has_name_index(self):
+        """Whether enable_name_index created the name tables, without creating them."""
+        cursor = self.read_conn.cursor()
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'file_names'")
+        return cursor.fetchone() is not None
+
+    @_serialized
+    def disable_name_index(self):
+        cursor = self.conn.cursor()
+        for table in ('dir_names', 'file_names'):
+            cursor.execute(f"DROP TRIGGER IF EXISTS {table}_insert")
+            cursor.execute(f"DROP TRIGGER IF EXISTS {table}_delete")
+            cursor.execute(f"DROP TABLE IF EXISTS {table}")
+        self.conn.commit()
+
+    def iter_name_matches(self, query, kind):
+        """
+        Yields the paths of kind ('dir' or 'file') whose last component contains query,
+        case-insensitively, in rowid order. That is the order get_index loads the
+        in-memory index in, so results are listed the same way. Needs enable_name_index.
+        Rows are fetched lazily, so the caller stops the query by not asking for more.
+        """
+        table = 'dir_names' if kind == 'dir' else 'file_names'
+        if len(query) >= 3:
+            # A quoted FTS5 string is a substring search with the trigram tokenizer
+            condition, arg = f"{table} MATCH ?", '"' + query.replace('"', '""') + '"'
+        else:
+            # Too short for a trigram, this scans the names
+            condition, arg = "instr(py_lower(name), ?) > 0", query.lower()
+        # The lock is only held per chunk, the caller may keep the generator open for long
+        with self.read_lock:
+            cursor = self.read_conn.cursor()
+            cursor.execute(f"SELECT f.path FROM {table} JOIN file_index f ON f.rowid = {table}.rowid WHERE {condition} "
+                           f"ORDER BY {table}.rowid", (arg,))
+        while True:
+            with self.read_lock:
+                rows = cursor.fetchmany(256)
+            if not rows:
+                return
+            for (path,) in rows:
+                yield path
+
+    def iter_paths(self, kind, root=None):
+        """
+        Yields the paths of kind ('dir' or 'file'), in rowid order like get_index, or only
+        those in the subtree at root (root included), in path order. Rows are fetched lazily
+        like iter_name_matches does.
+        """
+        with self.read_lock:
+            cursor = self.read_conn.cursor()
+            if root is None:
+                cursor.execute('SELECT path FROM file_index WHERE type = ? ORDER BY rowid', (kind,))
+            else:
+                cursor.execute('SELECT path FROM file_index WHERE type = ? AND (path = ? OR (path > ? AND path < ?)) '
+                               'ORDER BY path', (kind, *_subtree_args(root)))
+        while True:
+            with self.read_lock:
+                rows = cursor.fetchmany(256)
+            if not rows:
+                return
+            for (path,) in rows:
+                yield path
+
+    @_serialized
+    def _sync_table(self, table, columns, rows, roots=None):
+        """
+        Makes table hold exactly rows while only writing the rows that differ.
+        The new rows are staged in a temp table first, so unchanged rows never touch
+        the main database file or its journal. Returns (inserted, deleted) counts.
+        If roots is given, only rows in their subtrees are replaced and rows must lie within them.
+        """
+        cursor = self.conn.cursor()
+        staging = f"staging_{table}"
+        cols = ", ".join(columns)
+        cursor.execute(f"DROP TABLE IF EXISTS temp.{staging}")
+        cursor.execute(f"CREATE TEMP TABLE {staging} ({columns[0]} PRIMARY KEY, {', '.join(columns[1:])})")
+        cursor.executemany(f"INSERT OR IGNORE INTO {staging} ({cols}) VALUES ({', '.join('?' * len(columns))})", rows)
+
+        same = " AND ".join(f"s.{c} IS {table}.{c}" for c in columns)
+        scope, args = "", []
+        if roots is not None:
+            key = columns[0]
+            scope = " AND (" + (" OR ".join(f"{key} = ? OR ({key} > ? AND {key} < ?)" for _ in roots) or "0") + ")"
+            args = [arg for root in roots for arg in _subtree_args(root)]
+        cursor.execute(f"DELETE FROM {table} WHERE NOT EXISTS (SELECT 1 FROM {staging} s WHERE {same}){scope}", args)
+        deleted = max(cursor.rowcount, 0)
+        cursor.execute(f"INSERT OR IGNORE INTO {table} ({cols}) SELECT {cols} FROM {staging} ORDER BY rowid")
+        inserted = max(cursor.rowcount, 0)
+
+        cursor.execute(f"DROP TABLE temp.{staging}")
+        if table == 'file_index' and (inserted or deleted):
+            self._bump_generation(cursor)
+        self.conn.commit()
+        return inserted, deleted
+
+    @_serialized
+    def update_index(self, files, dirs, roots=None):
+        """
+        Replaces the stored index with files and dirs, or only the subtrees of roots if given.
+        Returns (inserted, deleted) counts.
+        """
+        with stats.timer("db.update_index"):
+            data = [(f, 'file') for f in files] + [(d, 'dir') for d in dirs]
+            return self._sync_table('file_index', ('path', 'type'), data, roots)
+
+    @_serialized
+    def apply_index_changes(self, added_files, added_dirs, removed):
+        """
+        Deletes removed paths with everything below them, then inserts the added ones.
+        Returns (inserted, deleted) counts.
+        """
+        cursor = self.conn.cursor()
+        cursor.executemany('DELETE FROM file_index WHERE path = ? OR (path > ? AND path < ?)',
+                           [_subtree_args(p) for p in removed])
+        deleted = max(cursor.rowcount, 0)
+        data = [(f, 'file') for f in added_files] + [(d, 'dir') for d in added_dirs]
         cursor.executemany('INSERT OR IGNORE INTO file_index (path, type) VALUES (?, ?)', data)
+        inserted = max(cursor.rowcount, 0)
+        if inserted or deleted:
+            self._bump_generation(cursor)
+        self.conn.commit()
+        return inserted, deleted
+
+    @_reading
+    def get_dir_states(self, root=None):
+        cursor = self.read_conn.cursor()
+        if root is None:
+            cursor.execute('SELECT path, mtime, inode, device FROM dir_state')
+        else:
+            cursor.execute('SELECT path, mtime, inode, device FROM dir_state WHERE path = ? OR (path > ? AND path < ?)',
+                           _subtree_args(root))
+        return {path: (mtime, inode, device) for path, mtime, inode, device in cursor.fetchall()}
+
+    @_serialized
+    def update_dir_states(self, states, roots=None):
+        return self._sync_table('dir_state', ('path', 'mtime', 'inode', 'device'), states, roots)
+
+    @_serialized
+    def replace_dir_states(self, states, root):
+        cursor = self.conn.cursor()
+        cursor.execute('DELETE FROM dir_state WHERE path = ? OR (path > ? AND path < ?)', _subtree_args(root))
+        cursor.executemany('INSERT OR REPLACE INTO dir_state (path, mtime, inode, device) VALUES (?, ?, ?, ?)', states)
+        self.conn.commit()
+
+    @_reading
+    def get_shards(self):
+        """Returns {root: (last_scan, entries, scan_seconds)} for every scanned include root."""
+        cursor = self.read_conn.cursor()
+        cursor.execute('SELECT root, last_scan, entries, scan_seconds FROM shards')
+        return {root: (last_scan, entries, seconds) for root, last_scan, entries, seconds in cursor.fetchall()}
+
+    @_serialized
+    def update_shard(self, root, last_scan, entries, scan_seconds):
+        cursor = self.conn.cursor()
+        cursor.execute('INSERT OR REPLACE INTO shards (root, last_scan, entries, scan_seconds) VALUES (?, ?, ?, ?)',
+                       (root, last_scan, entries, scan_seconds))
+        self.conn.commit()
+
+    @_serialized
+    def delete_shards(self, roots):
+        cursor = self.conn.cursor()
+        cursor.executemany('DELETE FROM shards WHERE root = ?', [(root,) for root in roots])
         self.conn.commit()
 
+    @_serialized
+    def record_usage(self, path, now=None):
+        """Counts one pick of path (copied or opened) and trims the oldest history."""
+        now = time.time() if now is None else now
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT score, last_used, count FROM usage_history WHERE path = ?', (path,))
+        row = cursor.fetchone()
+        score, count = 1.0, 1
+        if row:
+            score += frecency(row[0], row[1], now)
+            count += row[2]
+        cursor.execute('INSERT OR REPLACE INTO usage_history (path, score, last_used, count) VALUES (?, ?, ?, ?)',
+                       (path, score, now, count))
+        cursor.execute('''
+            DELETE FROM usage_history WHERE path NOT IN
+            (SELECT path FROM usage_history ORDER BY last_used DESC LIMIT ?)
+        ''', (USAGE_HISTORY_SIZE,))
+        self.conn.commit()
+
+    @_reading
+    def get_frecent_paths(self, limit, now=None):
+        """Returns up to limit (path, frecency) pairs, most frecent first."""
+        now = time.time() if now is None else now
+        cursor = self.read_conn.cursor()
+        cursor.execute('SELECT path, score, last_used FROM usage_history')
+        ranked = [(path, frecency(score, last_used, now)) for path, score, last_used in cursor.fetchall()]
+        ranked.sort(key=lambda item: item[1], reverse=True)
+        return ranked[:limit]
+
+    @_serialized
     def close(self):
+        with self.read_lock:
+            if self.read_conn is not self.conn:
+                self.read_conn.close()
         self.conn.close()
 
-# Global instance
-db = DatabaseManager()
+# Global instance. FSTASEARCH_DB points it at another database file (its snapshot
+# is kept next to it), e.g. a throwaway one for benchmark.py.
+db = DatabaseManager(os.environ.get("FSTASEARCH_DB") or None)
@@ -0,0 +1,83 @@
+import os
+import re
+
+GLOB_CHARS = set('*?[')
+
+
+def _glob_to_regex(pattern):
+    """
+    Translates a glob to a regex matching any path it excludes.
+    '*' and '?' stay within one path component, '**' spans any number of them.
+    Absolute patterns match from the root, others match at any component boundary,
+    so 'node_modules' and '*.pyc' work like they do in .gitignore.
+    A match also covers everything below the matched path.
+    """
+    parts = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            parts.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('**', i):
+            parts.append('.*')
+            i += 2
+        elif pattern[i] == '*':
+            parts.append('[^/]*')
+            i += 1
+        elif pattern[i] == '?':
+            parts.append('[^/]')
+            i += 1
+        elif pattern[i] == '[' and pattern.find(']', i + 2) > 0:
+            end = pattern.find(']', i + 2)
+            chars = pattern[i + 1:end]
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            parts.append('[' + chars.replace('\\', '\\\\') + ']')
+            i = end + 1
+        else:
+            parts.append(re.escape(pattern[i]))
+            i += 1
+    start = '^' if pattern.startswith('/') else '(?:^|/)'
+    return start + ''.join(parts) + '(?:/|$)'
+
+
+class ExcludeRules:
+    """
+    Exclusion rules compiled once, so checking a path does not depend on how many rules there are.
+    Plain absolute paths go into a trie of path components: a path is excluded if one of
+    its ancestors (or itself) is a rule, and '/foo/bar' no longer catches '/foo/barbaz'.
+    Every other rule is a glob, and all globs are combined into one regex.
+    """
+
+    def __init__(self, patterns=()):
+        self.patterns = list(patterns)
+        self.trie = {}
+        globs = []
+        for pattern in self.patterns:
+            if not pattern:
+                continue
+            if pattern.startswith(os.sep) and not GLOB_CHARS & set(pattern):
+                node = self.trie
+                for part in pattern.split(os.sep):
+                    if part:
+                        node = node.setdefault(part, {})
+                # An empty node marks the end of a rule
+                node[None] = {}
+            else:
+                globs.append(_glob_to_regex(pattern.rstrip('/') or pattern))
+        self.regex = re.compile('|'.join(globs)) if globs else None
+
+    def __call__(self, path):
+        node = self.trie
+        if None in node:
+            return True
+        if node:
+            for part in path.split(os.sep):
+                if not part:
+                    continue
+                node = node.get(part)
+                if node is None:
+                    break
+                if None in node:
+                    return True
+        return self.regex is not None and self.regex.search(path) is not None
@@ -1,17 +1,53 @@
 import sys
 import os
-import argparse
-import config
-import logging
-from indexer import Indexer
-from gui import SearchWindow
-from PyQt6.QtWidgets import QApplication, QSystemTrayIcon, QMenu
-from PyQt6.QtNetwork import QLocalSocket, QLocalServer
-from PyQt6.QtCore import QIODevice
+import time
+# Start of the launch, compared with the instance's clock to measure launch-to-window latency
+LAUNCHED = time.monotonic()
+import ipc
+# Everything else is imported after the fast path in main, which only needs the stdlib
+# socket client. Hotkey-to-window latency is dominated by interpreter startup, and each
+# heavy import (logging, argparse, sqlite3, PyQt6) would add to it.
 
-SOCKET_NAME = "fstasearch_socket"
+# How often the running service checks whether an include root is due for a rescan
+SCHEDULE_CHECK_INTERVAL_MS = 60 * 60 * 1000
+
+def run_query(args):
+    """
+    Prints the results for args.query from the running instance's in-memory index.
+    Without a running instance the stored index is searched directly, which is slower
+    but still never loads the GUI. That lookup is read-only: an instance that was merely
+    too busy to answer may be using the same DB and snapshot.
+    """
+    import logging
+    reply = ipc.query(args.query, args.limit, args.json)
+    if reply is None:
+        logging.warning("No running instance answered. Searching the stored index.")
+        import config
+        from indexer import Indexer
+        user_config = config.load_config()
+        indexer = Indexer(user_config.get("include_directories", []), user_config.get("exclude_directories", []),
+                          read_only=True)
+        reply = ipc.format_results(indexer.search(args.query, args.limit), args.json)
+    sys.stdout.buffer.write(reply)
+    sys.stdout.flush()
+
+def print_stats(args):
+    """Prints the running instance's timing statistics. They only exist in its memory."""
+    reply = ipc.send_command("STATSJSON" if args.json else "STATS")
+    if reply is None:
+        print("No running instance answered.", file=sys.stderr)
+        sys.exit(1)
+    sys.stdout.buffer.write(reply)
+    sys.stdout.flush()
 
 def main():
+    # Fast path: a plain launch only asks the running instance to show its window
+    if len(sys.argv) == 1 and ipc.show(LAUNCHED):
+        return
+
+    import argparse
+    import logging
+
     # Configure logging
     logging.basicConfig(
         level=logging.INFO,
@@ -19,16 +55,35 @@ def main():
         datefmt='%Y-%m-%d %H:%M:%S'
     )
 
+    parser = argparse.ArgumentParser(description="A minimal file cataloger and launcher.")
+    parser.add_argument("--configure", action="store_true", help="Set the target directory")
+    parser.add_argument("--query", metavar="TEXT", help="Print matching paths and exit, without opening the window")
+    parser.add_argument("--limit", type=int, default=50, help="Maximum number of results for --query")
+    parser.add_argument("--json", action="store_true", help="Print --query or --stats output as JSON")
+    parser.add_argument("--stats", action="store_true", help="Print the running instance's timing statistics and exit")
+    args = parser.parse_args()
+
+    # Headless lookups never touch the GUI stack
+    if args.query is not None:
+        run_query(args)
+        return
+    if args.stats:
+        print_stats(args)
+        return
+
     # 1. Try to connect to existing instance
-    socket = QLocalSocket()
-    socket.connectToServer(SOCKET_NAME)
-    if socket.waitForConnected(500):
-        logging.info("Instance already running. Sending show command...")
-        socket.write(b"SHOW")
-        socket.waitForBytesWritten(1000)
-        socket.disconnectFromServer()
+    if ipc.show(LAUNCHED):
+        logging.info(f"Instance already running. Show command sent {(time.monotonic() - LAUNCHED) * 1000:.1f}ms after launch")
         sys.exit(0)
 
+    import config
+    import stats
+    from indexer import Indexer
+    from gui import SearchWindow, CommandRunner, scan_status_text, SCAN_PROGRESS_INTERVAL_MS
+    from PyQt6.QtWidgets import QApplication, QSystemTrayIcon, QMenu
+    from PyQt6.QtNetwork import QLocalServer
+    from PyQt6.QtCore import QTimer
+
     # 2. If not running, start new instance
     logging.info("Starting new instance...")
     app = QApplication(sys.argv)
@@ -37,17 +92,14 @@ def main():
     # Create Local Server
     server = QLocalServer()
     # Cleanup old socket if it exists (e.g. from crash)
-    QLocalServer.removeServer(SOCKET_NAME)
-    if not server.listen(SOCKET_NAME):
+    QLocalServer.removeServer(ipc.SOCKET_PATH)
+    if not server.listen(ipc.SOCKET_PATH):
         logging.error(f"Unable to start local server: {server.errorString()}")
         # Proceed anyway? Or fail? Let's proceed but warn.
-        
-    parser = argparse.ArgumentParser(description="A minimal file cataloger and launcher.")
-    parser.add_argument("--configure", action="store_true", help="Set the target directory")
-    args = parser.parse_args()
 
     # Load Config
     user_config = config.load_config()
+    stats.enable(user_config.get("collect_stats", False))
     
     # Initialize Indexer
     include_dirs = user_config.get("include_directories", [])
@@ -60,38 +112,55 @@ def main():
 
     indexer = Indexer(include_dirs, exclude_dirs)
     
-    # Check if we need to re-index (Weekly)
-    last_scan = user_config.get("last_scan", 0)
-    now = __import__('time').time()
-    week_seconds = 7 * 24 * 60 * 60
-    
-    if now - last_scan > week_seconds:
-        logging.info("Index is older than 1 week. Starting background re-index.")
-        indexer.scan_async()
-    elif not indexer.files and not indexer.directories:
-         # Empty DB? Scan now.
-         logging.info("No index found in DB. Scanning now.")
-         # First scan: we might want to block or async? 
-         # Async is better for perceived speed, but user will see empty results for a moment.
-         # Let's do async but maybe UI handles empty state? 
-         # Actually for first run, async is fine, results will pop in next search or if we refresh?
-         # The UI updates from indexer.files reference.
-         # But the UI copies matches.
-         # Let's just scan async.
-         indexer.scan_async()
+    # Each include root (shard) is rescanned on its own schedule, by default weekly.
+    # Rescans are incremental, only directories whose mtime changed since the last scan
+    # are listed again. Roots that were never indexed are due right away, and their
+    # results stream in while they are scanned.
+    def rescan_due_roots():
+        due = indexer.due_roots()
+        if due and not indexer.is_scanning:
+            logging.info(f"Rescanning {', '.join(due)}, past their refresh interval.")
+            indexer.scan_async(due)
+
+    rescan_due_roots()
+
+    # Keep the index live between scans
+    if user_config.get("watch_filesystem", True):
+        from watcher import IndexWatcher
+        IndexWatcher(indexer).start()
 
     # Show Window
     window = SearchWindow(indexer)
     window.show_window()
 
-    # Handle incoming connections (commands from other instances)
+    # Handle incoming connections (commands from other instances and --query clients).
+    # Nothing here waits on a client or a search: the command line is collected as it
+    # arrives, and queries are answered from the runner's threads.
+    commands = CommandRunner(indexer, window.show_window)
+
+    def send_reply(client_socket, reply):
+        if reply:
+            client_socket.write(reply)
+        # Pending reply data is still written before the connection closes
+        client_socket.disconnectFromServer()
+
+    commands.reply_ready.connect(send_reply)
+
     def handle_new_connection():
         client_socket = server.nextPendingConnection()
-        if client_socket.waitForReadyRead(1000):
-            command = client_socket.readAll().data().decode().strip()
-            if command == "SHOW":
-                window.show_window()
-        client_socket.disconnectFromServer()
+        data = bytearray()
+
+        def read_command():
+            data.extend(client_socket.readAll().data())
+            if b"\n" in data:
+                client_socket.readyRead.disconnect(read_command)
+                line = data[:data.index(b"\n") + 1]
+                commands.run(client_socket, line.decode("utf-8", "surrogateescape"))
+
+        client_socket.readyRead.connect(read_command)
+        # The command may have arrived before the signal was connected
+        if client_socket.bytesAvailable():
+            read_command()
 
     server.newConnection.connect(handle_new_connection)
 
@@ -112,6 +181,19 @@ def main():
         tray_icon.setIcon(icon)
 
     tray_icon.setToolTip("fstasearch")
+
+    # Show scan progress in the tooltip
+    def update_tray_tooltip():
+        tray_icon.setToolTip(scan_status_text(indexer) or "fstasearch")
+
+    progress_timer = QTimer(window)
+    progress_timer.timeout.connect(update_tray_tooltip)
+    progress_timer.start(SCAN_PROGRESS_INTERVAL_MS)
+
+    # The service runs for days, so keep checking which roots are due
+    schedule_timer = QTimer(window)
+    schedule_timer.timeout.connect(rescan_due_roots)
+    schedule_timer.start(SCHEDULE_CHECK_INTERVAL_MS)
     
     tray_menu = QMenu()
     show_action = tray_menu.addAction("Show Search")
@@ -125,6 +207,9 @@ def main():
     # Connect trait activation (click) to show window
     tray_icon.activated.connect(lambda reason: window.show_window() if reason == QSystemTrayIcon.ActivationReason.Trigger else None)
 
+    # Live changes since the last snapshot would otherwise make the next start load the DB
+    app.aboutToQuit.connect(indexer.flush_snapshot)
+
     sys.exit(app.exec())
 
 if __name__ == "__main__":
@@ -1,19 +1,125 @@
 import sys
 import os
+import time
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from PyQt6.QtWidgets import (QApplication, QWidget, QVBoxLayout, QHBoxLayout, QListWidget, 
-                             QLineEdit, QLabel, QListWidgetItem, QGraphicsDropShadowEffect,
+                             QLineEdit, QLabel, QListView, QGraphicsDropShadowEffect,
                              QPushButton, QDialog, QTabWidget, QFileDialog, QToolButton,
-                             QSpinBox, QFormLayout, QMenu, QCheckBox)
-from PyQt6.QtCore import Qt, QTimer, pyqtSignal, QEvent
+                             QSpinBox, QFormLayout, QMenu, QCheckBox, QComboBox, QInputDialog)
+from PyQt6.QtCore import (Qt, QTimer, pyqtSignal, pyqtSlot, QEvent, QObject, QThread,
+                          QAbstractListModel, QModelIndex)
 from PyQt6.QtGui import QColor, QGuiApplication, QClipboard, QIcon, QAction
 
 import config
+import ipc
+import stats
+
+# Quiet time after a keystroke before a search is started
+SEARCH_DEBOUNCE_MS = 40
+# Rows are only rendered when visible, so a search can return this many hits
+SEARCH_RESULT_LIMIT = 2000
+# How often the window and the tray icon check on a running scan
+SCAN_PROGRESS_INTERVAL_MS = 500
+
+def scan_status_text(indexer):
+    """Describes a running scan for placeholders and tooltips, or returns None when idle."""
+    progress = indexer.scan_progress
+    if progress is None:
+        return None
+    found, root = progress
+    return f"Indexing {root or '...'}: {found:,} entries so far"
+
+class ResultsModel(QAbstractListModel):
+    """
+    List model over a plain list of result paths. Display text and tooltips are
+    computed in data(), i.e. only for the rows the view actually paints.
+    """
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.paths = []
+        self.display_depth = 3
+        self.show_hints = True
+
+    def set_results(self, paths):
+        self.beginResetModel()
+        self.paths = paths
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.paths)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        path = self.paths[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            parts = path.split(os.sep)
+            if len(parts) > self.display_depth:
+                return os.sep.join(["..."] + parts[-self.display_depth:])
+            return path
+        if role == Qt.ItemDataRole.ToolTipRole:
+            return "Left click to copy, Right click to visit" if self.show_hints else path
+        if role == Qt.ItemDataRole.UserRole:
+            return path
+        return None
+
+class SearchWorker(QObject):
+    """
+    Runs Indexer.search on a background thread. Queries that were superseded by a
+    newer keystroke while queued are skipped, and results that went stale while
+    searching are dropped instead of being sent back.
+    """
+    results_ready = pyqtSignal(int, list)
+
+    def __init__(self, indexer):
+        super().__init__()
+        self.indexer = indexer
+        self.latest = 0 # Written by the GUI thread
+
+    @pyqtSlot(int, str)
+    def run_query(self, generation, text):
+        if generation != self.latest:
+            return
+        matches = self.indexer.search(text, limit=SEARCH_RESULT_LIMIT)
+        if generation == self.latest:
+            self.results_ready.emit(generation, matches)
+
+class CommandRunner(QObject):
+    """
+    Runs the commands other processes send over the instance socket. Queries and stats
+    run on a small thread pool, so a large --query never stalls the window. Replies are
+    handed back through reply_ready, which is delivered on the GUI thread owning the socket.
+    """
+    reply_ready = pyqtSignal(object, bytes)
+
+    def __init__(self, indexer, show_window):
+        super().__init__()
+        self.indexer = indexer
+        self.show_window = show_window
+        self.pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="ipc")
+
+    def run(self, client_socket, line):
+        if line.startswith("SHOW"):
+            # Touches the window, so it stays on the GUI thread. It is cheap.
+            self.reply_ready.emit(client_socket, ipc.handle_command(line, self.indexer, self.show_window))
+            return
+        self.pool.submit(self._run, client_socket, line)
+
+    def _run(self, client_socket, line):
+        try:
+            reply = ipc.handle_command(line, self.indexer, None)
+        except Exception as e:
+            logging.error(f"Error running command {line.strip()!r}: {e}")
+            reply = b""
+        self.reply_ready.emit(client_socket, reply)
 
 class SettingsDialog(QDialog):
-    def __init__(self, parent=None, current_config=None):
+    def __init__(self, parent=None, current_config=None, shards=None):
         super().__init__(parent)
         self.config = current_config or config.DEFAULT_CONFIG.copy()
+        # {root: (last_scan, entries, scan_seconds)} of the scanned include roots
+        self.shards = shards or {}
         self.setWindowTitle("FstaSearch Settings")
         self.resize(500, 450)
         self.setup_ui()
@@ -38,6 +144,13 @@ class SettingsDialog(QDialog):
         # Include Tab
         self.include_list = QListWidget()
         self.include_list.addItems(self.config.get("include_directories", []))
+        for i in range(self.include_list.count()):
+            item = self.include_list.item(i)
+            shard = self.shards.get(item.text())
+            if shard:
+                last_scan, entries, seconds = shard
+                item.setToolTip(f"{entries:,} entries, last scanned "
+                                f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(last_scan))} in {seconds:.1f}s")
         self.tabs.addTab(self._create_list_tab(self.include_list, is_include=True), "Include Folders")
         
         # Exclude Tab
@@ -50,7 +163,7 @@ class SettingsDialog(QDialog):
 
         # Buttons
         btn_layout = QHBoxLayout()
-        save_btn = QPushButton("Save & Rescan")
+        save_btn = QPushButton("Save")
         save_btn.clicked.connect(self.save)
         cancel_btn = QPushButton("Cancel")
         cancel_btn.setStyleSheet("background-color: #555; color: white;")
@@ -73,10 +186,44 @@ class SettingsDialog(QDialog):
         remove_btn.clicked.connect(lambda: self.remove_selected(list_widget))
         
         btn_layout.addWidget(add_btn)
+        if not is_include:
+            pattern_btn = QPushButton("Add Pattern")
+            pattern_btn.setToolTip("Glob such as node_modules, *.pyc or **/build")
+            pattern_btn.clicked.connect(lambda: self.add_pattern(list_widget))
+            btn_layout.addWidget(pattern_btn)
         btn_layout.addWidget(remove_btn)
         layout.addLayout(btn_layout)
+
+        if is_include:
+            # Each folder is rescanned on its own schedule, e.g. a slow network share less often
+            self.refresh_intervals = dict(self.config.get("refresh_intervals", {}))
+            refresh_layout = QHBoxLayout()
+            self.refresh_spin = QSpinBox()
+            self.refresh_spin.setRange(1, 365)
+            self.refresh_spin.setSuffix(" days")
+            self.refresh_spin.setEnabled(False)
+            self.refresh_spin.valueChanged.connect(self._set_refresh_interval)
+            list_widget.currentItemChanged.connect(self._show_refresh_interval)
+            refresh_layout.addWidget(QLabel("Rescan selected folder every:"))
+            refresh_layout.addWidget(self.refresh_spin)
+            refresh_layout.addStretch()
+            layout.addLayout(refresh_layout)
         return widget
 
+    def _show_refresh_interval(self, current, previous):
+        self.refresh_spin.setEnabled(current is not None)
+        if current is None:
+            return
+        days = self.refresh_intervals.get(current.text(), self.config.get("refresh_interval_days", 7))
+        self.refresh_spin.blockSignals(True)
+        self.refresh_spin.setValue(days)
+        self.refresh_spin.blockSignals(False)
+
+    def _set_refresh_interval(self, days):
+        item = self.include_list.currentItem()
+        if item is not None:
+            self.refresh_intervals[item.text()] = days
+
     def _create_appearance_tab(self):
         widget = QWidget()
         layout = QFormLayout(widget)
@@ -94,6 +241,24 @@ class SettingsDialog(QDialog):
         self.tooltips_cb.setChecked(self.config.get("display_tooltips", True))
         layout.addRow("", self.tooltips_cb)
 
+        self.matcher_combo = QComboBox()
+        self.matcher_combo.addItem("Substring", "substring")
+        self.matcher_combo.addItem("Substring (packed buffer)", "packed")
+        self.matcher_combo.addItem("Fuzzy (ranked)", "fuzzy")
+        index = self.matcher_combo.findData(self.config.get("matcher", "substring"))
+        self.matcher_combo.setCurrentIndex(max(index, 0))
+        layout.addRow("Matching:", self.matcher_combo)
+
+        self.low_memory_cb = QCheckBox("Low Memory Mode")
+        self.low_memory_cb.setToolTip("Search the database instead of keeping the index in memory. Applies after a restart.")
+        self.low_memory_cb.setChecked(self.config.get("low_memory_mode", False))
+        layout.addRow("", self.low_memory_cb)
+
+        self.stats_cb = QCheckBox("Record Timings")
+        self.stats_cb.setToolTip("Keep latency statistics in memory, shown by fstasearch.py --stats.")
+        self.stats_cb.setChecked(self.config.get("collect_stats", False))
+        layout.addRow("", self.stats_cb)
+
         return widget
 
     def add_folder(self, list_widget):
@@ -106,6 +271,11 @@ class SettingsDialog(QDialog):
         if folder:
             list_widget.addItem(folder)
 
+    def add_pattern(self, list_widget):
+        pattern, ok = QInputDialog.getText(self, "Add Pattern", "Exclude paths matching (e.g. node_modules, *.pyc, **/build):")
+        if ok and pattern.strip():
+            list_widget.addItem(pattern.strip())
+
     def remove_selected(self, list_widget):
         for item in list_widget.selectedItems():
             list_widget.takeItem(list_widget.row(item))
@@ -116,28 +286,85 @@ class SettingsDialog(QDialog):
         
         self.config["include_directories"] = includes
         self.config["exclude_directories"] = excludes
+        self.config["refresh_intervals"] = {root: days for root, days in self.refresh_intervals.items() if root in includes}
         self.config["path_display_depth"] = self.depth_spin.value()
         self.config["display_tooltips"] = self.tooltips_cb.isChecked()
+        self.config["matcher"] = self.matcher_combo.currentData()
+        self.config["low_memory_mode"] = self.low_memory_cb.isChecked()
+        self.config["collect_stats"] = self.stats_cb.isChecked()
         
         config.save_config(self.config)
         self.accept()
 
 class SearchWindow(QWidget):
+    search_requested = pyqtSignal(int, str)
+
     def __init__(self, indexer):
         super().__init__()
         self.indexer = indexer
         self.settings_dialog_open = False
         self.app_config = config.load_config() # Load config once into instance
+        # Window state and usage are written on one background thread, in order. A long
+        # index sync holds the DB's write lock, and hiding the window must not wait for it.
+        self._db_writes = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writes")
         
         # Resizing state
         self._resizing = False
         self._resize_edge = None
         self._resize_margin = 10
-        
+
+        self.setup_search_worker()
         self.setup_ui()
+        self.setup_scan_progress()
         self.load_state()
         self.setMouseTracking(True) # Required for edge detection
         
+    def setup_search_worker(self):
+        # Every keystroke bumps the generation; only the latest one is ever shown
+        self._search_generation = 0
+        self._awaiting_results = False
+        self._keystroke_time = None
+        # Search bar text the listed results are for
+        self._shown_text = ""
+
+        self._search_timer = QTimer(self)
+        self._search_timer.setSingleShot(True)
+        self._search_timer.setInterval(SEARCH_DEBOUNCE_MS)
+        self._search_timer.timeout.connect(self._start_search)
+
+        self._search_thread = QThread(self)
+        self._search_worker = SearchWorker(self.indexer)
+        self._search_worker.moveToThread(self._search_thread)
+        self.search_requested.connect(self._search_worker.run_query)
+        self._search_worker.results_ready.connect(self._show_results)
+        self._search_thread.start()
+        QApplication.instance().aboutToQuit.connect(self._stop_search_worker)
+
+    def setup_scan_progress(self):
+        self._index_version = self.indexer.version
+        self._last_scan = self.indexer.last_scan
+        self._progress_timer = QTimer(self)
+        self._progress_timer.setInterval(SCAN_PROGRESS_INTERVAL_MS)
+        self._progress_timer.timeout.connect(self._update_scan_progress)
+        self._progress_timer.start()
+
+    def _update_scan_progress(self):
+        self.search_bar.setPlaceholderText(scan_status_text(self.indexer) or "Search...")
+        # Streamed batches and the final swap change what the query matches. Live updates
+        # between scans (watcher flushes) wait for the next keystroke instead of
+        # rerunning the query under the user every few seconds.
+        scanned = self.indexer.scan_progress is not None or self.indexer.last_scan != self._last_scan
+        if scanned and self.indexer.version != self._index_version:
+            if self.isVisible() and self.search_bar.text().strip():
+                self.on_search_text_changed(self.search_bar.text())
+        self._index_version = self.indexer.version
+        self._last_scan = self.indexer.last_scan
+
+    def _stop_search_worker(self):
+        self._search_worker.latest = -1
+        self._search_thread.quit()
+        self._search_thread.wait()
+
     def setup_ui(self):
         # Window attributes
         self.setWindowFlags(Qt.WindowType.FramelessWindowHint | Qt.WindowType.Tool)
@@ -170,16 +397,16 @@ class SearchWindow(QWidget):
                 font-size: 16px;
                 selection-background-color: #4a90e2;
             }
-            QListWidget {
+            QListView {
                 background-color: #2b2b2b;
                 color: #cccccc;
                 border: none;
                 font-size: 14px;
             }
-            QListWidget::item {
+            QListView::item {
                 padding: 5px;
             }
-            QListWidget::item:selected {
+            QListView::item:selected {
                 background-color: #4a90e2;
                 color: white;
                 border-radius: 4px;
@@ -220,9 +447,14 @@ class SearchWindow(QWidget):
         self.container_layout.addWidget(self.search_bar_container)
 
         # Results List
-        self.results_list = QListWidget()
-        self.results_list.itemActivated.connect(self.copy_to_clipboard)
-        self.results_list.itemClicked.connect(self.copy_to_clipboard) # Left Click
+        self.results_model = ResultsModel(self)
+        self._apply_display_settings()
+        self.results_list = QListView()
+        self.results_list.setModel(self.results_model)
+        self.results_list.setUniformItemSizes(True) # Lets the view skip measuring every row
+        self.results_list.setEditTriggers(QListView.EditTrigger.NoEditTriggers)
+        self.results_list.activated.connect(self.copy_to_clipboard)
+        self.results_list.clicked.connect(self.copy_to_clipboard) # Left Click
         
         # Right Click Context Menu
         self.results_list.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
@@ -255,7 +487,18 @@ class SearchWindow(QWidget):
     def save_state(self):
         self.app_config["last_search"] = self.search_bar.text()
         self.app_config["window_size"] = [self.width(), self.height()]
-        config.save_config(self.app_config)
+        # Only these keys, so a write still queued can't undo a change made in the settings
+        state = {key: self.app_config[key] for key in ("last_search", "window_size")}
+        self._write_in_background(config.save_config, state)
+
+    def record_usage(self, path):
+        self._write_in_background(self.indexer.record_usage, path)
+
+    def _write_in_background(self, fn, *args):
+        def report(future):
+            if future.exception() is not None:
+                logging.error(f"Background write failed: {future.exception()}")
+        self._db_writes.submit(fn, *args).add_done_callback(report)
 
     def center_on_screen(self):
         screen = QGuiApplication.primaryScreen().availableGeometry()
@@ -269,44 +512,76 @@ class SearchWindow(QWidget):
         self.show()
         self.activateWindow()
     
-    def _truncate_path(self, path):
-        depth = self.app_config.get("path_display_depth", 3)
-        parts = path.split(os.sep)
-        if len(parts) > depth:
-            return os.sep.join(["..."] + parts[-depth:])
-        return path
+    def _apply_display_settings(self):
+        self.results_model.display_depth = self.app_config.get("path_display_depth", 3)
+        self.results_model.show_hints = self.app_config.get("display_tooltips", True)
 
     def on_search_text_changed(self, text):
-        self.results_list.clear()
+        if stats.enabled:
+            self._keystroke_time = time.perf_counter()
+        # Invalidate whatever the worker has queued or is running
+        self._search_generation += 1
+        self._search_worker.latest = self._search_generation
         if len(text.strip()) == 0:
+            self._search_timer.stop()
+            self._awaiting_results = False
+            self._shown_text = ""
+            self.results_model.set_results([])
             return
-            
-        matches = self.indexer.search(text)
-        for match in matches:
-            display_text = self._truncate_path(match)
-            item = QListWidgetItem(display_text)
-            item.setData(Qt.ItemDataRole.UserRole, match) # Store full path
-            
-            if self.app_config.get("display_tooltips", True):
-                item.setToolTip(f"Left click to copy, Right click to visit")
-            else:
-                item.setToolTip(match)
-            self.results_list.addItem(item)
-        
-        if self.results_list.count() > 0:
-            self.results_list.setCurrentRow(0)
+
+        self._search_timer.start()
+
+    def _start_search(self):
+        self._awaiting_results = True
+        self.search_requested.emit(self._search_generation, self.search_bar.text())
+
+    def _flush_search(self):
+        """Searches synchronously if the results on screen are behind the search bar."""
+        if not (self._search_timer.isActive() or self._awaiting_results):
+            return
+        if self.search_bar.text() == self._shown_text:
+            # Only a refresh for a scan is pending, the selection on screen is what Enter means
+            return
+        self._search_timer.stop()
+        self._search_generation += 1
+        self._search_worker.latest = self._search_generation
+        self._show_results(self._search_generation, self.indexer.search(self.search_bar.text(), limit=SEARCH_RESULT_LIMIT))
+
+    def _show_results(self, generation, matches):
+        if generation != self._search_generation:
+            return
+        self._awaiting_results = False
+        # A refresh of the same text keeps the selected path selected, wherever it moved
+        selected = None
+        current = self.results_list.currentIndex()
+        if self.search_bar.text() == self._shown_text and current.isValid():
+            selected = self.results_model.paths[current.row()]
+        self._shown_text = self.search_bar.text()
+
+        with stats.timer("gui.render"):
+            self.results_model.set_results(matches)
+            if matches:
+                row = matches.index(selected) if selected in matches else 0
+                self.results_list.setCurrentIndex(self.results_model.index(row))
+        if stats.enabled and self._keystroke_time is not None:
+            # Includes the debounce delay, i.e. what the user actually waits
+            stats.record("gui.keystroke_to_render", time.perf_counter() - self._keystroke_time)
+            self._keystroke_time = None
 
     def open_settings(self):
         self.settings_dialog_open = True
-        dlg = SettingsDialog(self, config.load_config())
+        dlg = SettingsDialog(self, config.load_config(), self.indexer.shard_info())
         if dlg.exec():
             # Reload everything
             self.app_config = config.load_config()
+            self._apply_display_settings()
             
-            # Update indexer with new paths
-            self.indexer.include_dirs = self.app_config.get("include_directories", [])
-            self.indexer.exclude_dirs = self.app_config.get("exclude_directories", [])
-            self.indexer.scan()
+            # Update indexer with new paths. Removed folders are dropped and new ones
+            # scanned in the background, results show up as the scan progresses.
+            self.indexer.set_matcher(self.app_config.get("matcher", "substring"))
+            stats.enable(self.app_config.get("collect_stats", False))
+            self.indexer.reconfigure(self.app_config.get("include_directories", []),
+                                     self.app_config.get("exclude_directories", []))
             
             # Refresh search to apply truncation
             self.on_search_text_changed(self.search_bar.text())
@@ -324,11 +599,11 @@ class SearchWindow(QWidget):
         return super().event(event)
     
     def open_context_menu(self, pos):
-        item = self.results_list.itemAt(pos)
-        if not item:
+        index = self.results_list.indexAt(pos)
+        if not index.isValid():
             return
             
-        full_path = item.data(Qt.ItemDataRole.UserRole)
+        full_path = index.data(Qt.ItemDataRole.UserRole)
         
         menu = QMenu(self)
         open_action = QAction("Open in Explorer", self)
@@ -353,6 +628,7 @@ class SearchWindow(QWidget):
             
         try:
             subprocess.Popen(['xdg-open', target])
+            self.record_usage(path)
             self.save_state()
             # self.close() # Keep window open, allow focus loss to close it
         except Exception as e:
@@ -467,11 +743,13 @@ class SearchWindow(QWidget):
             self.hide()
         elif event.key() in (Qt.Key.Key_Up, Qt.Key.Key_Down):
             self.results_list.setFocus()
-            if self.results_list.count() > 0:
-                if self.results_list.currentRow() == -1:
-                    self.results_list.setCurrentRow(0)
+            if self.results_model.rowCount() > 0:
+                if not self.results_list.currentIndex().isValid():
+                    self.results_list.setCurrentIndex(self.results_model.index(0))
         elif event.key() == Qt.Key.Key_Return or event.key() == Qt.Key.Key_Enter:
             if self.results_list.hasFocus() or self.search_bar.hasFocus():
+                # Enter right after typing must act on the results for the typed text
+                self._flush_search()
                 self.copy_to_clipboard()
         else:
             super().keyPressEvent(event)
@@ -481,18 +759,19 @@ class SearchWindow(QWidget):
 
     def copy_to_clipboard(self):
         self.save_state()
-        current_item = self.results_list.currentItem()
-        if current_item:
-            full_path = current_item.data(Qt.ItemDataRole.UserRole)
+        current_index = self.results_list.currentIndex()
+        if current_index.isValid():
+            full_path = current_index.data(Qt.ItemDataRole.UserRole)
             clipboard = QApplication.clipboard()
             clipboard.setText(full_path)
             logging.info(f"Copied to clipboard: {full_path}")
+            self.record_usage(full_path)
             self.hide() 
         else:
-            if self.results_list.count() > 0:
-                item = self.results_list.item(0)
-                full_path = item.data(Qt.ItemDataRole.UserRole)
+            if self.results_model.rowCount() > 0:
+                full_path = self.results_model.paths[0]
                 clipboard = QApplication.clipboard()
                 clipboard.setText(full_path)
                 logging.info(f"Copied to clipboard: {full_path}")
+                self.record_usage(full_path)
                 self.hide()
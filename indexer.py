@@ -2,131 +2,824 @@ import os
 import time
 import logging
 import threading
+from collections import OrderedDict
 import database
 import config
+import stats
+from trigram import TrigramIndex
+from scanner import ParallelScanner
+from snapshot import write_snapshot, load_snapshot
+from pathtable import PathTable, PathList, build_tables
+from matcher import get_matcher, SQLiteMatcher
+from query import parse_query, QueryEngine
+from exclude import ExcludeRules
+from scheduler import ScanScheduler, ScanCancelled
+
+# Number of recent queries whose match sets are kept for refinement
+QUERY_CACHE_SIZE = 16
+# Number of most frecently picked paths kept in memory to boost search results
+HOT_SET_SIZE = 200
+
+
+def in_subtrees(roots):
+    """Returns a predicate telling whether a path is one of roots or lies below one of them."""
+    exact = set(roots)
+    prefixes = tuple(root.rstrip(os.sep) + os.sep for root in roots)
+    return lambda path: path in exact or path.startswith(prefixes)
+
 
 class Indexer:
-    def __init__(self, include_dirs, exclude_dirs=None):
+    def __init__(self, include_dirs, exclude_dirs=None, read_only=False):
+        """
+        With read_only the stored index is only searched: the name index tables and the
+        snapshot are left as they are, e.g. for a --query lookup beside a running instance.
+        """
         self.include_dirs = include_dirs
         self.exclude_dirs = exclude_dirs or []
-        # Load from DB immediately for fast startup
-        self.files, self.directories = database.db.get_index()
+        self.lock = threading.Lock()
+        self.snapshot_generation = None
+        # Bumped on every change to the in-memory index, so matchers can tell when to rebuild caches
+        self.version = 0
+        self.read_only = read_only
+        self.low_memory = database.db.get_setting('low_memory_mode', config.DEFAULT_CONFIG['low_memory_mode'])
+        if self.low_memory and read_only:
+            self.low_memory = database.db.has_name_index()
+        elif self.low_memory and not database.db.enable_name_index():
+            logging.error("Low memory mode is not available with this SQLite. Keeping the index in memory.")
+            self.low_memory = False
+        if self.low_memory:
+            # Names are searched through SQLite's trigram index, nothing is loaded
+            self.matcher = SQLiteMatcher()
+            self._publish(PathTable(), PathTable(), TrigramIndex(), TrigramIndex())
+        else:
+            if not read_only:
+                database.db.disable_name_index()
+            self.matcher = get_matcher(database.db.get_setting('matcher', config.DEFAULT_CONFIG['matcher']))
+        self._query_engine = QueryEngine()
+        self.hot_paths = []
+        self.hot_set = set()
+        self.load_usage()
+        # Map the on-disk snapshot for fast startup, falling back to the DB if it is stale
+        if not self.low_memory and not self._load_snapshot():
+            self._set_index(*database.db.get_index())
+            self.save_snapshot()
         self.last_scan = database.db.get_setting('last_scan', 0)
-        self.is_scanning = False
+        # Scans and root drops run one at a time, normally on the scheduler's worker
+        self._scan_lock = threading.RLock()
+        self._scan_running = threading.Event()
+        self.scheduler = ScanScheduler(self)
+        # (entries found so far, include root being scanned) while a scan runs, else None
+        self.scan_progress = None
+        self.scan_workers = database.db.get_setting('scan_workers', config.DEFAULT_CONFIG['scan_workers'])
+        self.scan_use_processes = database.db.get_setting('scan_use_processes', config.DEFAULT_CONFIG['scan_use_processes'])
 
-    def _is_excluded(self, path):
-        for exclude in self.exclude_dirs:
-            if path.startswith(exclude):
-                return True
-        return False
+    def _set_index(self, files, directories):
+        """
+        Rebuilds the in-memory index from full path lists that list parents first.
+        Paths are stored as parent-pointer tables and trigram posting lists are built over
+        lowercased file names and directory names, then both are swapped in together.
+        A directory with an indexed parent only indexes its own name, because a match on
+        any ancestor component is already found through that parent.
+        Directories without one (the include roots) index their full path.
+        """
+        dir_table, file_table = build_tables(directories, files)
+
+        file_grams = TrigramIndex()
+        for i in range(len(file_table)):
+            file_grams.add(i, file_table.basename(i).lower())
+
+        dir_grams = TrigramIndex()
+        for i, name in enumerate(dir_table.names):
+            dir_grams.add(i, name.lower())
+
+        self._publish(dir_table, file_table, file_grams, dir_grams)
+
+    def _publish(self, dir_table, file_table, file_grams, dir_grams):
+        with self.lock:
+            self._dir_table = dir_table
+            self._file_table = file_table
+            # Full paths are only built when these views are read
+            self.files = PathList(file_table, dir_table)
+            self.directories = PathList(dir_table, dir_table)
+            self._file_grams = file_grams
+            self._dir_grams = dir_grams
+            self._removed_count = 0
+            self.version += 1
+            # Cached match sets refer to entry ids, so they die with the index
+            self._query_cache = OrderedDict()
+            self._hot_resolved = None
+
+    def _load_snapshot(self):
+        """
+        Maps the index snapshot written by the last scan. Names and posting lists stay
+        in the mapped file and are only decoded when a search touches them.
+        Returns False if there is no snapshot matching the DB's current index.
+        """
+        path = database.db.snapshot_path
+        if path is None:
+            return False
+        generation = database.db.index_generation()
+        with stats.timer("load.snapshot"):
+            snapshot = load_snapshot(path, generation)
+        if snapshot is None:
+            return False
+        self._publish(snapshot.dir_table, snapshot.file_table,
+                      TrigramIndex(snapshot.file_postings), TrigramIndex(snapshot.dir_postings))
+        self.snapshot_generation = generation
+        return True
+
+    def save_snapshot(self):
+        """
+        Writes the current index to the snapshot file, tagged with the DB's index generation.
+        Only runs where nothing else changes the index (at startup or under _scan_lock), so
+        the file is written from the current tables without holding up searches.
+        """
+        path = database.db.snapshot_path
+        if path is None or self.low_memory or self.read_only:
+            return
+        with self.lock:
+            dir_table, file_table = self._dir_table, self._file_table
+            dir_grams, file_grams = self._dir_grams, self._file_grams
+        generation = database.db.index_generation()
+        try:
+            write_snapshot(path, generation, dir_table, file_table, dir_grams.items(), file_grams.items())
+        except OSError as e:
+            logging.warning(f"Could not write index snapshot: {e}")
+            return
+        self.snapshot_generation = generation
 
-    def scan_async(self):
-        if self.is_scanning:
+    def flush_snapshot(self):
+        """
+        Rewrites the snapshot if live changes made it stale, so the next start can still map
+        it. Called once changes went quiet and on shutdown. A running scan writes its own,
+        so this returns right away instead of waiting for it.
+        """
+        if not self._scan_lock.acquire(blocking=False):
             return
-        threading.Thread(target=self.scan, daemon=True).start()
+        try:
+            if self.snapshot_generation != database.db.index_generation():
+                with stats.timer("scan.snapshot"):
+                    self.save_snapshot()
+        finally:
+            self._scan_lock.release()
 
-    def scan(self):
-        """Recursively scans the directories and builds a list of files and directories."""
-        self.is_scanning = True
-        logging.info(f"Scanning...")
-        start_time = time.time()
-        file_list = []
-        dir_list = []
-        
-        seen_paths = set()
+    def _dir_matches(self, i, query):
+        """
+        Whether directory row i's name contains the lowercased query. Include roots keep
+        their full path as name, and the query must lie within one of its components.
+        """
+        dirs = self._dir_table
+        name = dirs.names[i]
+        if name is None:
+            return False
+        if dirs.parents[i] < 0:
+            return any(query in part for part in name.lower().split(os.sep))
+        return query in name.lower()
+
+    def _file_matches(self, i, query):
+        name = self._file_table.basename(i)
+        return name is not None and query in name.lower()
+
+    def _match_ids(self, query):
+        """
+        Returns the (dir_ids, file_ids) whose indexed names contain query, or None
+        if the query is too short for the trigram index and needs a full scan.
+        A query can only match a subset of what any of its substrings matched, so
+        the longest cached substring's match set is filtered instead of the index.
+        """
+        cache = self._query_cache
+        if query in cache:
+            cache.move_to_end(query)
+            return cache[query]
+
+        base = None
+        for key in cache:
+            if key in query and (base is None or len(key) > len(base)):
+                base = key
+
+        if base is not None:
+            dir_ids, file_ids = cache[base]
+        else:
+            dir_ids = self._dir_grams.candidates(query)
+            file_ids = self._file_grams.candidates(query)
+            if dir_ids is None:
+                return None
+
+        dir_ids = [i for i in dir_ids if self._dir_matches(i, query)]
+        file_ids = [i for i in file_ids if self._file_matches(i, query)]
 
-        for root_dir in self.include_dirs:
-            if not os.path.exists(root_dir):
+        cache[query] = (dir_ids, file_ids)
+        if len(cache) > QUERY_CACHE_SIZE:
+            cache.popitem(last=False)
+        return dir_ids, file_ids
+
+    def _find(self, table, path, dir_ids=None):
+        """
+        Returns the id of path in table, or None. Costs one lookup per path component.
+        Directories looked up before can be passed in dir_ids (path -> id), which the
+        directories looked up now are added to.
+        """
+        if dir_ids is not None and table is self._dir_table and path in dir_ids:
+            return dir_ids[path]
+        i = self._find_by_name(table, path, dir_ids) if not table.has_child_map() else False
+        if i is False:
+            i = table.find(-1, path)
+            if i is None:
+                head, name = os.path.split(path)
+                # Rows below a parent rebuild their path exactly (e.g. not for 'a//b')
+                if name and os.path.join(head, name) == path:
+                    parent = self._find(self._dir_table, head, dir_ids)
+                    if parent is not None:
+                        i = table.find(parent, name)
+        if dir_ids is not None and table is self._dir_table:
+            dir_ids[path] = i
+        return i
+
+    def _find_by_name(self, table, path, dir_ids):
+        """
+        Like _find for a table without a child map, without building it: the rows that
+        may hold path's name come from its rarest trigram and are told apart by their
+        parent ids. Returns False if the name is too short for a trigram or the table
+        should build its map instead.
+        """
+        head, name = os.path.split(path)
+        grams = self._dir_grams if table is self._dir_table else self._file_grams
+        candidates = grams.rarest(name.lower())
+        if candidates is None or not table.spend(len(candidates)):
+            return False
+        parents, names = table.parents, table.names
+        for i in candidates:
+            if parents[i] < 0 and names[i] == path:
+                return i
+        if not name or os.path.join(head, name) != path:
+            return None
+        parent = self._find(self._dir_table, head, dir_ids)
+        if parent is None:
+            return None
+        return next((i for i in candidates if parents[i] == parent and names[i] == name), None)
+
+    def _append(self, table, grams, path, is_dir, dir_ids=None):
+        """
+        Appends path to table and returns its id. The parent directory is looked up in
+        dir_ids (path -> id) if given, otherwise in the index itself.
+        """
+        if dir_ids is None:
+            parent = self._find(self._dir_table, os.path.dirname(path))
+        else:
+            parent = dir_ids.get(os.path.dirname(path))
+        if parent is None or os.path.join(os.path.dirname(path), os.path.basename(path)) != path:
+            i = table.append(-1, path)
+            grams.add(i, (path if is_dir else os.path.basename(path)).lower())
+        else:
+            i = table.append(parent, os.path.basename(path))
+            grams.add(i, os.path.basename(path).lower())
+        return i
+
+    def _append_batch(self, dirs, files, dir_ids):
+        """
+        Makes a batch of freshly scanned paths searchable right away. Directories must
+        come before anything below them. dir_ids collects the ids of appended directories.
+        """
+        with self.lock:
+            # Tables mapped from a snapshot are read-only until copied
+            self._dir_table.writable()
+            self._file_table.writable()
+            for path in dirs:
+                dir_ids[path] = self._append(self._dir_table, self._dir_grams, path, True, dir_ids)
+            for path in files:
+                self._append(self._file_table, self._file_grams, path, False, dir_ids)
+            self._query_cache.clear()
+            self._hot_resolved = None
+            self.version += 1
+
+    def apply_changes(self, added_files=(), added_dirs=(), removed=()):
+        """
+        Applies filesystem changes to the live index and the database without a rescan.
+        Removed directories take their whole subtree with them. Removed entries are
+        blanked out in place so existing ids stay valid, and the index is compacted
+        once they make up a quarter of it. Added directories must come after their parents.
+        Waits for a running scan, which would otherwise swap its tables over the changes.
+        The snapshot is left stale until flush_snapshot, so bursts of changes write it once.
+        """
+        with self._scan_lock:
+            self._apply_changes(added_files, added_dirs, removed)
+
+    def _apply_changes(self, added_files, added_dirs, removed):
+        if self.low_memory:
+            inserted, deleted = database.db.apply_index_changes(added_files, added_dirs, removed)
+            with self.lock:
+                self._hot_resolved = None
+            logging.info(f"Applied changes to the index ({inserted} rows inserted, {deleted} deleted)")
+            return inserted, deleted
+
+        with self.lock:
+            dirs, files = self._dir_table, self._file_table
+            dirs.writable()
+            files.writable()
+
+            removed_count = 0
+            removed_dirs = []
+            for path in removed:
+                i = self._find(files, path)
+                if i is not None:
+                    files.remove(i)
+                    removed_count += 1
+                i = self._find(dirs, path)
+                if i is not None:
+                    dirs.remove(i)
+                    removed_count += 1
+                    removed_dirs.append(i)
+
+            # Whole subtrees go with a removed directory, found through its children
+            while removed_dirs:
+                d = removed_dirs.pop()
+                for i in files.children(d):
+                    files.remove(i)
+                    removed_count += 1
+                for i in dirs.children(d):
+                    dirs.remove(i)
+                    removed_count += 1
+                    removed_dirs.append(i)
+
+            new_dirs = [p for p in dict.fromkeys(added_dirs) if self._find(dirs, p) is None]
+            for path in new_dirs:
+                self._append(dirs, self._dir_grams, path, True)
+
+            new_files = [p for p in dict.fromkeys(added_files) if self._find(files, p) is None]
+            for path in new_files:
+                self._append(files, self._file_grams, path, False)
+
+            self._query_cache.clear()
+            if not self.hot_set.isdisjoint(new_dirs) or not self.hot_set.isdisjoint(new_files):
+                # Removed hot paths are skipped by _boost, added ones need resolving
+                self._hot_resolved = None
+            self.version += 1
+            self._removed_count += removed_count
+            compact = self._removed_count * 4 > len(files) + len(dirs)
+
+        inserted, deleted = database.db.apply_index_changes(new_files, new_dirs, removed)
+        if compact:
+            self._set_index([p for p in self.files if p is not None], [p for p in self.directories if p is not None])
+        logging.info(f"Applied {len(new_dirs) + len(new_files)} additions and {removed_count} removals to the index "
+                     f"({inserted} rows inserted, {deleted} deleted)")
+        return inserted, deleted
+
+    def rescan_subtree(self, root):
+        """Incrementally rescans one directory tree and merges the differences into the index."""
+        with self._scan_lock:
+            self._rescan_subtree(root)
+
+    def _rescan_subtree(self, root):
+        known = self._previous_listings(root)
+        scanner = ParallelScanner(self._is_excluded, self.scan_workers, self.scan_use_processes)
+        dir_list, file_list, dir_states, listed_count = scanner.scan([root], known)
+        if listed_count:
+            below = in_subtrees([root])
+            indexed_dirs, indexed_files = self._indexed_paths(root)
+            old_dirs = {p for p in indexed_dirs if p is not None and below(p)}
+            old_files = {p for p in indexed_files if p is not None and below(p)}
+            removed = (old_dirs - set(dir_list)) | (old_files - set(file_list))
+            self.apply_changes([p for p in file_list if p not in old_files],
+                               [p for p in dir_list if p not in old_dirs], removed)
+        database.db.replace_dir_states(dir_states, root)
+
+    @property
+    def exclude_dirs(self):
+        return self._exclude_rules.patterns
+
+    @exclude_dirs.setter
+    def exclude_dirs(self, patterns):
+        # Compiled once here instead of being re-checked one by one for every entry
+        self._exclude_rules = ExcludeRules(patterns or [])
+
+    def _is_excluded(self, path):
+        return self._exclude_rules(path)
+
+    def scan_async(self, roots=None):
+        """Queues a scan on the scheduler's worker thread, merged with any scan already waiting."""
+        self.scheduler.request(roots)
+
+    def _indexed_paths(self, root=None):
+        """
+        Returns (dirs, files) iterables over the indexed paths. In low-memory mode they are
+        read lazily from the DB, limited to the subtree at root if given, so a caller only
+        reading one of them leaves the other unread. Otherwise they are the in-memory views,
+        which are not limited.
+        """
+        if self.low_memory:
+            return database.db.iter_paths('dir', root), database.db.iter_paths('file', root)
+        return self.directories, self.files
+
+    def is_empty(self):
+        if self.low_memory:
+            return database.db.index_size() == 0
+        return len(self.files) + len(self.directories) == 0
+
+    def _previous_listings(self, root=None):
+        """
+        Rebuilds each directory's last listing from the current index and the stored
+        directory states, so the scanner can reuse it if the directory is unchanged.
+        Directories with a child whose state is unknown are left out and listed again.
+        """
+        states = database.db.get_dir_states(root)
+        listings = {path: (state, [], []) for path, state in states.items()}
+
+        if self.low_memory:
+            dir_rows = ((*os.path.split(path), path) for path in database.db.iter_paths('dir', root))
+            file_rows = (os.path.split(path) for path in database.db.iter_paths('file', root))
+        else:
+            # Rows refer to their parent by id, so only directory paths are built
+            dir_paths = list(self.directories)
+
+            def split(table):
+                for parent, name in zip(table.parents, table.names):
+                    if name is None:
+                        yield None, None
+                    elif parent < 0:
+                        yield os.path.split(name)
+                    else:
+                        yield dir_paths[parent], name
+
+            dir_rows = ((head, name, path) for (head, name), path in zip(split(self._dir_table), dir_paths))
+            file_rows = split(self._file_table)
+
+        for head, name, path in dir_rows:
+            listing = listings.get(head)
+            if listing is None:
                 continue
-            
-            # Add root dir itself if not excluded
-            if root_dir not in seen_paths and not self._is_excluded(root_dir):
-                dir_list.append(root_dir)
-                seen_paths.add(root_dir)
+            state = states.get(path)
+            if state is None:
+                listings.pop(head)
+                continue
+            # A directory's loop detection key is its (device, inode)
+            listing[1].append((name, (state[2], state[1])))
+
+        for head, name in file_rows:
+            listing = listings.get(head)
+            if listing is not None:
+                listing[2].append(name)
+
+        return listings
+
+    @property
+    def is_scanning(self):
+        """Whether a scan is running, or waiting on the scheduler."""
+        return self._scan_running.is_set() or self.scheduler.busy
 
+    def scan(self, full=False, roots=None, cancel=None):
+        """
+        Recursively scans the directories and builds a list of files and directories.
+        Unless full is set, directories whose mtime and inode match the last scan are not
+        listed again. Their entries are carried over from the current index.
+        If roots is given, only those include roots (shards) are scanned and replaced,
+        and the entries of the other roots are kept as they are.
+        Setting the cancel event stops the scan with ScanCancelled before the index is
+        replaced. Blocks the caller, scan_async queues the scan on the scheduler instead.
+        """
+        with self._scan_lock:
+            self._scan_running.set()
             try:
-                for root, dirs, files in os.walk(root_dir, followlinks=True):
-                    # Loop Detection: Verify if we've seen this real path before
-                    real_root = os.path.realpath(root)
-                    if real_root in seen_paths:
-                        # We might have entered a loop or just a diamond. 
-                        # Ideally os.walk with followlinks handles simple recursion, but let's be safe.
-                        # Actually, os.walk(followlinks=True) DOES NOT protect against infinite loops in Python < 3.10 approx? 
-                        # In standard python os.walk, it can loop efficiently. 
-                        # We must track visited REAL paths of directories we descend into.
-                        # But here, 'root' changes as we walk.
-                        # If we track all files, we might be fine, but let's be explicitly careful with dirs.
-                        pass
-                    
-                    # Instead of complex walk manipulation, let's just use strict realpath tracking for what we add.
-                    
-                    # Prune excluded directories and hidden directories
-                    # Also prune if we've already processed this real directory to prevent loops
-                    i = 0
-                    while i < len(dirs):
-                        d = dirs[i]
-                        full_path = os.path.join(root, d)
-                        real_path = os.path.realpath(full_path)
-                        
-                        if d.startswith('.') or self._is_excluded(full_path) or real_path in seen_paths:
-                            del dirs[i]
-                        else:
-                            # We mark it as seen now, so we don't process it again via another link or loop
-                            seen_paths.add(real_path)
-                            # Also add to results
-                            dir_list.append(full_path) 
-                            i += 1
-                    
-                    for file in files:
-                        if not file.startswith('.'):
-                            full_path = os.path.join(root, file)
-                            # We might accept symlinked files too
-                            if full_path not in seen_paths and not self._is_excluded(full_path):
-                                file_list.append(full_path)
-                                seen_paths.add(full_path) # Treating files by path, not realpath? 
-                                # If we want to dedup files by content/inode, we should use realpath.
-                                # But for search, maybe we want both aliases?
-                                # User said "scan soft links as well - so long as the soft links are not an infinite loop".
-                                # Loops only happen with directories. Files are fine.
-            except Exception as e:
-                logging.error(f"Error scanning {root_dir}: {e}")
-
-        # Update Memory
-        self.files = file_list
-        self.directories = dir_list
+                self._scan(full, roots, cancel)
+            finally:
+                self.scan_progress = None
+                self._scan_running.clear()
+
+    def _scan(self, full, roots, cancel):
+        if roots is not None:
+            # Roots removed from the settings since the request are not scanned anymore
+            roots = [root for root in roots if root in self.include_dirs]
+            if not roots:
+                return
+        self.scan_progress = (0, None)
+        partial = roots is not None and set(roots) != set(self.include_dirs)
+        roots = list(dict.fromkeys(roots if partial else self.include_dirs))
+        logging.info(f"Scanning {', '.join(roots) if partial else '...'}")
+        start_time = time.time()
+
+        # Cached listings only hold what the old exclude rules let through
+        indexed_excludes = database.db.get_setting('indexed_exclude_directories')
+        known = None
+        if not full and indexed_excludes == list(self.exclude_dirs):
+            known = self._previous_listings()
+
+        # With nothing of these roots searchable yet (first run or a new root), found paths
+        # are made searchable and stored batch by batch. Otherwise the old entries stay up
+        # until the swap below.
+        if self.is_empty():
+            self._publish(PathTable(), PathTable(), TrigramIndex(), TrigramIndex())
+            stream = True
+        else:
+            stream = not any(self._is_indexed(root) for root in roots)
+        streamed_ids = {}
+        streamed_dirs, streamed_files = [], []
+        streamed_rows = 0
+        found = 0
+
+        scanner = ParallelScanner(self._is_excluded, self.scan_workers, self.scan_use_processes)
+        batches = scanner.iter_batches(roots, known)
+        while True:
+            try:
+                root, batch_dirs, batch_files = next(batches)
+            except StopIteration as done:
+                dir_list, file_list, dir_states, listed_count = done.value
+                break
+            if cancel is not None and cancel.is_set():
+                batches.close()
+                self._cancelled(roots, stream)
+            found += len(batch_dirs) + len(batch_files)
+            self.scan_progress = (found, root)
+            if stream:
+                if not self.low_memory:
+                    self._append_batch(batch_dirs, batch_files, streamed_ids)
+                    streamed_dirs.extend(batch_dirs)
+                    streamed_files.extend(batch_files)
+                streamed_rows += database.db.apply_index_changes(batch_files, batch_dirs, ())[0]
+        walk_time = max(time.time() - start_time, 1e-6)
+        stats.record("scan.walk", walk_time)
+        if cancel is not None and cancel.is_set():
+            self._cancelled(roots, stream)
+
+        # Nothing was listed, and every directory was reached and kept: the scan found
+        # exactly the listings the index was built from
+        unchanged = known is not None and not listed_count and len(dir_states) == len(dir_list)
+        db_roots = roots if partial else None
+        if unchanged:
+            inserted = deleted = 0
+        elif stream or self.low_memory:
+            # Update Memory, in the scanner's top-down order, which keeps parents before children
+            # and is the order results are listed in. This swaps out anything streamed in above in one step, so nothing shows up twice.
+            # Streamed entries keep the order their batches came in, which is how they were stored.
+            # Other roots' entries are carried over, but nothing outside the include roots.
+            if not self.low_memory:
+                with stats.timer("scan.swap"):
+                    all_dirs, all_files = (streamed_dirs, streamed_files) if stream else (dir_list, file_list)
+                    if partial:
+                        scanned = in_subtrees(roots)
+                        kept = in_subtrees(self.include_dirs)
+                        found_dirs, found_files = all_dirs, all_files
+                        all_dirs = [p for p in self.directories if p is not None and kept(p) and not scanned(p)]
+                        all_files = [p for p in self.files if p is not None and kept(p) and not scanned(p)]
+                        all_dirs.extend(found_dirs)
+                        all_files.extend(found_files)
+                    self._set_index(all_files, all_dirs)
+            # Update Database (only rows that changed are written, streamed ones already are)
+            inserted, deleted = database.db.update_index(file_list, dir_list, db_roots)
+        else:
+            # The index stays up and only takes the differences, like live changes do
+            with stats.timer("scan.swap"):
+                inserted, deleted = self._merge_scan(dir_list, file_list, db_roots)
         self.last_scan = time.time()
+        with self.lock:
+            self._hot_resolved = None
+
+        inserted += streamed_rows
+        if not unchanged:
+            database.db.update_dir_states(dir_states, db_roots)
+        if inserted or deleted or self.snapshot_generation != database.db.index_generation():
+            with stats.timer("scan.snapshot"):
+                self.save_snapshot()
+        if not partial:
+            database.db.set_setting('indexed_exclude_directories', list(self.exclude_dirs))
+
+        # Each root is a shard with its own scan time, which schedules its next rescan
+        for root in roots:
+            database.db.update_shard(root, self.last_scan, scanner.root_entries.get(root, 0),
+                                     scanner.root_seconds.get(root, 0.0))
+            if root in scanner.root_seconds:
+                # Only include roots get a histogram, the roots of subtree rescans would pile up
+                stats.record(f"scan.root {root}", scanner.root_seconds[root])
+        if not partial:
+            database.db.set_setting('last_scan', self.last_scan)
         
-        # Update Database
-        database.db.update_index(self.files, self.directories)
-        
-        # Update Config Last Scan Time
-        # We need to load config, update, save. 
-        # But we are in indexer... better to just update the specific setting via DB or generic config?
-        # Let's simple use config module
-        conf = config.load_config()
-        conf['last_scan'] = self.last_scan
-        config.save_config(conf)
-        
-        logging.info(f"Scanned {len(self.directories)} directories and {len(self.files)} files in {self.last_scan - start_time:.4f}s")
-        self.is_scanning = False
-    
+        entries = len(dir_list) + len(file_list)
+        stats.record("scan.total", time.time() - start_time)
+        stats.count("scan.listed_directories", listed_count)
+        stats.count("scan.rows_written", inserted + deleted)
+        logging.info(f"Scanned {len(dir_list)} directories and {len(file_list)} files in {self.last_scan - start_time:.4f}s "
+                     f"({len(dir_list) / walk_time:.0f} dirs/s, {entries / walk_time:.0f} entries/s, "
+                     f"{listed_count} of {len(dir_states)} directories listed, {inserted} rows inserted, {deleted} deleted)")
+
+    def _merge_scan(self, dir_list, file_list, roots):
+        """
+        Applies the differences between a scan's results and the in-memory index, within
+        the subtrees of roots or everywhere if None. Returns (inserted, deleted) DB rows.
+        """
+        dir_ids = {path: i for i, path in enumerate(self.directories) if path is not None}
+        files = self._file_table
+        scanned = (lambda path: True) if roots is None else in_subtrees(roots)
+
+        def is_indexed_file(path):
+            head, name = os.path.split(path)
+            parent = dir_ids.get(head)
+            return files.find(-1, path) is not None or (parent is not None and files.find(parent, name) is not None)
+
+        found_dirs = set(dir_list)
+        found_files = set(file_list)
+        removed_dirs = {path for path in dir_ids if path not in found_dirs and scanned(path)}
+        removed = [path for path in self.files
+                   if path is not None and path not in found_files and scanned(path)]
+        removed.extend(removed_dirs)
+        # Whatever lies below a removed directory goes with it
+        removed = [path for path in removed if os.path.dirname(path) not in removed_dirs]
+        return self._apply_changes([path for path in file_list if not is_indexed_file(path)],
+                                   [path for path in dir_list if path not in dir_ids], removed)
+
+    def _cancelled(self, roots, streamed):
+        """Cleans up after a cancelled scan and raises ScanCancelled."""
+        if streamed:
+            # Streamed entries of roots removed meanwhile would otherwise linger
+            removed = [root for root in roots if root not in self.include_dirs]
+            if removed:
+                self.drop_roots(removed)
+        raise ScanCancelled()
+
+    def shard_info(self):
+        """Returns {root: (last_scan, entries, scan_seconds)} for the include roots scanned so far."""
+        shards = database.db.get_shards()
+        return {root: shards[root] for root in self.include_dirs if root in shards}
+
+    def refresh_interval(self, root):
+        """Seconds between scheduled rescans of root, from its own setting or the default."""
+        days = database.db.get_setting('refresh_intervals', {}).get(root)
+        if days is None:
+            days = database.db.get_setting('refresh_interval_days', config.DEFAULT_CONFIG['refresh_interval_days'])
+        return days * 24 * 60 * 60
+
+    def due_roots(self, now=None):
+        """Returns the include roots whose refresh interval has passed since their last scan."""
+        now = time.time() if now is None else now
+        shards = database.db.get_shards()
+        # Roots indexed before shards existed share the old global scan time
+        fallback = database.db.get_setting('last_scan', 0)
+        due = []
+        for root in dict.fromkeys(self.include_dirs):
+            if root in shards:
+                last_scan = shards[root][0]
+            else:
+                last_scan = fallback if self._is_indexed(root) else 0
+            if now - last_scan > self.refresh_interval(root):
+                due.append(root)
+        return due
+
+    def reconfigure(self, include_dirs, exclude_dirs):
+        """
+        Applies new include and exclude lists without blocking. Removed roots are dropped
+        and new ones scanned on the scheduler, which cancels a scan still running for
+        the old settings. Changed exclusions rescan every root.
+        """
+        old_includes = list(self.include_dirs)
+        old_excludes = list(self.exclude_dirs)
+        self.include_dirs = list(include_dirs)
+        self.exclude_dirs = exclude_dirs
+        removed = [root for root in old_includes if root not in self.include_dirs]
+        if list(self.exclude_dirs) != old_excludes:
+            roots = None
+        else:
+            roots = [root for root in dict.fromkeys(self.include_dirs) if root not in old_includes]
+        if removed or roots is None or roots:
+            self.scheduler.request(roots, drop=removed, cancel=True)
+
+    def drop_roots(self, roots):
+        """
+        Removes the entries of roots that are no longer included from the index, the
+        database and the shard table. Anything another include root covers stays.
+        """
+        with self._scan_lock:
+            self._drop_roots(list(dict.fromkeys(roots)))
+
+    def _drop_roots(self, roots):
+        kept = in_subtrees(self.include_dirs)
+        if not self.low_memory:
+            self._set_index([p for p in self.files if p is not None and kept(p)],
+                            [p for p in self.directories if p is not None and kept(p)])
+
+        kept_files, kept_dirs, kept_states = [], [], []
+        for root in roots:
+            kept_files.extend(p for p in database.db.iter_paths('file', root) if kept(p))
+            kept_dirs.extend(p for p in database.db.iter_paths('dir', root) if kept(p))
+            kept_states.extend((p, *state) for p, state in database.db.get_dir_states(root).items() if kept(p))
+        inserted, deleted = database.db.update_index(kept_files, kept_dirs, roots)
+        database.db.update_dir_states(kept_states, roots)
+        database.db.delete_shards(roots)
+        self.save_snapshot()
+        # Watchers resync with the index when this changes, like after a scan
+        self.last_scan = time.time()
+        with self.lock:
+            self._hot_resolved = None
+        logging.info(f"Dropped {', '.join(roots)} from the index ({deleted} rows deleted)")
+
+    def load_usage(self):
+        """Loads the most frecently picked paths, best first, so searches can boost them without a DB query."""
+        hot_paths = [path for path, _ in database.db.get_frecent_paths(HOT_SET_SIZE)]
+        with self.lock:
+            self.hot_paths = hot_paths
+            self.hot_set = set(hot_paths)
+            self._hot_resolved = None
+
+    def record_usage(self, path):
+        """Records that path was picked (copied or opened) and refreshes the hot set."""
+        database.db.record_usage(path)
+        self.load_usage()
+
+    def _is_indexed(self, path):
+        if self.low_memory:
+            return database.db.has_path(path)
+        return self._find(self._file_table, path) is not None or self._find(self._dir_table, path) is not None
+
+    def _hot_entries(self):
+        """
+        The indexed hot paths as (path, is_dir, table, id), looked up once after the index
+        or the hot set changed instead of on every search. In low-memory mode table and id
+        are None.
+        """
+        if self._hot_resolved is None:
+            resolved = []
+            dir_ids = {}
+            for path in self.hot_paths:
+                if self.low_memory:
+                    kind = database.db.path_type(path)
+                    if kind is not None:
+                        resolved.append((path, kind == 'dir', None, None))
+                    continue
+                for table in (self._file_table, self._dir_table):
+                    i = self._find(table, path, dir_ids)
+                    if i is not None:
+                        resolved.append((path, table is self._dir_table, table, i))
+                        break
+            self._hot_resolved = resolved
+        return self._hot_resolved
+
+    def _boost(self, matches, results, limit):
+        """
+        Moves hot paths for which matches(path, is_dir) holds to the front, most frecent
+        first, even if the search cut them off.
+        """
+        # Rows removed since the lookup are blanked in place
+        hot = [p for p, is_dir, table, i in self._hot_entries()
+               if (table is None or table.names[i] is not None) and matches(p, is_dir)]
+        if not hot:
+            return results
+        boosted = set(hot)
+        return (hot + [p for p in results if p not in boosted])[:limit]
+
+    def set_matcher(self, name):
+        """Switches the matching engine used by search, see matcher.MATCHERS."""
+        if self.low_memory:
+            # Only SQLite can search an index that is not in memory
+            return
+        with self.lock:
+            self.matcher = get_matcher(name)
+
     def search(self, query, limit=50):
         """
-        Search for files and directories.
+        Search for files and directories with the configured matcher. Frecently picked
+        paths that match come first.
+        The default substring matcher works as follows:
         - Directories: specific path component matching query is returned.
                        (e.g. search 'foo' in 'a/b/foo/d' returns 'a/b/foo')
         - Files: ONLY matches if filename matches query.
+        Anything beyond a single term (several terms, dir/ scopes, ext: and type: filters,
+        negation) is planned by the query engine instead, see query.py.
         """
-        if not query:
+        parsed = parse_query(query.lower())
+        if not parsed.conditions:
             return []
-        
-        query = query.lower()
+
+        with stats.timer("search"), self.lock:
+            if parsed.is_simple:
+                text = parsed.text
+                results = self.matcher.search(self, text, limit)
+                matches = lambda path, is_dir: self.matcher.matches(text, path)
+            else:
+                if self.low_memory:
+                    results = parsed.search_database(limit, self.include_dirs)
+                else:
+                    results = self._query_engine.search(self, parsed, limit)
+                matches = parsed.matches
+            if self.hot_paths:
+                results = self._boost(matches, results, limit)
+            return results
+
+    def _search(self, query, limit):
         results_set = set() # For deduplication
         dir_results = []
         file_results = []
         
+        # Only paths whose indexed names contain the query can match.
+        # Queries shorter than a trigram fall back to a full scan.
+        matched = self._match_ids(query)
+        dirs, files = self._dir_table, self._file_table
+        if matched is None:
+            dir_candidates = self.directories
+            file_ids = (i for i in range(len(files)) if self._file_matches(i, query))
+        else:
+            dir_ids, file_ids = matched
+            dir_candidates = (dirs.path(i, dirs) for i in dir_ids)
+
         # 1. Search Directories (with path collapsing)
-        for path in self.directories:
+        for path in dir_candidates:
+            if path is None:
+                continue
             # Quick check if query is in path at all to save time
             path_lower = path.lower()
             if query in path_lower:
@@ -162,13 +855,12 @@ class Indexer:
         if len(results_set) >= limit:
             return dir_results
 
-        # 2. Search Files (Strict filename match)
-        for path in self.files:
-            filename = os.path.basename(path)
-            if query in filename.lower():
-                if path not in results_set:
-                    file_results.append(path)
-                    results_set.add(path)
+        # 2. Search Files (Strict filename match, ids are already filtered by name)
+        for i in file_ids:
+            path = files.path(i, dirs)
+            if path not in results_set:
+                file_results.append(path)
+                results_set.add(path)
                     
             if len(results_set) >= limit:
                 break
@@ -0,0 +1,99 @@
+import os
+import socket
+
+# Every hotkey press starts a client, so only cheap modules are imported up front.
+# json and logging are imported where they are needed.
+
+# The running instance listens here, in the same temp dir Qt uses ($TMPDIR or /tmp).
+# Clients only need the stdlib to talk to it.
+SOCKET_PATH = os.path.join(os.environ.get("TMPDIR") or "/tmp", "fstasearch_socket")
+
+# Commands are single lines:
+#   SHOW [<launched>]          - show the search window, no reply. launched is the client's
+#                                time.monotonic() at startup, to record launch-to-window latency
+#   QUERY <limit> <text>       - reply with matching paths, one per line
+#   QUERYJSON <limit> <text>   - reply with {"results": [...]} on one line
+#   STATS                      - reply with the timing statistics as a text table
+#   STATSJSON                  - reply with stats.snapshot() as JSON on one line
+# The server closes the connection after replying, which marks the end of the reply.
+
+def format_results(results, as_json=False):
+    if as_json:
+        import json
+        return json.dumps({"results": results}).encode() + b"\n"
+    return "".join(path + "\n" for path in results).encode("utf-8", "surrogateescape")
+
+def handle_command(line, indexer, show_window):
+    """Runs one command line received by the server and returns the reply bytes."""
+    import logging
+    command, _, arg = line.rstrip("\r\n").partition(" ")
+    if command == "SHOW":
+        show_window()
+        if arg:
+            import stats
+            import time
+            try:
+                # CLOCK_MONOTONIC is shared by every process on the machine
+                stats.record("client.show", time.monotonic() - float(arg))
+            except ValueError:
+                logging.warning(f"Bad launch time: {arg!r}")
+        return b""
+    if command in ("QUERY", "QUERYJSON"):
+        limit, _, text = arg.partition(" ")
+        try:
+            limit = int(limit)
+        except ValueError:
+            logging.warning(f"Bad query limit: {limit!r}")
+            return b""
+        return format_results(indexer.search(text, limit), command == "QUERYJSON")
+    if command in ("STATS", "STATSJSON"):
+        import stats
+        data = stats.snapshot()
+        if command == "STATSJSON":
+            import json
+            return json.dumps(data).encode() + b"\n"
+        return stats.format_report(data).encode()
+    logging.warning(f"Unknown command: {command!r}")
+    return b""
+
+def send_command(line, timeout=2.0, expect_reply=True):
+    """
+    Sends one command line to the running instance and returns its whole reply,
+    or None if no instance is listening or it did not answer within timeout
+    (its GUI thread may be busy). Without expect_reply, the command counts as
+    delivered once connected: the instance reads it when it gets to it, and b""
+    is returned without waiting, even if the send failed halfway.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        try:
+            sock.connect(SOCKET_PATH)
+        except OSError:
+            return None
+
+        try:
+            sock.sendall(line.encode("utf-8", "surrogateescape") + b"\n")
+            if not expect_reply:
+                return b""
+            chunks = []
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            return b"".join(chunks)
+        except OSError:
+            # An instance is listening, so never start a second one for a SHOW
+            return None if expect_reply else b""
+    finally:
+        sock.close()
+
+def show(launched, timeout=1.0):
+    """Asks the running instance to show its window. Returns False if none is listening."""
+    return send_command(f"SHOW {launched!r}", timeout, expect_reply=False) is not None
+
+def query(text, limit=50, as_json=False):
+    """Searches the running instance's index. Returns the reply bytes, or None if it is not running."""
+    command = "QUERYJSON" if as_json else "QUERY"
+    return send_command(f"{command} {limit} {text}")
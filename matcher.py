@@ -0,0 +1,478 @@
+import os
+import re
+import heapq
+from array import array
+from bisect import bisect_right
+import database
+
+# Scoring weights for FuzzyMatcher, in the spirit of fzf's v1 algorithm
+SCORE_MATCH = 16
+BONUS_BOUNDARY = 8
+BONUS_CAMEL = 7
+BONUS_CONSECUTIVE = 4
+BONUS_FIRST_CHAR_MULTIPLIER = 2
+PENALTY_GAP_START = 3
+PENALTY_GAP_EXTENSION = 1
+SEPARATORS = set('/_-. ')
+# Characters after which a blob position starts a word; rows are separated by newlines
+WORD_STARTS = SEPARATORS | {'\n'}
+
+
+class Matcher:
+    """A search strategy over an Indexer's tables. Called with the indexer lock held."""
+    name = None
+
+    def search(self, indexer, query, limit):
+        raise NotImplementedError
+
+    def matches(self, query, path):
+        """Whether a single path's name matches the lowercased query."""
+        raise NotImplementedError
+
+
+class SubstringMatcher(Matcher):
+    """Case-insensitive substring match, directories first, in index order. The default."""
+    name = "substring"
+
+    def search(self, indexer, query, limit):
+        return indexer._search(query, limit)
+
+    def matches(self, query, path):
+        return query in os.path.basename(path).lower()
+
+
+def fuzzy_score(query, name):
+    """
+    Scores name for the lowercased query, or returns None if query is not a subsequence.
+    The leftmost match is tightened backwards from where it ends, so the score reflects
+    the shortest window. Each matched character earns a bonus for starting the name or a
+    word, characters in a contiguous run share the best bonus of the run, and gaps cost points.
+    """
+    lower = name.lower()
+    # Lowercasing can change the length ('İ' becomes two characters). Positions then only
+    # line up with the lowercased name, which has no case left for camel humps.
+    cased = name if len(lower) == len(name) else lower
+    pos = -1
+    for ch in query:
+        pos = lower.find(ch, pos + 1)
+        if pos < 0:
+            return None
+
+    positions = [pos]
+    for ch in reversed(query[:-1]):
+        pos = lower.rfind(ch, 0, pos)
+        positions.append(pos)
+    positions.reverse()
+
+    score = 0
+    prev = -1
+    run_bonus = 0
+    for p in positions:
+        if p == 0 or cased[p - 1] in SEPARATORS:
+            bonus = BONUS_BOUNDARY
+        elif cased[p - 1].islower() and cased[p].isupper():
+            bonus = BONUS_CAMEL
+        else:
+            bonus = 0
+
+        if prev >= 0 and p == prev + 1:
+            # A contiguous run keeps the bonus of the word start it began on
+            run_bonus = max(run_bonus, bonus, BONUS_CONSECUTIVE)
+            bonus = run_bonus
+        else:
+            if prev >= 0:
+                score -= PENALTY_GAP_START + (p - prev - 2) * PENALTY_GAP_EXTENSION
+            run_bonus = bonus
+        if prev < 0:
+            bonus *= BONUS_FIRST_CHAR_MULTIPLIER
+        score += SCORE_MATCH + bonus
+        prev = p
+    # Among equal matches, prefer the shorter name
+    return score - len(name) / 1000
+
+
+def _max_score(length):
+    """The best fuzzy_score a query of this length can reach, ignoring the length tiebreak."""
+    return (SCORE_MATCH + BONUS_BOUNDARY) * length + BONUS_BOUNDARY * (BONUS_FIRST_CHAR_MULTIPLIER - 1)
+
+
+def _subsequence_pattern(query):
+    """
+    Compiles a regex matching query as a subsequence within one line. Each gap only
+    skips characters other than the next wanted one, so a failed line costs a
+    single linear pass instead of backtracking.
+    """
+    parts = []
+    for ch, following in zip(query, query[1:]):
+        parts.append(re.escape(ch) + "[^\n" + re.escape(following) + "]*")
+    parts.append(re.escape(query[-1]))
+    return re.compile("".join(parts))
+
+
+class FuzzyMatcher(Matcher):
+    """
+    fzf-style subsequence matching over file and directory names, ranked by fuzzy_score.
+    Candidates are found in bulk: every lowercased name is joined into one text blob and
+    a single regex pass finds the lines containing the query as a subsequence.
+    Only those lines are scored, and the best `limit` are kept in a heap. Lines where the
+    query starts a word are ranked first, which often settles the top k on its own.
+    """
+    name = "fuzzy"
+
+    def __init__(self):
+        self._version = None
+        self._tables = None
+        self._blob = ""
+        self._starts = array('Q')
+        # Blob row -> entry, directory ids as is and file ids as -1 - id
+        self._entries = array('q')
+        self._dir_count = 0
+        self._file_count = 0
+
+    def matches(self, query, path):
+        return fuzzy_score(query, os.path.basename(path)) is not None
+
+    def _prepare(self, indexer):
+        """
+        Brings the name blob up to date when the index changed since the last search.
+        Rows appended to the tables are added to the end, removed ones stay and are
+        skipped. Only a compaction or reload, which replaces the tables, rebuilds it.
+        """
+        if self._version == indexer.version:
+            return
+        dirs, files = indexer._dir_table, indexer._file_table
+        if self._tables is None or self._tables[0] is not dirs or self._tables[1] is not files:
+            self.__init__()
+            self._tables = (dirs, files)
+        new_dirs = range(self._dir_count, len(dirs))
+        new_files = range(self._file_count, len(files))
+        names = [dirs.names[i] or "" for i in new_dirs]
+        names.extend((files.basename(i) or "") for i in new_files)
+        # Offsets must come from the lowercased names, which can be longer, and a newline
+        # inside a name must not start a row of its own
+        names = [name.lower().replace("\n", "\0") for name in names]
+
+        if names:
+            pos = len(self._blob) + 1 if self._starts else 0
+            for name in names:
+                self._starts.append(pos)
+                pos += len(name) + 1
+            self._blob = (self._blob + "\n" if len(self._starts) > len(names) else "") + "\n".join(names)
+            self._entries.extend(new_dirs)
+            self._entries.extend(-1 - i for i in new_files)
+        self._dir_count = len(dirs)
+        self._file_count = len(files)
+        self._version = indexer.version
+
+    def _rows(self, pattern):
+        """Yields each row of the blob that pattern matches in, once."""
+        starts = self._starts
+        last = -1
+        for match in pattern.finditer(self._blob):
+            row = bisect_right(starts, match.start()) - 1
+            if row != last:
+                last = row
+                yield row
+
+    def _word_start_rows(self, query):
+        """Yields each row of the blob where query occurs at the start of a word, once."""
+        blob = self._blob
+        starts = self._starts
+        last = -1
+        pos = blob.find(query)
+        while pos >= 0:
+            if not pos or blob[pos - 1] in WORD_STARTS:
+                row = bisect_right(starts, pos) - 1
+                if row != last:
+                    last = row
+                    yield row
+            pos = blob.find(query, pos + 1)
+
+    def search(self, indexer, query, limit):
+        self._prepare(indexer)
+        dirs, files = indexer._dir_table, indexer._file_table
+        entries = self._entries
+        heap = []
+        scored = set()
+
+        starts = self._starts
+        blob_end = len(self._blob) + 1
+        top = _max_score(len(query))
+
+        def rank(rows):
+            for row in rows:
+                if row in scored:
+                    continue
+                scored.add(row)
+                # Ties keep index order, directories first
+                entry = entries[row]
+                order = (1, -entry) if entry >= 0 else (0, 1 + entry)
+                if len(heap) == limit:
+                    # Skip rows that could not beat the k-th best even with a perfect match
+                    end = starts[row + 1] if row + 1 < len(starts) else blob_end
+                    if (top - (end - starts[row] - 1) / 1000, *order) <= heap[0]:
+                        continue
+                name = dirs.names[entry] if entry >= 0 else files.basename(-1 - entry)
+                score = None if name is None else fuzzy_score(query, name)
+                if score is None:
+                    continue
+                item = (score, *order)
+                if len(heap) < limit:
+                    heapq.heappush(heap, item)
+                elif item > heap[0]:
+                    heapq.heapreplace(heap, item)
+
+        # Names containing the query as a word-start run score (nearly) the maximum.
+        # Any other match either starts on a camel-case hump or has a gap, which caps its
+        # score at best_rest, so if these alone fill the top k above that the full
+        # subsequence pass can be skipped.
+        rank(self._word_start_rows(query))
+        best_rest = top - min(PENALTY_GAP_START, (BONUS_BOUNDARY - BONUS_CAMEL) * (len(query) + 1))
+        if len(heap) < limit or heap[0][0] <= best_rest:
+            rank(self._rows(_subsequence_pattern(query)))
+
+        results = []
+        for _, is_dir, i in sorted(heap, reverse=True):
+            results.append(dirs.path(-i, dirs) if is_dir else files.path(-i, dirs))
+        return results
+
+
+def _load_numpy():
+    """NumPy is optional. Without it, PackedMatcher maps hits to rows one at a time."""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def _distinct(numpy, rows):
+    """Drops repeats from a sorted array, cheaper than numpy.unique which sorts or hashes."""
+    if len(rows) < 2:
+        return rows
+    return rows[numpy.concatenate(([True], rows[1:] != rows[:-1]))]
+
+
+def _collapse(path, query):
+    """Cuts a directory path after its top-most component containing the lowercased query."""
+    parts = path.split(os.sep)
+    for depth, part in enumerate(parts):
+        if query in part.lower():
+            return os.sep.join(parts[:depth + 1])
+    return path
+
+
+class PackedMatcher(Matcher):
+    """
+    Substring matching with the same results as SubstringMatcher, found in bulk instead
+    of testing one path at a time. Every lowercased name is packed into one UTF-8 buffer,
+    a line per row with directories first, next to the offset each line starts at.
+    Files are found with bytes.find, which scans the buffer at C speed, and chunks of hit
+    offsets are mapped back to rows with one numpy.searchsorted call. Hits come in row
+    order, so the scan stops as soon as `limit` results are collected.
+    With NumPy, the directory lines are matched in one vectorized pass as well.
+    Selective queries are still answered from the trigram index, which only looks at
+    a few candidates instead of the whole buffer.
+    """
+    name = "packed"
+    CHUNK = 256
+    # Checking a trigram candidate costs about as much as scanning this many rows of the
+    # buffer, so queries with fewer candidates are left to the trigram index
+    CANDIDATE_COST = 100
+
+    def __init__(self):
+        self._version = None
+        self._buffer = b""
+        self._starts = array('q')
+        self._dir_count = 0
+        self._numpy = _load_numpy()
+        self._bytes = None
+        self._parents = None
+
+    def matches(self, query, path):
+        return query in os.path.basename(path).lower()
+
+    def _prepare(self, indexer):
+        """(Re)builds the buffer when the index changed since the last search."""
+        if self._version == indexer.version:
+            return
+        dirs, files = indexer._dir_table, indexer._file_table
+        # Newlines in names would split a row in two, NUL never occurs in a name
+        names = [(name or "").replace("\n", "\0") for name in dirs.names]
+        names.extend((files.basename(i) or "").replace("\n", "\0") for i in range(len(files)))
+        buffer = "\n".join(names).lower().encode("utf-8", "surrogateescape")
+
+        # Line starts are taken from the encoded buffer, as lower() and UTF-8 change lengths
+        numpy = self._numpy
+        if numpy is not None:
+            self._bytes = numpy.frombuffer(buffer, dtype=numpy.uint8)
+            breaks = numpy.flatnonzero(self._bytes == ord("\n"))
+            starts = numpy.concatenate(([0], breaks + 1)).astype(numpy.int64)
+            # A copy, an array exporting its buffer could not be appended to anymore
+            self._parents = numpy.array(memoryview(dirs.parents), dtype=numpy.int32)
+        else:
+            starts = array('q', [0])
+            pos = buffer.find(b"\n")
+            while pos >= 0:
+                starts.append(pos + 1)
+                pos = buffer.find(b"\n", pos + 1)
+        self._buffer = buffer
+        self._starts = starts
+        self._dir_count = len(dirs)
+        self._version = indexer.version
+
+    def _rows_of(self, hits):
+        """Maps ascending buffer offsets to their distinct rows, in order."""
+        if self._numpy is not None:
+            numpy = self._numpy
+            rows = numpy.searchsorted(self._starts, numpy.array(hits, dtype=numpy.int64), side="right") - 1
+            return _distinct(numpy, rows).tolist()
+        starts = self._starts
+        return sorted({bisect_right(starts, hit) - 1 for hit in hits})
+
+    def _hit_rows(self, needle, start, end):
+        """Yields each row with needle in buffer[start:end], once and in order."""
+        buffer = self._buffer
+        pos = buffer.find(needle, start, end)
+        last = -1
+        while pos >= 0:
+            hits = []
+            while pos >= 0 and len(hits) < self.CHUNK:
+                hits.append(pos)
+                pos = buffer.find(needle, pos + len(needle), end)
+            for row in self._rows_of(hits):
+                if row > last:
+                    last = row
+                    yield row
+
+    def _dir_rows(self, indexer, query, needle, end):
+        """
+        Yields the directory rows whose name contains the query and no ancestor's does,
+        in order. Each one is a distinct result: a directory below a matching ancestor
+        would collapse to that ancestor.
+        """
+        parents = indexer._dir_table.parents
+        if self._numpy is None:
+            matched = set()
+            for row in self._hit_rows(needle, 0, end):
+                parent = parents[row]
+                if parent < 0 and not indexer._dir_matches(row, query):
+                    continue
+                matched.add(row)
+                # Parents come first, so a matching ancestor has been seen already
+                while parent >= 0 and parent not in matched:
+                    parent = parents[parent]
+                if parent < 0:
+                    yield row
+            return
+
+        numpy = self._numpy
+        data = self._bytes[:end]
+        hits = numpy.flatnonzero(data[:max(len(data) - len(needle) + 1, 0)] == needle[0])
+        for k in range(1, len(needle)):
+            hits = hits[data[hits + k] == needle[k]]
+        rows = _distinct(numpy, numpy.searchsorted(self._starts, hits, side="right") - 1)
+        false_roots = [row for row in rows[self._parents[rows] < 0].tolist() if not indexer._dir_matches(row, query)]
+        if false_roots:
+            rows = rows[~numpy.isin(rows, false_roots)]
+
+        matched = numpy.zeros(self._dir_count, dtype=bool)
+        matched[rows] = True
+        # Climb all candidates' ancestor chains together, one level per step
+        covered = numpy.zeros(len(rows), dtype=bool)
+        ancestors = self._parents[rows]
+        while True:
+            alive = ancestors >= 0
+            if not alive.any():
+                break
+            covered[alive] |= matched[ancestors[alive]]
+            ancestors = numpy.where(alive & ~covered, self._parents[numpy.maximum(ancestors, 0)], -1)
+        yield from rows[~covered].tolist()
+
+    def search(self, indexer, query, limit):
+        if "\n" in query or os.sep in query:
+            # Such a query could match across lines of the buffer
+            return indexer._search(query, limit)
+        dir_cost = indexer._dir_grams.cost(query)
+        if dir_cost is not None:
+            rows = len(indexer._dir_table) + len(indexer._file_table)
+            if (dir_cost + indexer._file_grams.cost(query)) * self.CANDIDATE_COST < rows:
+                return indexer._search(query, limit)
+        self._prepare(indexer)
+        dirs, files = indexer._dir_table, indexer._file_table
+        dir_count = self._dir_count
+        needle = query.encode("utf-8", "surrogateescape")
+        files_start = int(self._starts[dir_count]) if dir_count < len(self._starts) else len(self._buffer)
+
+        results = []
+        seen = set()
+        for row in self._dir_rows(indexer, query, needle, files_start):
+            if dirs.parents[row] < 0:
+                path = _collapse(dirs.path(row, dirs), query)
+            else:
+                path = dirs.path(row, dirs)
+            if path not in seen:
+                seen.add(path)
+                results.append(path)
+                if len(results) >= limit:
+                    return results
+
+        for row in self._hit_rows(needle, files_start, len(self._buffer)):
+            path = files.path(row - dir_count, dirs)
+            if path not in seen:
+                seen.add(path)
+                results.append(path)
+                if len(results) >= limit:
+                    break
+        return results
+
+
+class SQLiteMatcher(Matcher):
+    """
+    Substring matching answered by the database's FTS5 trigram tables, for low-memory mode.
+    Like SubstringMatcher, directories come first and collapse to their top-most matching
+    component, and files match by name. Rows are read lazily, so a search stops reading
+    once it has enough results.
+    """
+    name = "sqlite"
+
+    def search(self, indexer, query, limit):
+        results = []
+        seen = set()
+        # The name index only holds an include root's last component, the folders above it match too
+        for root in indexer.include_dirs:
+            current = _collapse(root, query)
+            if current != root and current not in seen and next(database.db.iter_paths('dir', root), None) == root:
+                seen.add(current)
+                results.append(current)
+                if len(results) >= limit:
+                    return results
+
+        for path in database.db.iter_name_matches(query, 'dir'):
+            # The directory's own name matched, but an ancestor may match first
+            current = _collapse(path, query)
+            if current not in seen:
+                seen.add(current)
+                results.append(current)
+                if len(results) >= limit:
+                    return results
+
+        for path in database.db.iter_name_matches(query, 'file'):
+            if path not in seen:
+                seen.add(path)
+                results.append(path)
+                if len(results) >= limit:
+                    break
+        return results
+
+    def matches(self, query, path):
+        return query in os.path.basename(path).lower()
+
+
+# Low-memory mode picks SQLiteMatcher itself, these are the choices for the in-memory index
+MATCHERS = {matcher.name: matcher for matcher in (SubstringMatcher, FuzzyMatcher, PackedMatcher)}
+
+
+def get_matcher(name):
+    """Returns a new matcher instance by name, falling back to the substring default."""
+    return MATCHERS.get(name, SubstringMatcher)()
@@ -0,0 +1,235 @@
+import os
+import sys
+import struct
+from array import array
+
+
+class PathTable:
+    """
+    Parent-pointer table of index entries. Row i holds parents[i], the id of the
+    directory containing the entry, and names[i], its name. Rows without an indexed
+    parent (the include roots) have parent -1 and keep their full path as name.
+    Removed rows keep their id with the name set to None.
+    Directory rows always come after their parent, so a single forward pass sees
+    every parent before its children.
+    Rows are found by (parent, name) through a map of each directory's children, which
+    takes about a third of the table's memory. It is only built once the lookups made
+    without it (scans of the parent ids, or rows named by a trigram) have looked at
+    about as many rows as building it would, so a table that is rarely changed never
+    holds one.
+    """
+    LOOKUP_ROWS = 1 << 16
+
+    def __init__(self, parents=None, names=None):
+        self._children = None
+        self._spent = 0
+        self.parents = array('i') if parents is None else parents
+        self.names = [] if names is None else names
+
+    def __len__(self):
+        return len(self.names)
+
+    def _child_map(self):
+        """parent id -> {name: id} of the live rows directly in that directory."""
+        if self._children is None:
+            children = {}
+            for i, (parent, name) in enumerate(zip(self.parents, self.names)):
+                if name is not None:
+                    children.setdefault(parent, {}).setdefault(name, i)
+            self._children = children
+        return self._children
+
+    def has_child_map(self):
+        return self._children is not None
+
+    def spend(self, rows):
+        """
+        Counts rows looked at by a lookup without the child map. Returns False, and the
+        lookup should use the map, once it is built or they add up to building it.
+        """
+        if self._children is not None:
+            return False
+        self._spent += rows
+        return self._spent <= max(len(self), self.LOOKUP_ROWS)
+
+    def _scan(self, parent):
+        """The ids of the rows whose parent id is parent, or None once the child map should be used."""
+        # A scan runs in C over the packed ids, much faster per row than building the map
+        if not self.spend(len(self) // 64 + 1):
+            return None
+        with memoryview(self.parents) as view:
+            data = bytes(view.cast('B'))
+        needle = struct.pack('i', parent)
+        ids = []
+        pos = data.find(needle)
+        while pos >= 0:
+            if pos % len(needle) == 0:
+                ids.append(pos // len(needle))
+            pos = data.find(needle, pos + 1)
+        return ids
+
+    def find(self, parent, name):
+        """Returns the id of the row called name in directory parent (-1 for rows without one), or None."""
+        ids = self._scan(parent)
+        if ids is not None:
+            return next((i for i in ids if self.names[i] == name), None)
+        children = self._child_map().get(parent)
+        return None if children is None else children.get(name)
+
+    def children(self, parent):
+        """Returns the ids of the live rows directly in directory parent."""
+        ids = self._scan(parent)
+        if ids is not None:
+            return [i for i in ids if self.names[i] is not None]
+        children = self._child_map().get(parent)
+        return [] if children is None else list(children.values())
+
+    def remove(self, i):
+        """Blanks out row i in place, so the ids of other rows stay valid."""
+        name = self.names[i]
+        if name is None:
+            return
+        if self._children is not None:
+            children = self._children.get(self.parents[i])
+            if children is not None and children.get(name) == i:
+                del children[name]
+        self.names[i] = None
+
+    def writable(self):
+        """Makes rows mapped from a snapshot changeable. The parent ids are copied, the names are not."""
+        if not isinstance(self.parents, array):
+            parents = array('i')
+            with memoryview(self.parents) as view:
+                parents.frombytes(view.cast('B'))
+            self.parents = parents
+        if not isinstance(self.names, (list, ChangedNames)):
+            self.names = ChangedNames(self.names)
+
+    def append(self, parent, name):
+        # Names repeat a lot (src, __init__.py, ...), so share one string per name
+        name = sys.intern(name)
+        self.parents.append(parent)
+        self.names.append(name)
+        i = len(self.names) - 1
+        if self._children is not None:
+            self._children.setdefault(parent, {}).setdefault(name, i)
+        return i
+
+    def basename(self, i):
+        name = self.names[i]
+        if name is None or self.parents[i] >= 0:
+            return name
+        return os.path.basename(name)
+
+    def path(self, i, dirs):
+        """Builds the full path of row i by walking up the directory table."""
+        name = self.names[i]
+        if name is None:
+            return None
+        parts = [name]
+        parent = self.parents[i]
+        while parent >= 0:
+            parts.append(dirs.names[parent])
+            parent = dirs.parents[parent]
+        parts.reverse()
+        return os.path.join(*parts)
+
+
+class ChangedNames:
+    """
+    The names of a table mapped from a snapshot after a change. The mapped names are
+    read as they are, removed ids and appended names are kept next to them.
+    """
+
+    def __init__(self, mapped):
+        self.mapped = mapped
+        self.count = len(mapped)
+        self.removed = set()
+        self.added = []
+
+    def __len__(self):
+        return self.count + len(self.added)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if i >= self.count:
+            return self.added[i - self.count]
+        return None if i in self.removed else self.mapped[i]
+
+    def __setitem__(self, i, name):
+        # Mapped rows only change by being removed
+        if i >= self.count:
+            self.added[i - self.count] = name
+        elif name is None:
+            self.removed.add(i)
+        else:
+            raise ValueError("mapped names can only be removed")
+
+    def __iter__(self):
+        removed = self.removed
+        for i, name in enumerate(self.mapped):
+            yield None if i in removed else name
+        yield from self.added
+
+    def append(self, name):
+        self.added.append(name)
+
+
+class PathList:
+    """Read-only sequence of the full paths in a PathTable, built on access."""
+
+    def __init__(self, table, dirs):
+        self.table = table
+        self.dirs = dirs
+
+    def __len__(self):
+        return len(self.table)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.table)
+        if not 0 <= i < len(self.table):
+            raise IndexError(i)
+        return self.table.path(i, self.dirs)
+
+    def __iter__(self):
+        # Walk forward reusing each parent's path, instead of climbing per row
+        dirs = self.dirs
+        listing_dirs = self.table is dirs
+        dir_paths = []
+        for parent, name in zip(dirs.parents, dirs.names):
+            if parent >= 0 and name is not None:
+                name = os.path.join(dir_paths[parent], name)
+            dir_paths.append(name)
+            if listing_dirs:
+                yield name
+        if listing_dirs:
+            return
+        for parent, name in zip(self.table.parents, self.table.names):
+            if parent >= 0 and name is not None:
+                name = os.path.join(dir_paths[parent], name)
+            yield name
+
+
+def build_tables(dir_paths, file_paths):
+    """Builds (dir_table, file_table) from full path lists that list parents before children."""
+    dirs = PathTable()
+    ids = {}
+
+    def split(path):
+        head, name = os.path.split(path)
+        parent = ids.get(head, -1)
+        # Only point at the parent if the path rebuilds exactly (e.g. not for 'a//b')
+        if parent < 0 or os.path.join(head, name) != path:
+            return -1, path
+        return parent, name
+
+    for path in dir_paths:
+        i = dirs.append(*split(path))
+        ids.setdefault(path, i)
+
+    files = PathTable()
+    for path in file_paths:
+        files.append(*split(path))
+    return dirs, files
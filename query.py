@@ -0,0 +1,564 @@
+import os
+import re
+from bisect import bisect_left, bisect_right
+from itertools import islice, chain
+import database
+
+# Query syntax, terms are separated by spaces and must all match (AND):
+#   report          name contains "report". Next to other name terms or an ext: filter,
+#                   a term may also match an ancestor folder's name: "proj rs" finds
+#                   proj/src/main.rs. One of them must still match the entry's own name.
+#   "my notes"      name contains the quoted text, spaces included
+#   proj/           below a directory whose path contains "proj" (/home/me/ for an exact one)
+#   src/main        full path contains "src/main"
+#   ext:py,rs       file name ends in .py or .rs
+#   type:dir        only directories (type:file for files)
+#   -draft, !draft  negates any term, e.g. -ext:log or -build/
+TOKEN = re.compile(r'[-!]?"[^"]*"?|\S+')
+TYPES = {"dir": "dir", "d": "dir", "folder": "dir", "file": "file", "f": "file"}
+
+
+class Condition:
+    """One term of a query. kind is 'name', 'path', 'ext', 'scope' or 'type'."""
+    __slots__ = ("kind", "value", "negate")
+
+    def __init__(self, kind, value, negate=False):
+        self.kind = kind
+        self.value = value
+        self.negate = negate
+
+    def __repr__(self):
+        return f"Condition({self.kind!r}, {self.value!r}, negate={self.negate})"
+
+
+def parse_query(text):
+    """Splits a lowercased query into Conditions. Unfinished filters like 'ext:' are skipped."""
+    conditions = []
+    for token in TOKEN.findall(text):
+        negate = token[0] in "-!" and len(token) > 1
+        if negate:
+            token = token[1:]
+        if token.startswith('"'):
+            value = token.strip('"')
+            if value:
+                conditions.append(Condition("name", value, negate))
+        elif token.startswith("ext:"):
+            exts = tuple("." + ext.lstrip(".") for ext in token[4:].split(",") if ext.lstrip("."))
+            if exts:
+                conditions.append(Condition("ext", exts, negate))
+        elif token.startswith("type:") and token[5:] in TYPES:
+            conditions.append(Condition("type", TYPES[token[5:]], negate))
+        elif token.startswith("type:") and not token[5:]:
+            continue
+        elif token.endswith(os.sep) and len(token) > 1:
+            conditions.append(Condition("scope", token.rstrip(os.sep) or os.sep, negate))
+        elif token == os.sep:
+            conditions.append(Condition("scope", os.sep, negate))
+        elif os.sep in token:
+            conditions.append(Condition("path", token, negate))
+        else:
+            conditions.append(Condition("name", token, negate))
+    return Query(conditions)
+
+
+class Query:
+    """
+    A parsed query. A single plain term is left to the configured matcher, anything
+    else is planned here: candidates come from the rarest positive term (its trigram
+    postings, plus the subtrees of the directories it matches if it may match an
+    ancestor), and each candidate is checked against the conditions, cheapest and most
+    selective first.
+    """
+
+    def __init__(self, conditions):
+        self.conditions = conditions
+        types = {c.value for c in conditions if c.kind == "type" and not c.negate}
+        types |= {("file" if c.value == "dir" else "dir") for c in conditions if c.kind == "type" and c.negate}
+        # Extensions only apply to files
+        if any(c.kind == "ext" and not c.negate for c in conditions):
+            types.add("file")
+        self.want_dirs = "file" not in types
+        self.want_files = "dir" not in types
+        names = [c for c in conditions if c.kind == "name" and not c.negate]
+        has_ext = any(c.kind == "ext" and not c.negate for c in conditions)
+        # Whether positive name terms may match an ancestor directory's name instead, and
+        # whether one of them then has to match the entry's own name (ext: always does)
+        self.ancestor_names = len(names) > 1 or (len(names) == 1 and has_ext)
+        self.needs_own_name = self.ancestor_names and not has_ext
+
+    @property
+    def is_simple(self):
+        """Whether this is one plain name term, searched by the matcher like before."""
+        return (len(self.conditions) == 1 and self.conditions[0].kind == "name"
+                and not self.conditions[0].negate)
+
+    @property
+    def text(self):
+        return self.conditions[0].value
+
+    def _name_ok(self, condition, name):
+        if condition.kind == "name":
+            return condition.value in name
+        return name.endswith(condition.value)
+
+    def matches(self, path, is_dir=None):
+        """Checks a single path, e.g. a frecent one. is_dir is looked up on disk if needed."""
+        name = os.path.basename(path).lower()
+        parent = os.path.dirname(path).lower()
+        own = not self.needs_own_name
+        for c in self.conditions:
+            if c.kind in ("name", "ext"):
+                ok = self._name_ok(c, name)
+                if ok and not c.negate:
+                    own = True
+                elif not ok and c.kind == "name" and self.ancestor_names and not c.negate:
+                    ok = any(c.value in part for part in parent.split(os.sep))
+            elif c.kind == "path":
+                ok = c.value in path.lower()
+            elif c.kind == "scope":
+                ok = _scope_matches_path(c.value, parent)
+            else:
+                if is_dir is None:
+                    is_dir = os.path.isdir(path)
+                ok = is_dir == (c.value == "dir")
+            if ok == c.negate:
+                return False
+        if not own:
+            return False
+        if self.want_dirs and self.want_files:
+            return True
+        if is_dir is None:
+            is_dir = os.path.isdir(path)
+        return self.want_dirs if is_dir else self.want_files
+
+    def search_database(self, limit, roots=()):
+        """
+        Low-memory mode: reads candidates for the longest term from SQLite and checks each path.
+        A name term that may match an ancestor, a path term's longest part and a scope also
+        read the subtrees of the directories they match, found through the name index.
+        Name terms of which one has to match the entry's own name read the candidates of
+        every one of them. Scopes are only read if there is no other positive term, and
+        only queries without any read through the whole index.
+        roots are the include roots, whose parent directories are not indexed.
+        """
+        positive = [c for c in self.conditions if not c.negate]
+        # (length of the shortest text, [(source, text), ...]) per term
+        terms = []
+        for c in positive:
+            if c.kind == "name":
+                terms.append((len(c.value), [("tree" if self.ancestor_names else "own", c.value)]))
+            elif c.kind == "ext":
+                terms.append((min(map(len, c.value)), [("own", ext) for ext in c.value]))
+            elif c.kind == "path":
+                part = max(c.value.split(os.sep), key=len)
+                terms.append((len(part), [("tree", part)]))
+            elif c.kind == "scope":
+                terms.append((len(c.value.rsplit(os.sep, 1)[-1]), [("scope", c.value)]))
+        if self.needs_own_name:
+            names = [c.value for c in positive if c.kind == "name"]
+            terms.append((min(map(len, names)), [("own", name) for name in names]))
+        # A scope's subtree is read whole if nothing in it matches, so any other term goes first
+        sources = max(terms, key=lambda term: (term[1][0][0] != "scope", term[0]))[1] if terms else None
+
+        results = []
+        kinds = [(kind, is_dir) for kind, is_dir, wanted in (("dir", True, self.want_dirs), ("file", False, self.want_files))
+                 if wanted]
+        seen = set()
+        for kind, is_dir in kinds:
+            if sources is None:
+                paths = database.db.iter_paths(kind)
+            else:
+                paths = chain.from_iterable(self._database_source(source, text, kind, roots) for source, text in sources)
+            for path in paths:
+                if path not in seen and self.matches(path, is_dir):
+                    seen.add(path)
+                    results.append(path)
+                    if len(results) >= limit:
+                        return results
+        return results
+
+    def _database_source(self, source, text, kind, roots):
+        if source == "own":
+            return database.db.iter_name_matches(text, kind)
+        below = self._database_subtree(text, kind, roots)
+        if source == "tree":
+            return chain(database.db.iter_name_matches(text, kind), below)
+        return below
+
+    def _database_subtree(self, scope, kind, roots):
+        """
+        Yields the paths of kind at or below the directories matching scope, and at or below
+        the include roots whose containing directory matches it. A text without a separator is a
+        scope matching the directories whose name contains it.
+        """
+        def tops():
+            for root in roots:
+                if _scope_matches_path(scope, os.path.dirname(root).lower()):
+                    yield root
+            # The shallowest directories matching scope contain its last component in their name
+            for path in database.db.iter_name_matches(scope.rsplit(os.sep, 1)[-1], "dir"):
+                if _scope_matches_path(scope, path.lower()):
+                    yield path
+
+        taken = set()
+        for top in tops():
+            path = top
+            while path not in taken and os.path.dirname(path) != path:
+                path = os.path.dirname(path)
+            if path in taken:
+                continue
+            taken.add(top)
+            yield from database.db.iter_paths(kind, top)
+
+
+def _union(grams, texts):
+    """Sorted ids of the entries whose names contain any of texts, which are all long enough."""
+    if len(texts) == 1:
+        return grams.candidates(texts[0])
+    return sorted(set().union(*(grams.candidates(text) for text in texts)))
+
+
+def _scope_matches_path(scope, parent):
+    """Whether a lowercased parent directory path lies at or below a directory matching scope."""
+    if scope.startswith(os.sep):
+        # An exact directory and everything below it
+        return (parent + os.sep).startswith(scope.rstrip(os.sep) + os.sep)
+    return scope in parent
+
+
+class ChildIndex:
+    """
+    The children of every directory, as ids sorted by parent id next to their parents.
+    Lets a scope enumerate just its subtree instead of the whole index. Rows appended
+    to the table later are kept apart by parent until there are enough to re-sort.
+    """
+
+    def __init__(self, table):
+        parents = table.parents
+        self.table = table
+        self.ids = sorted(range(len(table)), key=parents.__getitem__)
+        self.keys = [parents[i] for i in self.ids]
+        self.added = {}
+        self.count = len(table)
+
+    def extend(self, table):
+        """Takes in the rows appended to table since, or returns False if it is another table."""
+        if table is not self.table or len(table) < self.count:
+            return False
+        if (len(table) - len(self.ids)) * 8 > len(self.ids):
+            self.__init__(table)
+            return True
+        parents = table.parents
+        for i in range(self.count, len(table)):
+            self.added.setdefault(parents[i], []).append(i)
+        self.count = len(table)
+        return True
+
+    def children(self, d):
+        found = self.ids[bisect_left(self.keys, d):bisect_right(self.keys, d)]
+        return found + self.added[d] if d in self.added else found
+
+
+class QueryEngine:
+    """Runs non-simple queries against an Indexer's in-memory tables. Called with the indexer lock held."""
+
+    def __init__(self):
+        self._version = None
+        self._children = None
+
+    def _child_indexes(self, indexer):
+        """(dir children, file children), brought up to date when the index changed."""
+        if self._version != indexer.version:
+            tables = (indexer._dir_table, indexer._file_table)
+            if self._children is None or not all(c.extend(t) for c, t in zip(self._children, tables)):
+                self._children = tuple(ChildIndex(table) for table in tables)
+            self._version = indexer.version
+        return self._children
+
+    def search(self, indexer, query, limit):
+        dirs, files = indexer._dir_table, indexer._file_table
+        positive = [c for c in query.conditions if not c.negate]
+
+        # Every positive term bounds the candidates, and they come from the rarest one: own
+        # names through their postings, ancestor names, paths and scopes through subtrees
+        plans = []
+        for c in positive:
+            if c.kind == "name":
+                plans.append((self._cost(indexer, query, c.value), "tree" if query.ancestor_names else "own", [c.value]))
+            elif c.kind == "ext":
+                plans.append((sum(self._cost(indexer, query, ext) for ext in c.value), "own", list(c.value)))
+            elif c.kind == "path":
+                # Each part lies within one component, the entry's name or an ancestor's
+                parts = [part for part in c.value.split(os.sep) if len(part) >= 3]
+                cost = min((self._cost(indexer, query, part) for part in parts), default=len(dirs))
+                plans.append((cost, "path", [c.value]))
+            elif c.kind == "scope":
+                plans.append((self._cost(indexer, query, c.value.rsplit(os.sep, 1)[-1]), "scope", [c.value]))
+        if query.needs_own_name:
+            names = [c.value for c in positive if c.kind == "name"]
+            plans.append((sum(self._cost(indexer, query, name) for name in names), "own", names))
+        # Names too short for a trigram are checked lazily up to the limit instead
+        plans = [plan for plan in plans if plan[1] not in ("own", "tree") or all(len(text) >= 3 for text in plan[2])]
+        plans.sort(key=lambda plan: plan[0])
+
+        # Own-name postings never hold more entries than estimated, which caps the
+        # subtrees tried before them
+        budget = min((cost for cost, kind, _ in plans if kind == "own"), default=None)
+        best = None
+        for cost, kind, texts in plans:
+            if best is not None:
+                # Estimates only approximate a subtree's size, so a plan that looks no
+                # cheaper than what was found is not materialized
+                budget = len(best[0]) + len(best[1])
+                if cost >= budget:
+                    break
+            found = self._plan_entries(indexer, query, kind, texts, budget)
+            if found is not None:
+                best = found
+        if best is not None:
+            dir_ids, file_ids = best
+        else:
+            dir_ids = range(len(dirs)) if query.want_dirs else []
+            file_ids = range(len(files)) if query.want_files else []
+        checks = list(query.conditions)
+
+        # Name checks are cheap and fail fast when selective, scopes climb the tree
+        def order(c):
+            if c.kind in ("path", "scope"):
+                return (2, 0)
+            if c.kind == "type":
+                return (3, 0)
+            cost = indexer._file_grams.cost(c.value if c.kind == "name" else c.value[0])
+            return (1 if c.negate else 0, cost if cost is not None else len(files))
+        checks.sort(key=order)
+
+        results = []
+        under = {}
+        dir_paths = {}
+        for table, ids, is_dir in ((dirs, dir_ids, True), (files, file_ids, False)):
+            for i in ids:
+                name = table.basename(i)
+                if name is None:
+                    continue
+                if self._check(indexer, query, checks, table, i, name.lower(), is_dir, under, dir_paths):
+                    results.append(table.path(i, dirs))
+                    if len(results) >= limit:
+                        return results
+        return results
+
+    def _cost(self, indexer, query, text):
+        """Estimated number of wanted entries whose indexed name contains text, every entry if it is too short."""
+        dir_cost = indexer._dir_grams.cost(text) if query.want_dirs else 0
+        file_cost = indexer._file_grams.cost(text) if query.want_files else 0
+        if dir_cost is None or file_cost is None:
+            return len(indexer._dir_table) + len(indexer._file_table)
+        return dir_cost + file_cost
+
+    def _plan_entries(self, indexer, query, kind, texts, budget):
+        """
+        Returns the sorted (dir ids, file ids) a plan yields for the wanted types, or None
+        if that is more than budget entries. 'own' plans yield the entries whose name
+        contains any of texts, 'tree' plans add what lies below the directories whose
+        name contains texts[0], 'path' plans yield the entries whose path contains
+        texts[0] and 'scope' plans the subtree below texts[0].
+        """
+        if kind == "scope":
+            found = self._subtree(indexer, texts[0], budget)
+        elif kind == "path":
+            found = self._path_entries(indexer, texts[0], budget)
+        else:
+            found = (self._own_ids(indexer._dir_grams, texts, budget) if query.want_dirs else [],
+                     self._own_ids(indexer._file_grams, texts, budget) if query.want_files else [])
+            if None in found:
+                return None
+            if kind == "tree":
+                left = None if budget is None else budget - len(found[0]) - len(found[1])
+                below = None if left is not None and left < 0 else self._subtree(indexer, texts[0], left)
+                if below is None:
+                    return None
+                found = (sorted(set(found[0]).union(below[0])), sorted(set(found[1]).union(below[1])))
+        if found is None:
+            return None
+        dir_ids = found[0] if query.want_dirs else []
+        file_ids = found[1] if query.want_files else []
+        if budget is not None and len(dir_ids) + len(file_ids) > budget:
+            return None
+        return dir_ids, file_ids
+
+    def _own_ids(self, grams, texts, budget):
+        """Sorted ids of the rows whose indexed name contains any of texts, or None if that is more than budget."""
+        ids = _union(grams, texts)
+        return None if budget is not None and len(ids) > budget else ids
+
+    def _check(self, indexer, query, checks, table, i, name, is_dir, under, dir_paths):
+        own = not query.needs_own_name
+        for c in checks:
+            if c.kind in ("name", "ext"):
+                ok = c.value in name if c.kind == "name" else name.endswith(c.value)
+                if ok and not c.negate:
+                    own = True
+                elif not ok and c.kind == "name" and query.ancestor_names and not c.negate:
+                    # An ancestor's name matches the same way a scope without a separator does
+                    ok = self._below_scope(indexer, c.value, table, i, under)
+            elif c.kind == "path":
+                ok = c.value in self._lower_path(indexer, table, i, dir_paths)
+            elif c.kind == "scope":
+                ok = self._below_scope(indexer, c.value, table, i, under)
+            else:
+                ok = is_dir == (c.value == "dir")
+            if ok == c.negate:
+                return False
+        return own
+
+    def _lower_path(self, indexer, table, i, dir_paths):
+        """The lowercased full path of live row i. dir_paths memoizes directory paths by id."""
+        dirs = indexer._dir_table
+        parent = table.parents[i]
+        name = table.names[i].lower()
+        if parent < 0:
+            return name
+        chain = []
+        d = parent
+        while d >= 0 and d not in dir_paths:
+            chain.append(d)
+            d = dirs.parents[d]
+        for d in reversed(chain):
+            up = dirs.parents[d]
+            dir_name = dirs.names[d].lower()
+            dir_paths[d] = dir_name if up < 0 else os.path.join(dir_paths[up], dir_name)
+        return os.path.join(dir_paths[parent], name)
+
+    def _dir_matches_scope(self, indexer, scope, d):
+        dirs = indexer._dir_table
+        if scope.startswith(os.sep) or os.sep in scope:
+            path = dirs.path(d, dirs)
+            return path is not None and _scope_matches_path(scope, path.lower())
+        name = dirs.names[d]
+        return name is not None and scope in name.lower()
+
+    def _below_scope(self, indexer, scope, table, i, under):
+        """Whether entry i lies strictly below a directory matching scope. under memoizes per directory."""
+        parents = indexer._dir_table.parents
+        parent = table.parents[i]
+        if parent < 0:
+            path = table.path(i, indexer._dir_table)
+            return path is not None and _scope_matches_path(scope, os.path.dirname(path).lower())
+        chain = []
+        result = False
+        d = parent
+        while d >= 0:
+            known = under.get((scope, d))
+            if known is not None:
+                result = known
+                break
+            chain.append(d)
+            if self._dir_matches_scope(indexer, scope, d):
+                result = True
+                break
+            d = parents[d]
+        for d in chain:
+            under[(scope, d)] = result
+        return result
+
+    def _path_entries(self, indexer, value, budget):
+        """
+        Returns sorted (dir ids, file ids) whose full path contains value, or None if that is
+        more than budget entries. Below an indexed parent, a match either lies within the
+        parent's path, or ends in the entry's name: the name starts with the text after
+        value's last separator and the parent's path ends with the text up to it. Such
+        matches are looked up through the parents, and everything below a matching
+        directory matches too.
+        """
+        dirs, files = indexer._dir_table, indexer._file_table
+        dir_children, file_children = self._child_indexes(indexer)
+        head, last = value.rsplit(os.sep, 1)
+        head += os.sep
+        dir_paths = {}
+        found = ([], [])
+
+        def parent_ends_with_head(d):
+            path = self._lower_path(indexer, dirs, d, dir_paths)
+            return (path if path.endswith(os.sep) else path + os.sep).endswith(head)
+
+        for table, children, ids in ((dirs, dir_children, found[0]), (files, file_children, found[1])):
+            ids.extend(i for i in children.children(-1) if table.names[i] is not None and value in table.names[i].lower())
+
+        parent_name = head[:-1].rsplit(os.sep, 1)[-1]
+        if parent_name:
+            # Parents are directories whose name ends in the part before the last separator
+            parents = indexer._dir_grams.candidates(parent_name)
+            if parents is None:
+                parents = range(len(dirs))
+            parents = [d for d in parents if dirs.names[d] is not None and dirs.names[d].lower().endswith(parent_name)
+                       and parent_ends_with_head(d)]
+            for table, children, ids in ((dirs, dir_children, found[0]), (files, file_children, found[1])):
+                for d in parents:
+                    ids.extend(i for i in children.children(d)
+                               if table.names[i] is not None and table.names[i].lower().startswith(last))
+        else:
+            # Nothing to find parents by ('/src', 'a//b'), entries are found by their name
+            for table, grams, ids in ((dirs, indexer._dir_grams, found[0]), (files, indexer._file_grams, found[1])):
+                candidates = grams.candidates(last)
+                if candidates is None:
+                    candidates = range(len(table))
+                ids.extend(i for i in candidates if table.parents[i] >= 0 and table.names[i] is not None
+                           and table.names[i].lower().startswith(last) and parent_ends_with_head(table.parents[i]))
+
+        # Everything below a matching directory contains the match in its parent's path
+        dir_ids, file_ids = set(found[0]), set(found[1])
+        stack = list(dir_ids)
+        while stack:
+            d = stack.pop()
+            file_ids.update(file_children.children(d))
+            for child in dir_children.children(d):
+                if child not in dir_ids:
+                    dir_ids.add(child)
+                    stack.append(child)
+            if budget is not None and len(dir_ids) + len(file_ids) > budget:
+                return None
+        return sorted(dir_ids), sorted(file_ids)
+
+    def _subtree(self, indexer, scope, budget):
+        """
+        Returns sorted (dir ids, file ids) strictly below the directories matching scope,
+        or None if that is more than budget entries, i.e. not the most selective source.
+        Rows without an indexed parent (the include roots) count as below scope if the
+        directory containing them matches it, like Query.matches has it.
+        """
+        dirs = indexer._dir_table
+        roots = indexer._dir_grams.candidates(scope.rsplit(os.sep, 1)[-1])
+        if roots is None:
+            roots = range(len(dirs))
+            if budget is not None and len(dirs) > budget:
+                return None
+        roots = [d for d in roots if dirs.names[d] is not None and self._dir_matches_scope(indexer, scope, d)]
+
+        dir_children, file_children = self._child_indexes(indexer)
+        seen = set(roots)
+
+        def walk():
+            stack = list(roots)
+            for table, children, is_dir in ((dirs, dir_children, True), (indexer._file_table, file_children, False)):
+                for i in children.children(-1):
+                    path = table.names[i]
+                    if path is not None and _scope_matches_path(scope, os.path.dirname(path).lower()):
+                        yield is_dir, i
+                        if is_dir and i not in seen:
+                            seen.add(i)
+                            stack.append(i)
+            while stack:
+                d = stack.pop()
+                for f in file_children.children(d):
+                    yield False, f
+                for child in dir_children.children(d):
+                    yield True, child
+                    if child not in seen:
+                        seen.add(child)
+                        stack.append(child)
+
+        entries = list(walk() if budget is None else islice(walk(), budget + 1))
+        if budget is not None and len(entries) > budget:
+            return None
+        dir_ids = sorted({i for is_dir, i in entries if is_dir})
+        file_ids = sorted({i for is_dir, i in entries if not is_dir})
+        return dir_ids, file_ids
@@ -0,0 +1,227 @@
+import os
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+# Number of new paths per batch handed out by ParallelScanner.iter_batches
+BATCH_SIZE = 5000
+
+
+def list_directory(path, known=None):
+    """
+    Lists one directory with os.scandir, skipping hidden entries.
+    Returns ([(name, (device, inode)), ...] for subdirectories, [name, ...] for files,
+    (mtime_ns, inode, device) or None, whether it was listed).
+    The state is None if the directory could not be read, or if it holds symlinks: their
+    targets can appear, vanish or change without touching this directory's mtime.
+    If known holds a previous (state, dirs, files) and the directory's mtime and inode
+    are unchanged, the previous listing is returned without reading the directory.
+    A subdirectory's (device, inode) identifies it for loop detection. It comes from a
+    stat of the directory itself, or of a symlink's target.
+    Runs inside a pool worker, so it must stay a picklable module-level function.
+    """
+    try:
+        # Stat before listing: a change that races the listing bumps the mtime again
+        st = os.stat(path)
+    except OSError:
+        return [], [], None, False
+    state = (st.st_mtime_ns, st.st_ino, st.st_dev)
+    if known is not None and known[0] == state:
+        return known[1], known[2], state, False
+
+    dirs = []
+    files = []
+    has_links = False
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                name = entry.name
+                if name.startswith('.'):
+                    continue
+                has_links = has_links or entry.is_symlink()
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    try:
+                        # A symlink's target was already stat'ed by is_dir and is cached.
+                        # Plain directories take an lstat: d_ino from the listing is not
+                        # a stable inode on FUSE (without use_ino) or overlayfs, and
+                        # at mount points it is the covered directory's.
+                        target = entry.stat(follow_symlinks=entry.is_symlink())
+                    except OSError:
+                        continue
+                    dirs.append((name, (target.st_dev, target.st_ino)))
+                else:
+                    files.append(name)
+    except OSError:
+        # Unreadable or vanished directories are skipped, like os.walk does. Without a
+        # state they are listed again next time, e.g. once a chmod made them readable.
+        return dirs, files, None, True
+    return dirs, files, None if has_links else state, True
+
+
+class ParallelScanner:
+    """
+    Walks directory trees with a pool of threads or processes.
+    Every directory listing is an independent task, so idle workers immediately pick
+    up whichever directory is pending next instead of waiting on a slow subtree.
+    Pruning and loop detection happen in the calling thread, and the results are
+    assembled in the same top-down order os.walk would produce.
+    """
+
+    def __init__(self, is_excluded, workers=8, use_processes=False):
+        self.is_excluded = is_excluded
+        self.workers = max(1, workers)
+        self.use_processes = use_processes
+        # Per include root of the last walk: entries found, and seconds until its walk completed
+        self.root_entries = {}
+        self.root_seconds = {}
+
+    def scan(self, roots, known=None):
+        """
+        Returns (dir_list, file_list, dir_states, listed_count) for the given root directories.
+        known maps directory paths to the (state, dirs, files) of a previous scan, letting
+        unchanged directories skip the listing. dir_states holds a
+        (path, mtime_ns, inode, device) row for every directory that was visited.
+        """
+        batches = self.iter_batches(roots, known)
+        while True:
+            try:
+                next(batches)
+            except StopIteration as done:
+                return done.value
+
+    def iter_batches(self, roots, known=None, batch_size=None):
+        """
+        Generator form of scan. While the walk runs it yields (root, dirs, files) batches of
+        about batch_size new full paths as listings complete. root is the include root
+        the latest listing belongs to. Every directory is yielded before anything below it.
+        When exhausted it returns what scan returns, with the lists in top-down order.
+        """
+        known = known or {}
+        batch_size = batch_size or BATCH_SIZE
+        paths = []      # node id -> directory path
+        owners = []     # node id -> include root it was reached from
+        listings = {}   # node id -> (child node ids, file paths)
+        top = []        # (node id, include root in results)
+        dir_states = []
+        listed_count = 0
+        seen = set()    # (device, inode) of every directory taken so far
+        batch_dirs = []
+        batch_files = []
+        # Listings still pending per include root, to time each root's walk
+        remaining = {}
+        start_time = time.perf_counter()
+        self.root_entries = {}
+        self.root_seconds = {}
+
+        executor_class = ProcessPoolExecutor if self.use_processes else ThreadPoolExecutor
+        with executor_class(max_workers=self.workers) as pool:
+            pending = {}
+
+            def submit(path, owner):
+                node = len(paths)
+                paths.append(path)
+                owners.append(owner)
+                pending[pool.submit(list_directory, path, known.get(path))] = node
+                remaining[owner] = remaining.get(owner, 0) + 1
+                return node
+
+            for root_dir in dict.fromkeys(roots):
+                try:
+                    st = os.stat(root_dir)
+                except OSError:
+                    continue
+                key = (st.st_dev, st.st_ino)
+                keep = key not in seen and not self.is_excluded(root_dir)
+                if keep:
+                    seen.add(key)
+                    batch_dirs.append(root_dir)
+                self.root_entries[root_dir] = int(keep)
+                top.append((submit(root_dir, root_dir), keep))
+
+            # Listings complete in any order but are taken in submission order, so which
+            # of two paths to the same directory is kept does not depend on worker timing
+            ready = {}
+            next_node = 0
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node = pending.pop(future)
+                    try:
+                        ready[node] = future.result()
+                    except Exception as e:
+                        logging.error(f"Error scanning {paths[node]}: {e}")
+                        ready[node] = [], [], None, False
+
+                while next_node in ready:
+                    node = next_node
+                    next_node += 1
+                    root = paths[node]
+                    dirs, files, state, listed = ready.pop(node)
+                    listed_count += listed
+
+                    # Prune excluded directories and directories already seen through
+                    # another link, so loops are never entered
+                    children = []
+                    for d, key in dirs:
+                        if key in seen:
+                            # Where that other link goes can change without this directory
+                            # changing, so it is listed again next time instead of cached
+                            state = None
+                            continue
+                        full_path = os.path.join(root, d)
+                        if self.is_excluded(full_path):
+                            continue
+                        seen.add(key)
+                        children.append(submit(full_path, owners[node]))
+                        batch_dirs.append(full_path)
+                    if state is not None:
+                        dir_states.append((root, state[0], state[1], state[2]))
+
+                    # A directory is only taken once, so its file paths are unique
+                    kept_files = []
+                    for file in files:
+                        full_path = os.path.join(root, file)
+                        if not self.is_excluded(full_path):
+                            kept_files.append(full_path)
+
+                    listings[node] = (children, kept_files)
+                    batch_files.extend(kept_files)
+
+                    owner = owners[node]
+                    self.root_entries[owner] += len(children) + len(kept_files)
+                    remaining[owner] -= 1
+                    if not remaining[owner]:
+                        self.root_seconds[owner] = time.perf_counter() - start_time
+
+                # Listings of empty directories finishing last leave nothing to hand out
+                size = len(batch_dirs) + len(batch_files)
+                if size >= batch_size or (size and not pending):
+                    try:
+                        yield owners[next_node - 1], batch_dirs, batch_files
+                    except GeneratorExit:
+                        # Closed early (a cancelled scan): queued listings are not needed
+                        for future in pending:
+                            future.cancel()
+                        raise
+                    batch_dirs = []
+                    batch_files = []
+
+        # Assemble top-down: each directory contributes its children and files
+        # before any of its subdirectories are expanded
+        dir_list = []
+        file_list = []
+        for node, keep in top:
+            if keep:
+                dir_list.append(paths[node])
+            stack = [node]
+            while stack:
+                children, files = listings[stack.pop()]
+                dir_list.extend(paths[child] for child in children)
+                file_list.extend(files)
+                stack.extend(reversed(children))
+
+        return dir_list, file_list, dir_states, listed_count
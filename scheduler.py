@@ -0,0 +1,89 @@
+import logging
+import threading
+
+
+class ScanCancelled(Exception):
+    """Raised inside Indexer.scan when a newer request replaced the running scan."""
+
+
+def _merge_roots(a, b):
+    # None stands for every include root
+    if a is None or b is None:
+        return None
+    return list(dict.fromkeys(list(a) + list(b)))
+
+
+class ScanScheduler:
+    """
+    Runs an Indexer's scans on one background thread, one at a time.
+    Requests made while another is waiting are merged into it, so a burst of them
+    costs a single scan. A request with cancel set also stops the running scan, e.g.
+    because the settings it was started with changed. Its results are thrown away and
+    its roots are scanned again together with the new request.
+    """
+
+    def __init__(self, indexer):
+        self.indexer = indexer
+        self._cond = threading.Condition()
+        self._pending = None    # (roots or None for all, full, roots to drop)
+        self._running = None    # the request being worked on
+        self._cancel = threading.Event()
+        self._thread = None
+
+    @property
+    def busy(self):
+        """Whether a request is running or waiting."""
+        with self._cond:
+            return self._running is not None or self._pending is not None
+
+    def request(self, roots=None, full=False, drop=(), cancel=False):
+        """
+        Queues a scan of roots (all include roots if None, none if empty). The roots in
+        drop are removed from the index first if they are no longer included.
+        """
+        with self._cond:
+            if self._pending is None:
+                self._pending = (None if roots is None else list(roots), full, list(drop))
+            else:
+                pending_roots, pending_full, pending_drop = self._pending
+                self._pending = (_merge_roots(pending_roots, roots), pending_full or full,
+                                 list(dict.fromkeys(pending_drop + list(drop))))
+            if cancel and self._running is not None:
+                self._cancel.set()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="scan-scheduler", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    def wait(self, timeout=None):
+        """Blocks until every request so far is done. Returns False on timeout."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._running is None and self._pending is None, timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending is not None)
+                self._running = self._pending
+                self._pending = None
+                self._cancel.clear()
+            roots, full, drop = self._running
+            try:
+                # Roots that were added back in the meantime must keep their entries
+                drop = [root for root in drop if root not in self.indexer.include_dirs]
+                if drop:
+                    self.indexer.drop_roots(drop)
+                if roots is None or roots:
+                    self.indexer.scan(full=full, roots=roots, cancel=self._cancel)
+            except ScanCancelled:
+                logging.info("Scan cancelled by a newer request")
+                with self._cond:
+                    # The cancelling request is queued, the cancelled roots go along with it
+                    pending_roots, pending_full, pending_drop = self._pending or ([], False, [])
+                    self._pending = (_merge_roots(pending_roots, roots), pending_full or full, pending_drop)
+            except Exception as e:
+                logging.error(f"Scan failed: {e}")
+            finally:
+                with self._cond:
+                    self._running = None
+                    self._cond.notify_all()
@@ -0,0 +1,248 @@
+import os
+import mmap
+import struct
+import logging
+from array import array
+from bisect import bisect_left
+from pathtable import PathTable
+
+MAGIC = b'FSTAIDX1'
+VERSION = 2
+BLOCK_SIZE = 16         # Entries per front-coding block; every block starts with a full string
+REMOVED = 0xFFFF        # Prefix length marking a removed entry
+
+# Parents, name offsets and names per table, then keys (offsets and blob), id offsets
+# and ids per posting index
+SECTION_COUNT = 14
+
+HEADER = struct.Struct('<8sIIQI4x')
+SECTION = struct.Struct('<QQ')
+ENTRY = struct.Struct('<HH')
+COUNT = struct.Struct('<Q')
+
+
+def _encode_strings(strings):
+    """
+    Front-codes strings into (offsets, blob). Each entry stores how many leading bytes
+    it shares with the previous entry and the remaining suffix. offsets holds the entry
+    count followed by the blob offset of every block, plus the blob's end.
+    """
+    offsets = array('Q', [0])
+    blob = bytearray()
+    prev = b''
+    count = 0
+    for i, s in enumerate(strings):
+        if i % BLOCK_SIZE == 0:
+            offsets.append(len(blob))
+            prev = b''
+        count += 1
+        if s is None:
+            blob += ENTRY.pack(REMOVED, 0)
+            continue
+        data = s.encode('utf-8', 'surrogateescape')
+        shared = 0
+        limit = min(len(prev), len(data))
+        while shared < limit and prev[shared] == data[shared]:
+            shared += 1
+        blob += ENTRY.pack(shared, len(data) - shared)
+        blob += data[shared:]
+        prev = data
+    offsets.append(len(blob))
+    offsets[0] = count
+    return offsets.tobytes(), bytes(blob)
+
+
+class FrontCodedList:
+    """Read-only sequence of strings decoded lazily, one block at a time, from a snapshot."""
+
+    def __init__(self, offsets, blob):
+        self._count = offsets[0]
+        self._offsets = offsets[1:]
+        self._blob = blob
+        self._cached = (-1, None)
+
+    def __len__(self):
+        return self._count
+
+    def _block(self, b):
+        cached_b, entries = self._cached
+        if cached_b == b:
+            return entries
+        blob = self._blob
+        pos = self._offsets[b]
+        entries = []
+        prev = b''
+        for _ in range(min(BLOCK_SIZE, self._count - b * BLOCK_SIZE)):
+            shared, length = ENTRY.unpack_from(blob, pos)
+            pos += ENTRY.size
+            if shared == REMOVED:
+                entries.append(None)
+                continue
+            prev = prev[:shared] + bytes(blob[pos:pos + length])
+            pos += length
+            entries.append(prev.decode('utf-8', 'surrogateescape'))
+        self._cached = (b, entries)
+        return entries
+
+    def bisect_left(self, s):
+        """
+        Like bisect.bisect_left for a list of sorted strings without removed entries. Only
+        the first string of each block, which is stored in full, and one block are decoded.
+        """
+        blob, offsets = self._blob, self._offsets
+        lo, hi = 0, (self._count + BLOCK_SIZE - 1) // BLOCK_SIZE
+        while lo < hi:
+            mid = (lo + hi) // 2
+            _, length = ENTRY.unpack_from(blob, offsets[mid])
+            start = offsets[mid] + ENTRY.size
+            if bytes(blob[start:start + length]).decode('utf-8', 'surrogateescape') <= s:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == 0:
+            return 0
+        return (lo - 1) * BLOCK_SIZE + bisect_left(self._block(lo - 1), s)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError(i)
+        return self._block(i // BLOCK_SIZE)[i % BLOCK_SIZE]
+
+    def __iter__(self):
+        for b in range((self._count + BLOCK_SIZE - 1) // BLOCK_SIZE):
+            yield from self._block(b)
+
+
+class SnapshotPostings:
+    """Read-only trigram posting lists, found by binary search over the sorted trigrams."""
+
+    def __init__(self, keys, offsets, ids):
+        self._keys = keys
+        self._offsets = offsets
+        self._ids = ids
+
+    def get(self, gram, default=None):
+        keys = self._keys
+        lo = keys.bisect_left(gram)
+        if lo < len(keys) and keys[lo] == gram:
+            return self._ids[self._offsets[lo]:self._offsets[lo + 1]]
+        return default
+
+    def items(self):
+        for i, gram in enumerate(self._keys):
+            yield gram, self._ids[self._offsets[i]:self._offsets[i + 1]]
+
+
+class Snapshot:
+    """A loaded snapshot; its tables and postings stay backed by the mapped file."""
+
+    def __init__(self, generation, dir_table, file_table, dir_postings, file_postings):
+        self.generation = generation
+        self.dir_table = dir_table
+        self.file_table = file_table
+        self.dir_postings = dir_postings
+        self.file_postings = file_postings
+
+
+def _encode_postings(items):
+    items = sorted(items)
+    keys_offsets, keys_blob = _encode_strings(gram for gram, _ in items)
+    offsets = array('Q', [0])
+    ids = bytearray()
+    for _, posting in items:
+        ids += posting.tobytes()
+        offsets.append(len(ids) // 4)
+    return [keys_offsets, keys_blob, offsets.tobytes(), bytes(ids)]
+
+
+def write_snapshot(path, generation, dir_table, file_table, dir_postings, file_postings):
+    """
+    Writes the index to path atomically. The directory and file PathTables are stored as
+    a parent id array plus front-coded names. dir_postings and file_postings are
+    iterables of (trigram, ids) pairs. The snapshot is only valid while the database's
+    index generation still equals generation.
+    """
+    sections = []
+    for table in (dir_table, file_table):
+        sections.append(array('i', table.parents).tobytes())
+        sections.extend(_encode_strings(table.names))
+    sections.extend(_encode_postings(dir_postings))
+    sections.extend(_encode_postings(file_postings))
+
+    # The running instance and a --query fallback may both write, each to its own file
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            pos = HEADER.size + SECTION.size * len(sections)
+            table = []
+            for data in sections:
+                pos += -pos % 8
+                table.append(SECTION.pack(pos, len(data)))
+                pos += len(data)
+            f.write(HEADER.pack(MAGIC, VERSION, len(sections), generation, 0))
+            f.write(b''.join(table))
+            for data in sections:
+                f.write(b'\0' * (-f.tell() % 8))
+                f.write(data)
+            # The data must be on disk before the rename is, or a crash can leave a short file
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def load_snapshot(path, generation):
+    """Maps the snapshot at path, or returns None if it is missing, invalid or stale."""
+    try:
+        with open(path, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+    def strings(i):
+        offsets = sections[i].cast('Q')
+        if (len(offsets) < 2 or len(offsets) != (offsets[0] + BLOCK_SIZE - 1) // BLOCK_SIZE + 2
+                or offsets[-1] != len(sections[i + 1])):
+            raise ValueError(f"section {i} does not match its strings")
+        return FrontCodedList(offsets, sections[i + 1])
+
+    def table(i):
+        parents = sections[i].cast('i')
+        names = strings(i + 1)
+        if len(parents) != len(names):
+            raise ValueError(f"section {i} does not match its names")
+        return PathTable(parents, names)
+
+    def postings(i):
+        keys = strings(i)
+        offsets = sections[i + 2].cast('Q')
+        ids = sections[i + 3].cast('I')
+        if len(offsets) != len(keys) + 1 or offsets[-1] != len(ids):
+            raise ValueError(f"section {i + 2} does not match its posting lists")
+        return SnapshotPostings(keys, offsets, ids)
+
+    # A truncated or otherwise damaged file is only stale, the index is reloaded from the DB
+    try:
+        magic, version, n_sections, snap_generation, _ = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != VERSION or snap_generation != generation:
+            return None
+        if n_sections != SECTION_COUNT:
+            raise ValueError(f"{n_sections} sections instead of {SECTION_COUNT}")
+        view = memoryview(buf)
+        sections = []
+        for i in range(n_sections):
+            offset, length = SECTION.unpack_from(buf, HEADER.size + i * SECTION.size)
+            if offset + length > len(buf):
+                raise ValueError(f"section {i} ends past the end of the file")
+            sections.append(view[offset:offset + length])
+        return Snapshot(snap_generation, table(0), table(3), postings(6), postings(10))
+    except (struct.error, TypeError, ValueError) as e:
+        logging.warning(f"Ignoring corrupt index snapshot {path}: {e}")
+        return None
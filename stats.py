@@ -0,0 +1,158 @@
+import time
+import threading
+from bisect import bisect_left
+
+# In-memory timing statistics for the hot paths: searches, rendering, DB loads and
+# scans. Nothing is recorded unless enable() was called. Disabled, timer() hands
+# back a shared no-op context manager, so instrumented code pays one call and a flag check.
+
+# Histogram buckets grow by 2^(1/4) from 1µs to about 17 minutes, so a percentile
+# read from a bucket's upper edge is at most ~19% high.
+BUCKET_BOUNDS = [1e-6 * 2 ** (i / 4) for i in range(121)]
+PERCENTILES = (50, 95, 99)
+
+enabled = False
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+
+
+class Histogram:
+    """Log-bucketed latency histogram. Exact count, total, min and max; percentiles from the buckets."""
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, seconds):
+        self.buckets[bisect_left(BUCKET_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """Upper edge of the bucket holding the p-th percentile, clamped to the observed range."""
+        if not self.count:
+            return None
+        rank = self.count * p / 100
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                edge = BUCKET_BOUNDS[i] if i < len(BUCKET_BOUNDS) else self.max
+                return min(max(edge, self.min), self.max)
+        return self.max
+
+    def summary(self):
+        data = {"count": self.count, "total": self.total, "min": self.min, "max": self.max,
+                "mean": self.total / self.count if self.count else None}
+        for p in PERCENTILES:
+            data[f"p{p}"] = self.percentile(p)
+        return data
+
+
+class _Timer:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def enable(flag=True):
+    """Turns recording on or off. Statistics recorded so far are kept."""
+    global enabled
+    enabled = bool(flag)
+
+
+def timer(name):
+    """Context manager recording the duration of its block under name."""
+    if not enabled:
+        return _NULL_TIMER
+    return _Timer(name)
+
+
+def record(name, seconds):
+    """Adds one duration to the histogram called name."""
+    if not enabled:
+        return
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.add(seconds)
+
+
+def count(name, n=1):
+    """Adds n to the counter called name."""
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+
+def snapshot():
+    """Returns {"enabled", "timers": {name: summary}, "counters": {name: value}}, safe to serialize."""
+    with _lock:
+        return {
+            "enabled": enabled,
+            "timers": {name: h.summary() for name, h in sorted(_histograms.items())},
+            "counters": dict(sorted(_counters.items())),
+        }
+
+
+def _ms(seconds):
+    return "-" if seconds is None else f"{seconds * 1000:.2f}"
+
+
+def format_report(data):
+    """Renders a snapshot() as a plain text table, times in milliseconds."""
+    lines = []
+    if not data["enabled"]:
+        lines.append("Statistics are disabled (turn on Record Timings in the settings).")
+    if data["timers"]:
+        width = max(len(name) for name in data["timers"])
+        header = ["count", "mean", "min"] + [f"p{p}" for p in PERCENTILES] + ["max"]
+        lines.append(f"{'timer (ms)':<{width}}  " + "".join(f"{h:>10}" for h in header))
+        for name, s in data["timers"].items():
+            values = [str(s["count"]), _ms(s["mean"]), _ms(s["min"])]
+            values += [_ms(s[f"p{p}"]) for p in PERCENTILES] + [_ms(s["max"])]
+            lines.append(f"{name:<{width}}  " + "".join(f"{v:>10}" for v in values))
+    if data["counters"]:
+        width = max(len(name) for name in data["counters"])
+        lines.append("")
+        for name, value in data["counters"].items():
+            lines.append(f"{name:<{width}}  {value:>10}")
+    return "\n".join(lines) + "\n"
@@ -7,6 +7,15 @@ from pathlib import Path
 import database
 import config
 from indexer import Indexer
+from scanner import ParallelScanner
+from watcher import IndexWatcher
+from snapshot import FrontCodedList
+from pathtable import PathList, PathTable, build_tables
+from trigram import TrigramIndex
+from matcher import fuzzy_score, FuzzyMatcher, PackedMatcher
+import ipc
+import stats
+from exclude import ExcludeRules
 
 class TestFstaSearch(unittest.TestCase):
     def setUp(self):
@@ -53,6 +62,92 @@ class TestFstaSearch(unittest.TestCase):
         self.assertEqual(len(indexer2.files), 3)
         self.assertTrue(any("file1.txt" in f for f in indexer2.files))
 
+    def test_snapshot_startup(self):
+        """A fresh Indexer maps the scan's snapshot and falls back to the DB once it is stale."""
+        database.db.snapshot_path = os.path.join(self.test_dir, "index.snapshot")
+        os.makedirs(os.path.join(self.test_dir, "subdir", "ünïcode_dir"))
+        indexer = Indexer([self.test_dir])
+        indexer.scan()
+        expected = {q: indexer.search(q) for q in ("file", "ünï", "sub", "3.jpg", "f")}
+        # Entries keep the scanner's top-down order, in memory and in the DB
+        walk_dirs, walk_files, _, _ = ParallelScanner(indexer._is_excluded, workers=1).scan([self.test_dir])
+        self.assertEqual((list(indexer.directories), list(indexer.files)), (walk_dirs, walk_files))
+        self.assertEqual(database.db.get_index(), (walk_files, walk_dirs))
+
+        mapped = Indexer([self.test_dir])
+        self.assertIsInstance(mapped._file_table.names, FrontCodedList)
+        self.assertEqual(list(mapped.files), list(indexer.files))
+        self.assertEqual(list(mapped.directories), list(indexer.directories))
+        self.assertEqual({q: mapped.search(q) for q in expected}, expected)
+
+        # Live changes make the snapshot stale
+        new_file = os.path.join(self.test_dir, "late_file.txt")
+        mapped.apply_changes([new_file])
+        self.assertEqual(mapped.search("late_file"), [new_file])
+        reloaded = Indexer([self.test_dir])
+        self.assertIsInstance(reloaded._file_table.names, list)
+        self.assertEqual(reloaded.search("late_file"), [new_file])
+        # ...and the fallback load wrote a fresh one
+        self.assertIsInstance(Indexer([self.test_dir])._file_table.names, FrontCodedList)
+
+        # Flushed after live changes, the next start maps the snapshot again
+        newer_file = os.path.join(self.test_dir, "subdir", "newer_file.txt")
+        reloaded.apply_changes([newer_file])
+        reloaded.flush_snapshot()
+        restarted = Indexer([self.test_dir])
+        self.assertIsInstance(restarted._file_table.names, FrontCodedList)
+        self.assertEqual(restarted.search("newer_file"), [newer_file])
+        self.assertEqual(list(restarted.files), list(reloaded.files))
+
+        # Hot paths and live changes are looked up without decoding every mapped name
+        from unittest import mock
+        file3 = os.path.join(self.test_dir, "subdir", "file3.jpg")
+        database.db.record_usage(file3)
+        database.db.record_usage(os.path.join(self.test_dir, "subdir", "ünïcode_dir"))
+        with mock.patch.object(PathTable, "_child_map", side_effect=AssertionError):
+            hot = Indexer([self.test_dir])
+            self.assertIsInstance(hot._file_table.names, FrontCodedList)
+            self.assertEqual(hot.search("f")[0], file3)
+            self.assertEqual(hot.search("d")[0], os.path.join(self.test_dir, "subdir", "ünïcode_dir"))
+            hot.apply_changes([os.path.join(self.test_dir, "subdir", "hot_file.txt")], removed=[file3])
+            self.assertEqual(hot.search("file3"), [])
+            self.assertEqual(hot.search("hot_file"), [os.path.join(self.test_dir, "subdir", "hot_file.txt")])
+        self.assertEqual(hot._find(hot._file_table, newer_file), reloaded._find(reloaded._file_table, newer_file))
+
+        # A damaged snapshot is stale too, whichever section it ends in
+        size = os.path.getsize(database.db.snapshot_path)
+        for cut in (size - 3, size // 2, 100, 20):
+            with open(database.db.snapshot_path, "r+b") as f:
+                f.truncate(cut)
+            damaged = Indexer([self.test_dir])
+            self.assertIsInstance(damaged._file_table.names, list)
+            self.assertEqual(damaged.search("late_file"), [new_file])
+        self.assertFalse([name for name in os.listdir(self.test_dir) if name.endswith(".tmp")])
+
+        # Searches go on while the snapshot is written
+        import threading
+        from unittest import mock
+        writing = threading.Event()
+        release = threading.Event()
+        found = []
+
+        def slow_write(*args):
+            writing.set()
+            release.wait(10)
+
+        with mock.patch("indexer.write_snapshot", slow_write):
+            saver = threading.Thread(target=damaged.save_snapshot)
+            saver.start()
+            try:
+                self.assertTrue(writing.wait(10))
+                searcher = threading.Thread(target=lambda: found.append(damaged.search("late_file")))
+                searcher.start()
+                searcher.join(2)
+                self.assertEqual(found, [[new_file]])
+            finally:
+                release.set()
+                saver.join(10)
+
     def test_indexer_exclude(self):
         # Exclude the subdir
         subdir = os.path.join(self.test_dir, "subdir")
@@ -63,6 +158,26 @@ class TestFstaSearch(unittest.TestCase):
         self.assertEqual(len(indexer.directories), 1)
         self.assertFalse(any("file3.jpg" in f for f in indexer.files))
 
+    def test_exclude_rules(self):
+        """Path rules match whole components and glob rules prune directories and files anywhere."""
+        rules = ExcludeRules(["/foo/bar", "node_modules", "*.pyc", "**/build", "/home/*/cache"])
+        for path in ("/foo/bar", "/foo/bar/x", "/a/node_modules/b.js", "/a/x.pyc", "/a/b/build", "/home/u/cache/z"):
+            self.assertTrue(rules(path), path)
+        for path in ("/foo/barbaz", "/foo", "/a/node_modulesx", "/a/xpyc", "/a/rebuild", "/home/u/v/cache"):
+            self.assertFalse(rules(path), path)
+
+        os.makedirs(os.path.join(self.test_dir, "app", "node_modules", "lib"))
+        os.makedirs(os.path.join(self.test_dir, "subdir_two"))
+        Path(os.path.join(self.test_dir, "app", "node_modules", "lib", "index.js")).touch()
+        Path(os.path.join(self.test_dir, "app", "main.pyc")).touch()
+        Path(os.path.join(self.test_dir, "subdir_two", "kept.txt")).touch()
+
+        indexer = Indexer([self.test_dir], exclude_dirs=["node_modules", "*.pyc", os.path.join(self.test_dir, "subdir")])
+        indexer.scan()
+        self.assertEqual(sorted(os.path.relpath(p, self.test_dir) for p in indexer.files),
+                         ["file1.txt", "file2.py", os.path.join("subdir_two", "kept.txt")])
+        self.assertNotIn(os.path.join(self.test_dir, "app", "node_modules"), list(indexer.directories))
+
     def test_indexer_search(self):
         indexer = Indexer([self.test_dir])
         indexer.scan()
@@ -105,6 +220,19 @@ class TestFstaSearch(unittest.TestCase):
         results_beta = indexer.search("beta")
         self.assertTrue(any(r.endswith(os.path.join("alpha", "beta")) for r in results_beta))
 
+    def test_differential_index_update(self):
+        """update_index only writes the rows that changed."""
+        files = ["/a/one.txt", "/a/two.txt"]
+        dirs = ["/a", "/a/b"]
+        self.assertEqual(database.db.update_index(files, dirs), (4, 0))
+        self.assertEqual(database.db.update_index(files, dirs), (0, 0))
+        # A path that turned from a file into a directory is rewritten
+        self.assertEqual(database.db.update_index(["/a/one.txt", "/a/three.txt"], ["/a", "/a/two.txt"]), (2, 2))
+
+        db_files, db_dirs = database.db.get_index()
+        self.assertEqual(sorted(db_files), ["/a/one.txt", "/a/three.txt"])
+        self.assertEqual(sorted(db_dirs), ["/a", "/a/two.txt"])
+
     def test_config_persistence(self):
         # Test saving to DB via config module
         conf = config.load_config()
@@ -115,6 +243,21 @@ class TestFstaSearch(unittest.TestCase):
         conf2 = config.load_config()
         self.assertFalse(conf2["display_tooltips"])
 
+    def test_performance_profile(self):
+        """File databases open in WAL mode and batched settings commit once."""
+        db_path = os.path.join(self.test_dir, "profile.db")
+        db = database.DatabaseManager(db_path)
+        try:
+            self.assertEqual(db.conn.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+            self.assertEqual(db.conn.execute("PRAGMA synchronous").fetchone()[0], 1)  # NORMAL
+            self.assertEqual(db.conn.execute("PRAGMA temp_store").fetchone()[0], 2)  # MEMORY
+
+            db.set_settings({"a": 1, "b": [2, 3]})
+            self.assertEqual(db.get_setting("b"), [2, 3])
+            self.assertFalse(db.conn.in_transaction)
+        finally:
+            db.close()
+
     def test_deep_path_collapsing(self):
         """Test specific use case: deep_a/deep_b/deep_c..."""
         # Create deep structure
@@ -198,6 +341,973 @@ class TestFstaSearch(unittest.TestCase):
         self.assertTrue(any(r.endswith("target_dir") for r in dirs_found))
         self.assertTrue(any(r.endswith(os.path.join("other", "target_dir")) for r in dirs_found))
 
+    def test_trigram_search_matches_full_scan(self):
+        """Trigram candidates must give exactly the results of a full scan."""
+        for parts in [("proj_a", "src", "report"), ("proj_b", "report_old"), ("misc", "Reports")]:
+            os.makedirs(os.path.join(self.test_dir, *parts))
+        Path(os.path.join(self.test_dir, "proj_a", "src", "report.py")).touch()
+        Path(os.path.join(self.test_dir, "misc", "REPORT.md")).touch()
+
+        indexer = Indexer([self.test_dir])
+        indexer.scan()
+        indexed = [indexer.search(q) for q in ("report", "proj", "src", "ort.", "e", "zzz")]
+
+        class FullScan:
+            def candidates(self, query):
+                return None
+
+        indexer._dir_grams = indexer._file_grams = FullScan()
+        indexer._query_cache.clear()
+        scanned = [indexer.search(q) for q in ("report", "proj", "src", "ort.", "e", "zzz")]
+        self.assertEqual(indexed, scanned)
+
+        # Components above the include root are still matched and collapsed
+        root_name = os.path.basename(self.test_dir)
+        indexer._set_index(indexer.files, indexer.directories)
+        self.assertIn(self.test_dir, indexer.search(root_name))
+
+        # Posting lists keep the gaps between ids, in 16-bit items while they fit
+        grams = TrigramIndex()
+        for i in (3, 70, 71):
+            grams.add(i, "report")
+        self.assertEqual(grams.postings["rep"].typecode, "H")
+        grams.add(5000000, "report")
+        self.assertEqual(grams.candidates("port"), [3, 70, 71, 5000000])
+        self.assertEqual(grams.cost("repo"), 4)
+
+    def test_path_table_round_trip(self):
+        """Parent-pointer tables rebuild exactly the paths they were built from."""
+        dirs = ["/data/", "/data/a", "/data/a/b", "/srv//odd", "/srv//odd/c", "/data/a/b/c"]
+        files = ["/data/a/b/x.txt", "/data/top.txt", "/srv//odd/c/y", "/elsewhere/z"]
+        dir_table, file_table = build_tables(dirs, files)
+
+        self.assertEqual(list(PathList(dir_table, dir_table)), dirs)
+        self.assertEqual(list(PathList(file_table, dir_table)), files)
+        self.assertEqual([PathList(file_table, dir_table)[i] for i in range(len(files))], files)
+        # Only names are stored below the roots, and repeated names share one string
+        self.assertEqual(dir_table.names[2], "b")
+        self.assertEqual(dir_table.parents[:3].tolist(), [-1, -1, 1])
+        self.assertIs(dir_table.names[5], build_tables(["/x", "/x/c"], [])[0].names[1])
+
+        # Lookups scan the parent ids until they add up to building the child map
+        self.assertEqual(dir_table.find(1, "b"), 2)
+        self.assertEqual(file_table.children(4), [2])
+        self.assertFalse(dir_table.has_child_map())
+        dir_table.spend(PathTable.LOOKUP_ROWS)
+        self.assertEqual(dir_table.find(1, "b"), 2)
+        self.assertTrue(dir_table.has_child_map())
+
+    def test_query_refinement_cache(self):
+        """Extending or shortening a query reuses cached match sets with identical results."""
+        os.makedirs(os.path.join(self.test_dir, "repo_one", "nested_repository"))
+        Path(os.path.join(self.test_dir, "repo_one", "rep.txt")).touch()
+        Path(os.path.join(self.test_dir, "subdir", "report.txt")).touch()
+
+        indexer = Indexer([self.test_dir])
+        indexer.scan()
+        fresh = {q: Indexer([self.test_dir]).search(q) for q in ("rep", "repo", "repor", "xrep")}
+
+        for q in ("rep", "repo", "repor", "repo", "rep", "xrep"):
+            self.assertEqual(indexer.search(q), fresh[q])
+        self.assertIn("repor", indexer._query_cache)
+
+        # A rescan invalidates the cached ids
+        Path(os.path.join(self.test_dir, "repo_two.txt")).touch()
+        indexer.scan()
+        self.assertTrue(any(r.endswith("repo_two.txt") for r in indexer.search("repo")))
+
+    def test_fuzzy_matcher_ranking(self):
+        """Fuzzy mode finds subsequences and ranks word starts and contiguous runs first."""
+        os.makedirs(os.path.join(self.test_dir, "src", "main_window"))
+        for name in ("main_window.py", "my_aim_in_window.txt", "mainwin.c", "unrelated.txt"):
+            Path(os.path.join(self.test_dir, "src", name)).touch()
+
+        indexer = Indexer([self.test_dir])
+        indexer.scan()
+        self.assertEqual(indexer.search("mainwin"), [os.path.join(self.test_dir, "src", "mainwin.c")])
+
+        indexer.set_matcher("fuzzy")
+        results = [os.path.basename(p) for p in indexer.search("mainwin", limit=10)]
+        self.assertEqual(results[0], "mainwin.c")
+        self.assertEqual(set(results), {"mainwin.c", "main_window", "main_window.py", "my_aim_in_window.txt"})
+        self.assertLess(results.index("main_window.py"), results.index("my_aim_in_window.txt"))
+        self.assertEqual(len(indexer.search("mainwin", limit=2)), 2)
+        self.assertIsNone(fuzzy_score("xyz", "main_window.py"))
+        self.assertGreater(fuzzy_score("mw", "MainWindow"), fuzzy_score("mw", "summwin"))
+
+        # The name blob follows index changes
+        Path(os.path.join(self.test_dir, "src", "mwin.h")).touch()
+        indexer.scan()
+        self.assertIn("mwin.h", [os.path.basename(p) for p in indexer.search("mwin", limit=10)])
+
+        # Names that grow when lowercased, or hold a newline, do not shift the rows after them
+        os.makedirs(os.path.join(self.test_dir, "İ" * 30))
+        Path(os.path.join(self.test_dir, "new\nline")).touch()
+        Path(os.path.join(self.test_dir, "zqz")).touch()
+        indexer.scan()
+        self.assertEqual(indexer.search("zqz"), [os.path.join(self.test_dir, "zqz")])
+        self.assertEqual(indexer.search("line"), [os.path.join(self.test_dir, "new\nline")])
+        self.assertIsNotNone(fuzzy_score("xt", "İİİx.txt"))
+
+        # Live changes extend the blob, and rank like one built from scratch
+        from unittest import mock
+        new_dir = os.path.join(self.test_dir, "main_win_extra")
+        indexer.apply_changes([os.path.join(new_dir, "mainwin.rs")], [new_dir],
+                              [os.path.join(self.test_dir, "src", "mainwin.c")])
+        with mock.patch.object(FuzzyMatcher, "__init__", side_effect=AssertionError):
+            results = indexer.search("mainwin", limit=10)
+        self.assertEqual(results, FuzzyMatcher().search(indexer, "mainwin", 10))
+        self.assertEqual(results[0], os.path.join(new_dir, "mainwin.rs"))
+        self.assertNotIn(os.path.join(self.test_dir, "src", "mainwin.c"), results)
+
+    def test_packed_matcher_matches_substring(self):
+        """The packed buffer search returns exactly what the substring matcher returns, with or without numpy."""
+        os.makedirs(os.path.join(self.test_dir, "subdir", "Nested_File", "deeper"))
+        for name in ("FILE_upper.txt", "ünïcode_file.md", "new\nline_file", "other.c"):
+            Path(os.path.join(self.test_dir, "subdir", "Nested_File", name)).touch()
+
+        indexer = Indexer([self.test_dir])
+        indexer.scan()
+        queries = ("file", "fi", "f", "sub", "ünï", "nested_file", "\nline", "deeper", os.sep, "missing",
+                   os.path.basename(self.test_dir)[:4])
+        expected = {(q, limit): indexer.search(q, limit) for q in queries for limit in (1, 3, 50)}
+
+        for use_numpy in (True, False):
+            indexer.set_matcher("packed")
+            if not use_numpy:
+                indexer.matcher._numpy = None
+            indexer.matcher.CHUNK = 2
+            # Scan the buffer even where the trigram index would be cheaper
+            indexer.matcher.CANDIDATE_COST = 10 ** 9
+            self.assertEqual({key: indexer.search(*key) for key in expected}, expected)
+
+        # The buffer follows index changes
+        new_file = os.path.join(self.test_dir, "late_file.txt")
+        indexer.apply_changes([new_file])
+        self.assertIn(new_file, indexer.search("late"))
+        self.assertTrue(PackedMatcher().matches("late", new_file))
+
+    def test_query_language(self):
+        """Terms are ANDed and can be scoped to a subtree, filtered by extension or type, and negated."""
+        for rel in ("proj/src/main.rs", "proj/src/lib.rs", "proj/build/out.rs", "proj/README.md",
+                    "other/main.rs", "other/proj_notes.txt"):
+            path = os.path.join(self.test_dir, *rel.split("/"))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            Path(path).touch()
+        p = lambda rel: os.path.join(self.test_dir, *rel.split("/"))
+
+        indexer = Indexer([self.test_dir])
+        indexer.scan()
+        queries = {
+            "main rs": {p("proj/src/main.rs"), p("other/main.rs")},
+            "proj/ rs": {p("proj/src/main.rs"), p("proj/src/lib.rs"), p("proj/build/out.rs")},
+            "PROJ/ ext:rs -build/": {p("proj/src/main.rs"), p("proj/src/lib.rs")},
+            "proj/ r": {p("proj/src"), p("proj/src/main.rs"), p("proj/src/lib.rs"), p("proj/build/out.rs"), p("proj/README.md")},
+            "type:dir src": {p("proj/src")},
+            "ext:md,.txt": {p("proj/README.md"), p("other/proj_notes.txt"), p("file1.txt")},
+            "ext:txt -file": {p("other/proj_notes.txt")},
+            "main !other/": {p("proj/src/main.rs")},
+            "src/main rs": {p("proj/src/main.rs")},
+            p("proj/src") + os.sep + " s": {p("proj/src/main.rs"), p("proj/src/lib.rs")},
+            '"proj_notes" -type:dir': {p("other/proj_notes.txt")},
+            "ext: type:": set(),
+            # A single path term is planned too, the matcher only looks at names
+            "src/main": {p("proj/src/main.rs")},
+            # Name terms may match a folder above, one of them the entry's own name
+            "proj .rs": {p("proj/src/main.rs"), p("proj/src/lib.rs"), p("proj/build/out.rs")},
+            "proj main": {p("proj/src/main.rs")},
+            "proj ext:rs -build/": {p("proj/src/main.rs"), p("proj/src/lib.rs")},
+            # A negated name only looks at the entry's own
+            "src -proj": {p("proj/src")},
+        }
+        # The test dir's random name is an ancestor too
+        if "rs" not in self.test_dir.lower():
+            queries["proj rs"] = queries["proj .rs"]
+        for q, expected in queries.items():
+            self.assertEqual(set(indexer.search(q)), expected, q)
+        # Directories first, and the limit holds
+        results = indexer.search("proj/ s", limit=2)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[0], p("proj/src"))
+        # A single term is still the matcher's, which collapses directory matches
+        self.assertEqual(indexer.search("proj"), [p("proj"), p("other/proj_notes.txt")])
+
+        # Candidates come from the terms, paths are only built for results
+        from unittest import mock
+        with mock.patch.object(PathTable, "path", autospec=True, side_effect=PathTable.path) as path:
+            self.assertEqual(indexer.search("zz/qq"), [])
+            self.assertEqual(indexer.search("c/m"), [p("proj/src/main.rs")])
+            self.assertEqual(indexer.search("main ext:rs proj"), [p("proj/src/main.rs")])
+        self.assertEqual(path.call_count, 2)
+        # Terms too short for a trigram are checked lazily, nothing is listed up front
+        from query import QueryEngine
+        with mock.patch.object(QueryEngine, "_plan_entries", side_effect=AssertionError):
+            self.assertEqual(set(indexer.search("ma ai")), {p("proj/src/main.rs"), p("other/main.rs")})
+            self.assertEqual(set(indexer.search("rs -ma")), {p("proj/src/lib.rs"), p("proj/build/out.rs")})
+            self.assertEqual(len(indexer.search("r s", limit=2)), 2)
+        # Added entries reach the children of their directory without re-sorting them all
+        from query import ChildIndex
+        self.assertEqual(set(indexer.search("proj/ ext:rs")), queries["proj/ rs"])
+        added = p("proj/src/added.rs")
+        Path(added).touch()
+        indexer.apply_changes([added])
+        with mock.patch.object(ChildIndex, "__init__", side_effect=AssertionError):
+            self.assertEqual(set(indexer.search("proj/ ext:rs")), queries["proj/ rs"] | {added})
+            self.assertEqual(set(indexer.search("src/ -main")), {p("proj/src/lib.rs"), added})
+        os.remove(added)
+        indexer.apply_changes(removed=[added])
+
+        # Include roots lie below a scope matching the directory that contains them
+        roots = [p("proj"), p("other")]
+        scoped = {self.test_dir + os.sep + " type:dir": set(roots) | {p("proj/src"), p("proj/build")},
+                  "/ -type:file -src -build": set(roots),
+                  "proj/ ext:rs": {p("proj/src/main.rs"), p("proj/src/lib.rs"), p("proj/build/out.rs")}}
+        database.db.close()
+        database.db = database.DatabaseManager(":memory:")
+        rooted = Indexer(roots)
+        rooted.scan()
+        for q, expected in scoped.items():
+            self.assertEqual(set(rooted.search(q)), expected, q)
+
+        # Low-memory queries read the name index and subtrees, never the whole index
+        database.db.set_setting('low_memory_mode', True)
+        with mock.patch.object(database.db, "get_index", side_effect=AssertionError):
+            low_memory = Indexer(roots)
+            for q, expected in scoped.items():
+                self.assertEqual(set(low_memory.search(q)), expected, q)
+        database.db.set_setting('low_memory_mode', False)
+        indexer = Indexer([self.test_dir])
+        indexer.scan()
+        database.db.set_setting('low_memory_mode', True)
+        with mock.patch.object(database.db, "get_index", side_effect=AssertionError):
+            low_memory = Indexer([self.test_dir])
+            for q, expected in queries.items():
+                self.assertEqual(set(low_memory.search(q)), expected, q)
+
+    def test_per_root_shards(self):
+        """Each include root has its own schedule, and is scanned or dropped without touching the others."""
+        roots = [os.path.join(self.test_dir, name) for name in ("ssd", "nfs", "usb")]
+        for root in roots:
+            os.makedirs(os.path.join(root, "docs"))
+            Path(os.path.join(root, "docs", f"{os.path.basename(root)}_old.txt")).touch()
+        ssd, nfs, usb = roots
+
+        indexer = Indexer([ssd, nfs])
+        indexer.scan()
+        shards = indexer.shard_info()
+        self.assertEqual(set(shards), {ssd, nfs})
+        self.assertEqual(shards[ssd][1], 3)
+
+        # A shorter interval only makes that root due
+        database.db.set_setting('refresh_intervals', {ssd: 1})
+        self.assertEqual(indexer.due_roots(shards[ssd][0] + 2 * 86400), [ssd])
+        self.assertEqual(indexer.due_roots(shards[ssd][0] + 8 * 86400), [ssd, nfs])
+
+        for root in (ssd, nfs):
+            Path(os.path.join(root, "docs", f"{os.path.basename(root)}_new.txt")).touch()
+        indexer.scan(roots=[ssd])
+        names = {os.path.basename(p) for p in indexer.search(".txt", limit=50)}
+        self.assertEqual(names, {"ssd_old.txt", "ssd_new.txt", "nfs_old.txt"})
+        db_files, _ = database.db.get_index()
+        self.assertEqual({os.path.basename(p) for p in db_files}, names)
+
+        # Removing a root drops its shard, adding one scans only the new root
+        from unittest import mock
+        indexer.scan = mock.Mock(wraps=indexer.scan)
+        indexer.reconfigure([ssd, usb], [])
+        self.assertTrue(indexer.scheduler.wait(10))
+        self.assertEqual(indexer.scan.call_args.kwargs["roots"], [usb])
+        self.assertEqual(indexer.due_roots(), [])
+        names = {os.path.basename(p) for p in indexer.search(".txt", limit=50)}
+        self.assertEqual(names, {"ssd_old.txt", "ssd_new.txt", "usb_old.txt"})
+        db_files, db_dirs = database.db.get_index()
+        self.assertEqual({os.path.basename(p) for p in db_files}, names)
+        self.assertFalse(any(p.startswith(nfs) for p in db_dirs))
+        self.assertEqual(set(indexer.shard_info()), {ssd, usb})
+        self.assertEqual(set(database.db.get_shards()), {ssd, usb})
+
+        # Subtree ranges hold for the filesystem root and roots with a trailing separator
+        for root, other in ((os.sep, None), ("/data/", "/database")):
+            db = database.DatabaseManager(":memory:")
+            below = [os.path.join(root, "home", "a.txt"), os.path.join(root, "zz", "b.txt")]
+            db.update_index(below + ([other] if other else []), [root])
+            self.assertEqual(db.get_index(root), (below, [root]))
+            self.assertEqual(db.update_index([], [], [root]), (0, 3))
+            self.assertEqual(db.get_index()[0], [other] if other else [])
+            db.close()
+
+    def test_scan_scheduler(self):
+        """Queued scans merge into one, and a cancelling request replaces the running scan."""
+        import threading
+        from unittest import mock
+        from scheduler import ScanCancelled
+        other = os.path.join(self.test_dir, "other")
+        os.makedirs(other)
+        indexer = Indexer([self.test_dir])
+        indexer.scan()
+
+        # Hold the worker inside a scan until the test lets it go
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        real_scan = indexer.scan
+
+        def slow_scan(full=False, roots=None, cancel=None):
+            calls.append(roots)
+            if len(calls) == 1:
+                started.set()
+                release.wait(10)
+                if cancel.is_set():
+                    raise ScanCancelled()
+            real_scan(full, roots, cancel)
+
+        with mock.patch.object(indexer, "scan", side_effect=slow_scan):
+            indexer.scan_async([self.test_dir])
+            self.assertTrue(started.wait(10))
+            self.assertTrue(indexer.is_scanning)
+            # Two requests while busy: one merged follow-up scan, the first one cancelled
+            indexer.scan_async([other])
+            indexer.scheduler.request([self.test_dir], cancel=True)
+            release.set()
+            self.assertTrue(indexer.scheduler.wait(10))
+
+        self.assertFalse(indexer.is_scanning)
+        self.assertEqual(calls[0], [self.test_dir])
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(sorted(calls[1]), sorted([self.test_dir, other]))
+
+        # A real scan stops at the first batch once cancelled, leaving the index alone
+        Path(os.path.join(self.test_dir, "new_file.txt")).touch()
+        cancel = threading.Event()
+        cancel.set()
+        with self.assertRaises(ScanCancelled):
+            indexer.scan(cancel=cancel)
+        self.assertFalse(indexer.is_scanning)
+
+        # Threads share one connection, so a sync runs alone: a setting written meanwhile waits
+        synced = threading.Event()
+        resume = threading.Event()
+
+        def files():
+            yield os.path.join(self.test_dir, "file1.txt")
+            synced.set()
+            resume.wait(10)
+
+        sync = threading.Thread(target=database.db.update_index, args=(files(), [self.test_dir]))
+        sync.start()
+        self.assertTrue(synced.wait(10))
+        writer = threading.Thread(target=database.db.set_setting, args=("probe", 1))
+        writer.start()
+        writer.join(0.2)
+        self.assertTrue(writer.is_alive())
+        resume.set()
+        sync.join(10)
+        writer.join(10)
+        self.assertEqual(database.db.get_setting("probe"), 1)
+        self.assertEqual(indexer.search("new_file"), [])
+
+        # Reads have their own connection: under WAL they see the last commit without waiting
+        file_db = database.DatabaseManager(os.path.join(self.test_dir, "wal.db"))
+        file_db.update_shard(self.test_dir, 1.0, 5, 0.5)
+        synced.clear()
+        resume.clear()
+        sync = threading.Thread(target=file_db.update_index, args=(files(), [self.test_dir]))
+        sync.start()
+        self.assertTrue(synced.wait(10))
+        reads = []
+        reader = threading.Thread(target=lambda: reads.extend([file_db.get_shards(), file_db.get_index(),
+                                                               file_db.get_setting("probe", 0)]))
+        reader.start()
+        reader.join(5)
+        resume.set()
+        sync.join(10)
+        self.assertEqual(reads, [{self.test_dir: (1.0, 5, 0.5)}, ([], []), 0])
+        self.assertEqual(file_db.get_index(), ([os.path.join(self.test_dir, "file1.txt")], [self.test_dir]))
+        file_db.close()
+
+    def test_frecency_boost(self):
+        """Picked paths rise to the top of matching searches, decay over time and vanish when deleted."""
+        for i in range(5):
+            Path(os.path.join(self.test_dir, "subdir", f"notes{i}.txt")).touch()
+        picked = os.path.join(self.test_dir, "subdir", "notes4.txt")
+
+        indexer = Indexer([self.test_dir])
+        indexer.scan()
+        self.assertNotEqual(indexer.search("notes", limit=1), [picked])
+
+        indexer.record_usage(picked)
+        indexer.record_usage(picked)
+        self.assertEqual(indexer.search("notes", limit=1), [picked])
+        self.assertEqual(len(indexer.search("notes")), 5)
+        self.assertNotIn(picked, indexer.search("file"))
+
+        # A fresh indexer gets the hot set from the DB
+        self.assertEqual(Indexer([self.test_dir]).search("notes", limit=1), [picked])
+
+        now = time.time()
+        database.db.record_usage(os.path.join(self.test_dir, "file1.txt"), now)
+        ranked = dict(database.db.get_frecent_paths(10, now + database.USAGE_HALF_LIFE))
+        self.assertAlmostEqual(ranked[os.path.join(self.test_dir, "file1.txt")], 0.5)
+
+        # Hot paths are looked up once per index change, not on every keystroke
+        from unittest import mock
+        indexer.search("notes")
+        with mock.patch.object(indexer, "_find", wraps=indexer._find) as find:
+            for q in ("n", "no", "not", "note"):
+                self.assertEqual(indexer.search(q, limit=1), [picked])
+        find.assert_not_called()
+        # Names too short for a trigram are resolved without a pass over the table
+        short = os.path.join(self.test_dir, "subdir", "n5")
+        indexer.apply_changes([short])
+        indexer.record_usage(short)
+        with mock.patch("pathtable.PathTable.basename", side_effect=AssertionError):
+            self.assertIn((short, False), [(p, is_dir) for p, is_dir, _, _ in indexer._hot_entries()])
+        # Filters check hot paths with the type looked up along with them
+        with mock.patch("os.path.isdir", side_effect=AssertionError):
+            self.assertEqual(indexer.search("ext:txt notes", limit=1), [picked])
+            self.assertEqual(indexer.search("type:file no", limit=1), [picked])
+            self.assertNotIn(picked, indexer.search("type:dir no"))
+        indexer.apply_changes(removed=[picked])
+        self.assertNotIn(picked, indexer.search("notes"))
+        indexer.apply_changes([picked])
+        self.assertEqual(indexer.search("notes", limit=1), [picked])
+
+        database.db.set_setting('low_memory_mode', True)
+        low_memory = Indexer([self.test_dir])
+        low_memory.search("notes")
+        with mock.patch.object(database.db, "path_type") as path_type, \
+                mock.patch("os.path.isdir", side_effect=AssertionError):
+            self.assertEqual(low_memory.search("notes", limit=1), [picked])
+            self.assertEqual(low_memory.search("ext:txt notes", limit=1), [picked])
+        path_type.assert_not_called()
+        database.db.set_setting('low_memory_mode', False)
+
+        os.remove(picked)
+        indexer.scan()
+        self.assertNotIn(picked, indexer.search("notes"))
+
+    def test_socket_query_protocol(self):
+        """QUERY commands are answered from the live index over the instance's Unix socket."""
+        import json
+        import socket
+        import threading
+        indexer = Indexer([self.test_dir])
+        indexer.scan()
+        shown = []
+
+        original_path = ipc.SOCKET_PATH
+        ipc.SOCKET_PATH = os.path.join(self.test_dir, "test.sock")
+        try:
+            self.assertIsNone(ipc.query("file"))
+
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(ipc.SOCKET_PATH)
+            server.listen()
+
+            def serve(count):
+                for _ in range(count):
+                    conn, _ = server.accept()
+                    with conn:
+                        line = conn.makefile("rb").readline().decode()
+                        conn.sendall(ipc.handle_command(line, indexer, lambda: shown.append(True)))
+
+            thread = threading.Thread(target=serve, args=(3,))
+            thread.start()
+            text = ipc.query("file", limit=2)
+            data = json.loads(ipc.query("file3", as_json=True))
+            stats.enable(True)
+            self.assertEqual(ipc.send_command(f"SHOW {time.monotonic()!r}"), b"")
+            thread.join()
+            self.assertEqual(stats.snapshot()["timers"]["client.show"]["count"], 1)
+
+            # An instance too busy to answer is still an instance: SHOW counts as delivered,
+            # and a query gets None so the caller falls back instead of crashing
+            self.assertIsNone(ipc.send_command("QUERY 5 file", timeout=0.2))
+            self.assertTrue(ipc.show(time.monotonic(), timeout=0.2))
+            server.close()
+        finally:
+            ipc.SOCKET_PATH = original_path
+            stats.enable(False)
+            stats.reset()
+
+        self.assertEqual(text.decode().splitlines(), indexer.search("file", limit=2))
+        self.assertEqual(data, {"results": [os.path.join(self.test_dir, "subdir", "file3.jpg")]})
+        self.assertEqual(shown, [True])
+
+    def test_query_fallback_is_read_only(self):
+        """Without an answering instance, --query searches the stored index but never writes to it."""
+        import io
+        import types
+        import fstasearch
+        from unittest import mock
+        Indexer([self.test_dir]).scan()
+        snapshot_path = os.path.join(self.test_dir, "index.snapshot")
+        database.db.snapshot_path = snapshot_path
+        expected = Indexer([self.test_dir], read_only=True).search("file")
+        self.assertEqual(len(expected), 3)
+
+        def run_query():
+            out = types.SimpleNamespace(buffer=io.BytesIO(), flush=lambda: None)
+            args = types.SimpleNamespace(query="file", limit=50, json=False)
+            with mock.patch("ipc.query", return_value=None), mock.patch("sys.stdout", out), self.assertLogs(level="WARNING"):
+                fstasearch.run_query(args)
+            return out.buffer.getvalue().decode().splitlines()
+
+        def has_name_index():
+            return database.db.conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'file_names'").fetchone() is not None
+
+        # A busy instance in low-memory mode keeps its name tables, even if the setting
+        # read here says otherwise, and a missing snapshot is not written
+        database.db.enable_name_index()
+        self.assertEqual(run_query(), expected)
+        self.assertTrue(has_name_index())
+        self.assertFalse(os.path.exists(snapshot_path))
+
+        # Low-memory mode searches the tables if they exist, and does not create them
+        database.db.set_setting('low_memory_mode', True)
+        self.assertEqual(sorted(run_query()), sorted(expected))
+        database.db.disable_name_index()
+        self.assertEqual(run_query(), expected)
+        self.assertFalse(has_name_index())
+        self.assertFalse(os.path.exists(snapshot_path))
+
+    def test_stats_recording(self):
+        """Timers record nothing while disabled and report percentiles and counters once enabled."""
+        import json
+        stats.reset()
+        indexer = Indexer([self.test_dir])
+        indexer.scan()
+        indexer.search("file")
+        self.assertIs(stats.timer("search"), stats.timer("other"))
+        self.assertEqual(stats.snapshot()["timers"], {})
+
+        stats.enable()
+        try:
+            for ms in range(1, 101):
+                stats.record("test.timer", ms / 1000)
+            stats.count("test.counter", 3)
+            indexer.scan(full=True)
+            # Subtree rescans (watcher flushes, unwatched directories) add no per-root timers
+            indexer.rescan_subtree(os.path.join(self.test_dir, "subdir"))
+            indexer.search("file")
+            database.db.get_index()
+            data = json.loads(ipc.handle_command("STATSJSON", indexer, None))
+            report = ipc.handle_command("STATS", indexer, None).decode()
+        finally:
+            stats.enable(False)
+            stats.reset()
+
+        timer = data["timers"]["test.timer"]
+        self.assertEqual(timer["count"], 100)
+        self.assertAlmostEqual(timer["mean"], 0.0505)
+        # Bucket edges are at most ~19% above the exact percentile
+        for p, exact in ((50, 0.050), (95, 0.095), (99, 0.099)):
+            self.assertGreaterEqual(timer[f"p{p}"], exact)
+            self.assertLessEqual(timer[f"p{p}"], exact * 1.2)
+        self.assertEqual(data["counters"]["test.counter"], 3)
+        for name in ("search", "scan.walk", "scan.total", "scan.swap", "db.get_index", f"scan.root {self.test_dir}"):
+            self.assertEqual(data["timers"][name]["count"], 1, name)
+        self.assertEqual([name for name in data["timers"] if name.startswith("scan.root")], [f"scan.root {self.test_dir}"])
+        self.assertIn("test.timer", report)
+        self.assertIn("p99", report)
+
+    def test_client_fast_path_imports(self):
+        """Launching to show a running instance must not load the GUI, the DB or other heavy modules."""
+        import subprocess
+        import sys
+        heavy = ("json", "logging", "argparse", "sqlite3", "config", "database", "indexer", "gui", "PyQt6")
+        code = f"import sys, fstasearch; print([m for m in {heavy!r} if m in sys.modules])"
+        output = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout
+        self.assertEqual(output.strip(), "[]")
+
+    def test_benchmark_uses_temporary_db(self):
+        """The benchmark opens only its temporary DB, the user's is not even created."""
+        import subprocess
+        import sys
+        home = os.path.join(self.test_dir, "home")
+        os.mkdir(home)
+        code = ("import benchmark, types; benchmark.run(types.SimpleNamespace(seed=1, vocabulary=50, names='uniform', "
+                "depth=1, fanout=2, files=2, symlinks=0, repeat=1, limit=10, matchers=['substring'], low_memory=False, keep=False))")
+        subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                       env=dict(os.environ, HOME=home), capture_output=True, check=True)
+        self.assertEqual(os.listdir(home), [])
+
+    def test_parallel_scan_matches_serial_order(self):
+        """The worker count and pool type must not change what is found or its order."""
+        for i in range(4):
+            for j in range(3):
+                os.makedirs(os.path.join(self.test_dir, f"d{i}", f"e{j}", ".git"))
+                Path(os.path.join(self.test_dir, f"d{i}", f"e{j}", f"f{i}{j}.txt")).touch()
+        os.symlink(os.path.join(self.test_dir, "d0"), os.path.join(self.test_dir, "d3", "back"))
+
+        never = lambda path: False
+        serial = ParallelScanner(never, workers=1).scan([self.test_dir])[:2]
+        self.assertEqual(ParallelScanner(never, workers=8).scan([self.test_dir])[:2], serial)
+        self.assertEqual(ParallelScanner(never, workers=2, use_processes=True).scan([self.test_dir])[:2], serial)
+
+        # Which of two paths to one directory is kept does not depend on which listing finishes first
+        from unittest import mock
+        import scanner
+        os.symlink(os.path.join(self.test_dir, "d1", "e1"), os.path.join(self.test_dir, "d2", "link"))
+        serial = ParallelScanner(never, workers=1).scan([self.test_dir])[:2]
+        list_directory = scanner.list_directory
+        for slow in ("d1", "d2"):
+            def delayed(path, known=None, slow=os.path.join(self.test_dir, slow)):
+                if path == slow:
+                    time.sleep(0.05)
+                return list_directory(path, known)
+            with mock.patch("scanner.list_directory", delayed):
+                self.assertEqual(ParallelScanner(never, workers=8).scan([self.test_dir])[:2], serial, slow)
+
+        dirs, files = serial
+        self.assertFalse(any(".git" in d for d in dirs))
+        self.assertEqual(len(files), 3 + 12)
+        # Parents are always listed before their children
+        for i, d in enumerate(dirs[1:], 1):
+            self.assertLess(dirs.index(os.path.dirname(d)), i)
+
+    def test_incremental_rescan(self):
+        """Rescans only list changed directories and drop vanished subtrees."""
+        os.makedirs(os.path.join(self.test_dir, "keep", "deep"))
+        os.makedirs(os.path.join(self.test_dir, "gone", "inner"))
+        Path(os.path.join(self.test_dir, "gone", "inner", "old.txt")).touch()
+
+        indexer = Indexer([self.test_dir])
+        indexer.scan()
+        self.assertTrue(indexer.search("old.txt"))
+
+        Path(os.path.join(self.test_dir, "keep", "deep", "new.txt")).touch()
+        shutil.rmtree(os.path.join(self.test_dir, "gone"))
+
+        # Reload from the DB like a fresh start would
+        indexer = Indexer([self.test_dir])
+        known = indexer._previous_listings()
+        self.assertEqual(set(known), set(indexer.directories))
+        _, _, states, listed = ParallelScanner(indexer._is_excluded).scan([self.test_dir], known)
+        # Only the root (lost 'gone') and 'deep' (gained 'new.txt') changed
+        self.assertEqual(listed, 2)
+        self.assertEqual(len(states), 4)
+
+        indexer.scan()
+        self.assertTrue(indexer.search("new.txt"))
+        self.assertFalse(indexer.search("old.txt"))
+        self.assertFalse(any("gone" in d for d in indexer.directories))
+        self.assertEqual(len(indexer.files), 4)
+
+        # A rescan that finds nothing new keeps the index as it is, one that does only
+        # applies the differences instead of rebuilding it
+        from unittest import mock
+        table = indexer._file_table
+        with mock.patch.object(indexer, "_set_index", side_effect=AssertionError), \
+                mock.patch.object(database.db, "update_index", side_effect=AssertionError):
+            indexer.scan()
+            self.assertIs(indexer._file_table, table)
+            Path(os.path.join(self.test_dir, "keep", "later.txt")).touch()
+            os.remove(os.path.join(self.test_dir, "file2.py"))
+            indexer.scan()
+        self.assertTrue(indexer.search("later.txt"))
+        self.assertFalse(indexer.search("file2"))
+        db_files, db_dirs = database.db.get_index()
+        self.assertEqual(sorted(db_files), sorted(p for p in indexer.files if p is not None))
+        self.assertEqual(sorted(db_dirs), sorted(p for p in indexer.directories if p is not None))
+        self.assertEqual(Indexer([self.test_dir]).search("later.txt"), indexer.search("later.txt"))
+
+        # Changing the exclude rules forces a full listing
+        indexer.exclude_dirs = [os.path.join(self.test_dir, "keep")]
+        indexer.scan()
+        self.assertFalse(indexer.search("new.txt"))
+        indexer.exclude_dirs = []
+        indexer.scan()
+        self.assertTrue(indexer.search("new.txt"))
+
+        # A directory that could not be listed is not taken as empty by later rescans
+        keep = os.path.join(self.test_dir, "keep")
+        scandir = os.scandir
+
+        def denied(path):
+            if path == keep:
+                raise PermissionError(13, "Permission denied", path)
+            return scandir(path)
+
+        with mock.patch("os.scandir", denied):
+            indexer.scan(full=True)
+        self.assertFalse(indexer.search("new.txt"))
+        indexer.scan()
+        self.assertTrue(indexer.search("new.txt"))
+
+    def test_incremental_rescan_after_symlink_changes(self):
+        """Rescans see what changed behind symlinks, like a full scan does."""
+        base = os.path.join(self.test_dir, "base")
+        real = os.path.join(base, "a", "real")
+        os.makedirs(real)
+        Path(os.path.join(real, "report.txt")).touch()
+        shortcut = os.path.join(base, "shortcut")
+        os.symlink(real, shortcut)
+        elsewhere = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, elsewhere, True)
+        target = os.path.join(elsewhere, "target")
+        os.makedirs(target)
+        link = os.path.join(self.test_dir, "subdir", "link")
+        os.symlink(target, link)
+
+        indexer = Indexer([self.test_dir])
+        indexer.scan()
+        self.assertEqual(len(indexer.search("report")), 1)
+        self.assertIn(link, indexer.directories)
+
+        # Whichever path to 'real' loop detection pruned is reached again once the other goes
+        os.remove(shortcut)
+        indexer.scan()
+        self.assertEqual(indexer.search("report"), [os.path.join(real, "report.txt")])
+
+        # A directory symlink whose target vanished is no directory anymore
+        shutil.rmtree(target)
+        indexer.scan()
+        self.assertNotIn(link, indexer.directories)
+        self.assertIn(link, indexer.files)
+
+        def entries():
+            return (sorted(p for p in indexer.directories if p is not None),
+                    sorted(p for p in indexer.files if p is not None))
+
+        indexer.scan()
+        incremental = entries()
+        indexer.scan(full=True)
+        self.assertEqual(incremental, entries())
+
+    def test_streaming_first_scan(self):
+        """A first scan makes results searchable and stored batch by batch, then swaps in without duplicates."""
+        from unittest import mock
+        for i in range(4):
+            for j in range(5):
+                Path(os.path.join(self.test_dir, "subdir", f"item{i}{j}.txt")).touch()
+            os.makedirs(os.path.join(self.test_dir, f"bulk{i}"))
+
+        indexer = Indexer([self.test_dir])
+        snapshots = []
+        append_batch = indexer._append_batch
+
+        def spy(dirs, files, dir_ids):
+            self.assertTrue(dirs or files)
+            append_batch(dirs, files, dir_ids)
+            snapshots.append((len(indexer.search("item", limit=100)), indexer.scan_progress,
+                              len(database.db.get_index()[0])))
+
+        with mock.patch("scanner.BATCH_SIZE", 5), mock.patch.object(indexer, "_append_batch", spy):
+            indexer.scan()
+
+        # The root listing is searchable before subdir has been listed
+        counts = [count for count, _, _ in snapshots]
+        self.assertEqual(counts[0], 0)
+        self.assertEqual(counts[-1], 20)
+        self.assertEqual(snapshots[-1][1][1], self.test_dir)
+        # Earlier batches were already committed to the DB
+        self.assertEqual(snapshots[-1][2], 2)
+        self.assertEqual(len(database.db.get_index()[0]), 23)
+        self.assertIsNone(indexer.scan_progress)
+        self.assertEqual(len(indexer.search("item", limit=100)), 20)
+        self.assertEqual(len(indexer.files), 23)
+
+        # Streamed rows are stored once, and memory keeps the order their batches came in
+        # (level by level, deeper directories after their parent's siblings), so results
+        # keep their order when the index is loaded from the DB. A new root streams too.
+        new_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, new_root)
+        for rel in ("a/inner/deeper", "b/side/under"):
+            os.makedirs(os.path.join(new_root, *rel.split("/")))
+            Path(os.path.join(new_root, *rel.split("/"), "nested_item.txt")).touch()
+        indexer.include_dirs = [self.test_dir, new_root]
+        writes = []
+
+        def update_index(*args, update_index=database.db.update_index):
+            writes.append(update_index(*args))
+            return writes[-1]
+        with mock.patch("scanner.BATCH_SIZE", 2), mock.patch.object(database.db, "update_index", update_index):
+            indexer.scan(roots=[new_root])
+        self.assertEqual(writes, [(0, 0)])
+        self.assertEqual(database.db.get_index(), (list(indexer.files), list(indexer.directories)))
+        reloaded = Indexer(indexer.include_dirs)
+        for q in ("item", "e"):
+            self.assertEqual(reloaded.search(q, limit=100), indexer.search(q, limit=100))
+
+        # A rescan keeps the full index up instead of streaming
+        with mock.patch.object(indexer, "_append_batch", side_effect=AssertionError):
+            indexer.scan()
+
+    def test_low_memory_sqlite_search(self):
+        """Low-memory mode keeps no index in memory and answers searches from SQLite's trigram tables."""
+        os.makedirs(os.path.join(self.test_dir, "repo", "src", "repo_tools"))
+        Path(os.path.join(self.test_dir, "repo", "src", "repo_tools", "report.txt")).touch()
+        Path(os.path.join(self.test_dir, "repo", "a_b.txt")).touch()
+        Path(os.path.join(self.test_dir, "repo", "a%b.txt")).touch()
+        os.makedirs(os.path.join(self.test_dir, "ÄBC"))
+        Path(os.path.join(self.test_dir, "repo", "Über.md")).touch()
+
+        in_memory = Indexer([self.test_dir])
+        in_memory.scan()
+        # Short queries fold non-ASCII case too
+        expected = {q: in_memory.search(q) for q in ("repo", "rep", "file", "t", "a%", "a_", "nothing", "üb", "äb", "über")}
+        self.assertEqual(expected["üb"], [os.path.join(self.test_dir, "repo", "Über.md")])
+
+        database.db.set_setting('low_memory_mode', True)
+        indexer = Indexer([self.test_dir])
+        self.assertEqual(len(indexer.files) + len(indexer.directories), 0)
+        for q, results in expected.items():
+            self.assertEqual(sorted(indexer.search(q)), sorted(results), q)
+        # Directories still come first
+        self.assertEqual(indexer.search("repo")[0], os.path.join(self.test_dir, "repo"))
+        self.assertEqual(len(indexer.search("t", limit=3)), 3)
+
+        # Writes reach the name index through the triggers
+        Path(os.path.join(self.test_dir, "subdir", "late_report.txt")).touch()
+        os.remove(os.path.join(self.test_dir, "repo", "src", "repo_tools", "report.txt"))
+        indexer.scan()
+        self.assertEqual(indexer.search("report"), [os.path.join(self.test_dir, "subdir", "late_report.txt")])
+        indexer.apply_changes(removed=[os.path.join(self.test_dir, "subdir")])
+        self.assertEqual(indexer.search("report"), [])
+        self.assertEqual(len(indexer.files) + len(indexer.directories), 0)
+
+        # Results are listed in the order the in-memory index loads from the DB
+        files, dirs = database.db.get_index()
+        self.assertEqual(list(database.db.iter_name_matches("t", "file")), [p for p in files if "t" in os.path.basename(p)])
+
+        # Without the trigram tokenizer (SQLite < 3.34) the index stays in memory
+        from unittest import mock
+        database.db.disable_name_index()
+        with mock.patch("database.NAME_TOKENIZER", "missing"), self.assertLogs(level="ERROR"):
+            fallback = Indexer([self.test_dir])
+        self.assertFalse(fallback.low_memory)
+        self.assertEqual(len(fallback.files), len(files))
+        self.assertTrue(Indexer([self.test_dir]).low_memory)
+
+        # Folders above an include root match like in memory
+        nested_root = os.path.join(self.test_dir, "parent_zone", "nested")
+        os.makedirs(os.path.join(nested_root, "inner"))
+        database.db.set_setting('low_memory_mode', False)
+        in_memory = Indexer([nested_root])
+        in_memory.scan()
+        self.assertEqual(in_memory.search("zone"), [os.path.join(self.test_dir, "parent_zone")])
+        database.db.set_setting('low_memory_mode', True)
+        self.assertEqual(Indexer([nested_root]).search("zone"), in_memory.search("zone"))
+
+        # Leaving low-memory mode drops the extra tables
+        database.db.set_setting('low_memory_mode', False)
+        Indexer([self.test_dir])
+        self.assertIsNone(database.db.conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'file_names'").fetchone())
+
+    def test_apply_changes(self):
+        """Live changes update memory, search and the DB, removing whole subtrees."""
+        indexer = Indexer([self.test_dir])
+        indexer.scan()
+        subdir = os.path.join(self.test_dir, "subdir")
+        new_dir = os.path.join(self.test_dir, "fresh_dir")
+        new_file = os.path.join(new_dir, "fresh_file.txt")
+
+        indexer.apply_changes([new_file], [new_dir], [subdir])
+        self.assertEqual(indexer.search("fresh"), [new_dir, new_file])
+        self.assertFalse(indexer.search("file3"))
+        self.assertFalse(indexer.search("subdir"))
+
+        db_files, db_dirs = database.db.get_index()
+        self.assertIn(new_file, db_files)
+        self.assertNotIn(subdir, db_dirs)
+        self.assertFalse(any("file3" in f for f in db_files))
+
+        # Re-adding an existing path does not duplicate it
+        indexer.apply_changes([new_file], [new_dir])
+        self.assertEqual(indexer.search("fresh"), [new_dir, new_file])
+
+        # Paths are looked up by component, even names too short for a trigram
+        from unittest import mock
+        a = os.path.join(self.test_dir, "a")
+        b = os.path.join(a, "b")
+        with mock.patch("pathtable.PathTable.basename", side_effect=AssertionError):
+            indexer.apply_changes([os.path.join(b, "x"), os.path.join(a, "y")], [a, b])
+            indexer.apply_changes(removed=[os.path.join(a, "y")])
+        self.assertEqual([p for p in indexer.files if p is not None and p.startswith(a)], [os.path.join(b, "x")])
+        indexer.apply_changes(removed=[a])
+        self.assertFalse(any(p is not None and p.startswith(a) for p in list(indexer.files) + list(indexer.directories)))
+        self.assertEqual(indexer.search("fresh"), [new_dir, new_file])
+
+    def test_watcher_applies_events(self):
+        """inotify events become index changes, with subtree rescans past the watch limit."""
+        indexer = Indexer([self.test_dir])
+        indexer.scan()
+        watcher = IndexWatcher(indexer)
+        if not watcher.open():
+            self.skipTest("inotify unavailable")
+        watcher.sync_watches()
+
+        os.makedirs(os.path.join(self.test_dir, "made", "inner"))
+        Path(os.path.join(self.test_dir, "made", "inner", "watched.txt")).touch()
+        os.remove(os.path.join(self.test_dir, "file1.txt"))
+        for wd, mask, _, name in watcher.inotify.read_events(1.0):
+            watcher.handle_event(wd, mask, name)
+        watcher.flush()
+
+        self.assertTrue(indexer.search("watched.txt"))
+        self.assertFalse(indexer.search("file1"))
+        # The snapshot is rewritten once changes went quiet for snapshot_delay
+        self.assertIsNotNone(watcher.changed_at)
+
+        # Directories that could not be watched are rescanned instead
+        watcher.unwatched.add(os.path.join(self.test_dir, "subdir"))
+        Path(os.path.join(self.test_dir, "subdir", "polled.txt")).touch()
+        for root in watcher._unwatched_roots():
+            indexer.rescan_subtree(root)
+        self.assertTrue(indexer.search("polled.txt"))
+        self.assertTrue(indexer.search("file3"))
+
+        # While a scan runs the batch waits for it, an overflow only queues a scan
+        from unittest import mock
+        late = os.path.join(self.test_dir, "late.txt")
+        watcher.added_files.add(late)
+        indexer._scan_running.set()
+        watcher.flush()
+        indexer._scan_running.clear()
+        self.assertFalse(indexer.search("late.txt"))
+        watcher.flush()
+        self.assertEqual(indexer.search("late.txt"), [late])
+        watcher.overflowed = True
+        with mock.patch.object(indexer, "scan") as scan, mock.patch.object(indexer, "scan_async") as scan_async:
+            watcher.flush()
+        scan.assert_not_called()
+        scan_async.assert_called_once_with()
+        watcher.inotify.close()
+
+        # In low-memory mode watches and rescans read the DB's rows lazily, never the whole index
+        database.db.set_setting('low_memory_mode', True)
+        low_memory = Indexer([self.test_dir])
+        low_watcher = IndexWatcher(low_memory)
+        self.assertTrue(low_watcher.open())
+        Path(os.path.join(self.test_dir, "subdir", "low_memory.txt")).touch()
+        with mock.patch.object(database.db, "get_index", side_effect=AssertionError):
+            low_watcher.sync_watches()
+            low_memory.rescan_subtree(os.path.join(self.test_dir, "subdir"))
+        self.assertEqual(set(low_watcher.wd_paths.values()), {p for p in indexer.directories if p is not None})
+        self.assertTrue(low_memory.search("low_memory.txt"))
+        low_watcher.inotify.close()
+        database.db.set_setting('low_memory_mode', False)
+
+        # Subtrees of '/' are '/' and everything below it, not paths starting with '//'
+        watcher.unwatched = {"/a/c", "/a b", "/a"}
+        self.assertEqual(watcher._unwatched_roots(), ["/a", "/a b"])
+        watcher.unwatched.add("/")
+        self.assertEqual(watcher._unwatched_roots(), ["/"])
+        watcher.inotify = mock.Mock()
+        watcher.wd_paths = {1: "/", 2: "/a", 3: "/a b/c"}
+        watcher._unwatch_subtree("/")
+        self.assertEqual((watcher.wd_paths, watcher.unwatched), ({}, set()))
+        listing = (["/", "/a"], ["/a/f"], [], 1)
+        with mock.patch("scanner.ParallelScanner.scan", return_value=listing), \
+                mock.patch.object(indexer, "_previous_listings", return_value={}), \
+                mock.patch.object(indexer, "_indexed_paths", return_value=(["/", "/a", "/old"], ["/a/f", "/old/g"])), \
+                mock.patch.object(indexer, "apply_changes") as apply_changes, \
+                mock.patch.object(database.db, "replace_dir_states"):
+            indexer._rescan_subtree("/")
+        apply_changes.assert_called_once_with([], [], {"/old", "/old/g"})
+
     def test_symlink_following(self):
         """Test that symlinked directories are followed."""
         # Create a real directory with a file
@@ -234,6 +1344,56 @@ class TestFstaSearch(unittest.TestCase):
         results = indexer.search("real_file.txt")
         self.assertTrue(len(results) >= 1, f"Expected to find real_file.txt, got {results}")
         
+    def test_loop_detection_without_realpath(self):
+        """Loops are caught by (device, inode) from directory entries, without resolving paths."""
+        from unittest import mock
+        os.makedirs(os.path.join(self.test_dir, "a", "b"))
+        os.symlink(os.path.join(self.test_dir, "a"), os.path.join(self.test_dir, "a", "b", "up"))
+        os.symlink(os.path.join(self.test_dir, "subdir"), os.path.join(self.test_dir, "alias"))
+
+        with mock.patch("os.path.realpath", side_effect=AssertionError("realpath called")):
+            dir_list, file_list, states, _ = ParallelScanner(lambda path: False).scan([self.test_dir])
+        # The alias and its target are one directory, whichever is listed first is kept
+        found = sorted(os.path.relpath(d, self.test_dir) for d in dir_list)
+        self.assertIn(found, ([".", "a", os.path.join("a", "b"), "subdir"], [".", "a", os.path.join("a", "b"), "alias"]))
+        self.assertEqual(len(file_list), 3)
+        st = os.stat(os.path.join(self.test_dir, "a"))
+        self.assertIn((os.path.join(self.test_dir, "a"), st.st_mtime_ns, st.st_ino, st.st_dev), states)
+
+        # Inode numbers in the listing are not trusted, as on FUSE or overlayfs, where
+        # they may repeat or change between listings
+        from scanner import list_directory
+        real_scandir = os.scandir
+
+        class Entry:
+            def __init__(self, entry):
+                self._entry = entry
+                self.name = entry.name
+
+            def inode(self):
+                return 1
+
+            def __getattr__(self, name):
+                return getattr(self._entry, name)
+
+        class Listing:
+            def __init__(self, path):
+                self._it = real_scandir(path)
+
+            def __enter__(self):
+                return (Entry(entry) for entry in self._it)
+
+            def __exit__(self, *exc):
+                self._it.close()
+
+        with mock.patch("os.scandir", Listing):
+            dirs, _, _, _ = list_directory(self.test_dir)
+            dir_list, _, _, _ = ParallelScanner(lambda path: False).scan([os.path.join(self.test_dir, "a")])
+        for name, key in dirs:
+            st = os.stat(os.path.join(self.test_dir, name))
+            self.assertEqual(key, (st.st_dev, st.st_ino), name)
+        self.assertEqual(dir_list, [os.path.join(self.test_dir, "a"), os.path.join(self.test_dir, "a", "b")])
+
     def test_symlink_loop_detection(self):
         """Test that a recursive symlink doesn't cause infinite loop."""
         # Create dir A
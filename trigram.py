@@ -0,0 +1,122 @@
+from array import array
+from itertools import accumulate, islice
+
+
+def _encode(ids):
+    """
+    Packs sorted ids into one array: a header holding the last and the first id,
+    then the gap to each following id. Arrays of 16-bit items split each header id
+    in two halves; they are used while every gap fits, 32-bit items otherwise.
+    """
+    gaps = [b - a for a, b in zip(ids, ids[1:])]
+    first, last = ids[0], ids[-1]
+    if max(gaps, default=0) < 1 << 16:
+        return array('H', [last >> 16, last & 0xFFFF, first >> 16, first & 0xFFFF] + gaps)
+    return array('I', [last, first] + gaps)
+
+
+def _decode(posting):
+    """Returns the ids packed by _encode."""
+    if posting.typecode == 'I':
+        return list(accumulate(islice(posting, 2, None), initial=posting[1]))
+    return list(accumulate(islice(posting, 4, None), initial=posting[2] << 16 | posting[3]))
+
+
+def _count(posting):
+    return len(posting) - (1 if posting.typecode == 'I' else 3)
+
+
+class TrigramIndex:
+    """
+    In-memory posting lists mapping each lowercased trigram to the ids of the
+    entries whose indexed text contains it. Ids must be added in increasing
+    order so every posting list stays sorted.
+    Lists are kept as the gaps between their ids, mostly in 16-bit items, and are
+    decoded when a query reads them.
+    An optional read-only base (e.g. postings mapped from a snapshot) holds the lists
+    as they were; the ids added since come after all of its ids and are kept apart.
+    """
+
+    def __init__(self, base=None):
+        self.postings = {}
+        self.base = base
+
+    def _get(self, gram):
+        posting = self.postings.get(gram)
+        base_ids = self.base.get(gram) if self.base is not None else None
+        if posting is None:
+            return base_ids
+        if base_ids is None:
+            return _decode(posting)
+        return list(base_ids) + _decode(posting)
+
+    def _len(self, gram):
+        posting = self.postings.get(gram)
+        base_ids = self.base.get(gram) if self.base is not None else None
+        return (0 if posting is None else _count(posting)) + (0 if base_ids is None else len(base_ids))
+
+    def add(self, entry_id, text):
+        postings = self.postings
+        for gram in {text[i:i + 3] for i in range(len(text) - 2)}:
+            posting = postings.get(gram)
+            if posting is None:
+                postings[gram] = _encode([entry_id])
+            elif posting.typecode == 'I':
+                posting.append(entry_id - posting[0])
+                posting[0] = entry_id
+            else:
+                gap = entry_id - (posting[0] << 16 | posting[1])
+                if gap >= 1 << 16:
+                    postings[gram] = _encode(_decode(posting) + [entry_id])
+                    continue
+                posting.append(gap)
+                posting[0] = entry_id >> 16
+                posting[1] = entry_id & 0xFFFF
+
+    def items(self):
+        """Yields (trigram, ids) for every trigram, including those only in the base."""
+        for gram, posting in self.postings.items():
+            ids = array('I', self.base.get(gram, ()) if self.base is not None else ())
+            ids.extend(_decode(posting))
+            yield gram, ids
+        if self.base is not None:
+            for gram, ids in self.base.items():
+                if gram not in self.postings:
+                    yield gram, ids
+
+    def rarest(self, query):
+        """
+        Returns the shortest posting list among query's trigrams, which holds every
+        candidate and more, or None if the query is too short.
+        """
+        grams = {query[i:i + 3] for i in range(len(query) - 2)}
+        if not grams:
+            return None
+        return self._get(min(grams, key=self._len)) or ()
+
+    def cost(self, query):
+        """Returns how many candidates query has at most, or None if it is too short."""
+        grams = {query[i:i + 3] for i in range(len(query) - 2)}
+        if not grams:
+            return None
+        return min(map(self._len, grams))
+
+    def candidates(self, query):
+        """
+        Returns the sorted ids of entries that contain every trigram of query,
+        or None if the query is too short to be answered from the index.
+        """
+        grams = {query[i:i + 3] for i in range(len(query) - 2)}
+        if not grams:
+            return None
+
+        # Start from the rarest trigram so the working set is as small as possible
+        grams = sorted(grams, key=self._len)
+        if not self._len(grams[0]):
+            return []
+        result = set(self._get(grams[0]))
+        for gram in grams[1:]:
+            result.intersection_update(self._get(gram))
+            if not result:
+                break
+        return sorted(result)
@@ -0,0 +1,255 @@
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+import threading
+from scanner import ParallelScanner
+from indexer import in_subtrees
+
+# inotify(7) constants
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_ONLYDIR
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify:
+    """Thin ctypes wrapper around the Linux inotify syscalls."""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._rm_watch(self.fd, wd)
+
+    def read_events(self, timeout):
+        """Yields (wd, mask, cookie, name) tuples, waiting at most timeout seconds for the first."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            yield wd, mask, cookie, name
+
+    def close(self):
+        os.close(self.fd)
+
+
+class IndexWatcher:
+    """
+    Keeps an Indexer current between scans by watching every indexed directory with inotify.
+    Events are collected and applied to the in-memory index and the file_index table in
+    batches. Directories that cannot be watched because the inotify watch limit is
+    exhausted are rescanned incrementally on a timer instead.
+    """
+
+    def __init__(self, indexer, batch_interval=2.0, rescan_interval=600, snapshot_delay=60):
+        self.indexer = indexer
+        self.batch_interval = batch_interval
+        self.rescan_interval = rescan_interval
+        # Seconds without changes before the index snapshot is rewritten
+        self.snapshot_delay = snapshot_delay
+        # Time changes were last applied, while the snapshot has not been rewritten since
+        self.changed_at = None
+        self.inotify = None
+        self.wd_paths = {}
+        self.unwatched = set()
+        self._synced_scan = None
+        self._stop = threading.Event()
+        self._reset_batch()
+
+    def _reset_batch(self):
+        self.added_files = set()
+        self.added_dirs = set()
+        self.removed = set()
+        self.overflowed = False
+
+    def open(self):
+        try:
+            self.inotify = Inotify()
+        except (OSError, AttributeError) as e:
+            logging.warning(f"Filesystem watching unavailable: {e}")
+            return False
+        return True
+
+    def start(self):
+        if not self.open():
+            return False
+        threading.Thread(target=self._run, daemon=True).start()
+        return True
+
+    def stop(self):
+        self._stop.set()
+
+    def watch(self, path):
+        try:
+            wd = self.inotify.add_watch(path)
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                if not self.unwatched:
+                    logging.warning("inotify watch limit reached. Falling back to periodic rescans.")
+                self.unwatched.add(path)
+            return
+        self.wd_paths[wd] = path
+
+    def _unwatch_subtree(self, path):
+        below = in_subtrees([path])
+        for wd, watched in list(self.wd_paths.items()):
+            if below(watched):
+                self.inotify.rm_watch(wd)
+                del self.wd_paths[wd]
+        self.unwatched = {p for p in self.unwatched if not below(p)}
+
+    def sync_watches(self):
+        """Watches every directory of the current index, e.g. after a scan replaced it."""
+        self._synced_scan = self.indexer.last_scan
+        indexed_dirs, _ = self.indexer._indexed_paths()
+        indexed = [path for path in indexed_dirs if path is not None]
+        # Directories that left the index, e.g. below an include root that was removed
+        current = set(indexed)
+        for wd, path in list(self.wd_paths.items()):
+            if path not in current:
+                self.inotify.rm_watch(wd)
+                del self.wd_paths[wd]
+        watched = set(self.wd_paths.values())
+        self.unwatched.clear()
+        for path in indexed:
+            if path not in watched:
+                self.watch(path)
+        logging.info(f"Watching {len(self.wd_paths)} directories ({len(self.unwatched)} unwatched)")
+
+    def handle_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            self.overflowed = True
+            return
+        if mask & IN_IGNORED:
+            self.wd_paths.pop(wd, None)
+            return
+        parent = self.wd_paths.get(wd)
+        if parent is None or not name or name.startswith('.'):
+            return
+
+        path = os.path.join(parent, name)
+        is_dir = bool(mask & IN_ISDIR)
+        if mask & (IN_CREATE | IN_MOVED_TO):
+            if self.indexer._is_excluded(path):
+                return
+            (self.added_dirs if is_dir else self.added_files).add(path)
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            self.added_files.discard(path)
+            self.added_dirs.discard(path)
+            self.removed.add(path)
+            if is_dir and mask & IN_MOVED_FROM:
+                # Watches inside a moved directory keep reporting its old path
+                self._unwatch_subtree(path)
+
+    def flush(self):
+        """Applies the collected batch of events to the index."""
+        if self.overflowed:
+            # Events were dropped by the kernel, only a rescan can catch up
+            self._reset_batch()
+            logging.warning("inotify queue overflowed. Rescanning.")
+            # Watches are synced by _run once the scan finished
+            self.indexer.scan_async()
+            return
+        if self.indexer.is_scanning:
+            # The batch is kept and applied once the scan swapped in its tables
+            return
+
+        added_files = list(self.added_files)
+        added_dirs = []
+        if self.added_dirs:
+            # New or moved-in directories may already hold entries
+            scanner = ParallelScanner(self.indexer._is_excluded, workers=1)
+            dirs, files, _, _ = scanner.scan(sorted(self.added_dirs))
+            added_dirs.extend(dirs)
+            added_files.extend(files)
+            for path in dirs:
+                self.watch(path)
+
+        removed = list(self.removed)
+        self._reset_batch()
+        if added_files or added_dirs or removed:
+            self.indexer.apply_changes(added_files, added_dirs, removed)
+            self.changed_at = time.time()
+
+    def _unwatched_roots(self):
+        roots = []
+        below = None
+        # Sorted by component, a subtree is contiguous ('/a', '/a/b', '/a b', not '/a', '/a b', '/a/b')
+        for path in sorted(self.unwatched, key=lambda p: p.split(os.sep)):
+            if below is None or not below(path):
+                roots.append(path)
+                below = in_subtrees([path])
+        return roots
+
+    def _run(self):
+        self.sync_watches()
+        last_flush = last_rescan = time.time()
+        while not self._stop.is_set():
+            for wd, mask, _, name in self.inotify.read_events(self.batch_interval):
+                self.handle_event(wd, mask, name)
+
+            now = time.time()
+            if now - last_flush >= self.batch_interval:
+                last_flush = now
+                try:
+                    if self.indexer.last_scan != self._synced_scan and not self.indexer.is_scanning:
+                        self.sync_watches()
+                    self.flush()
+                except Exception as e:
+                    logging.error(f"Error applying filesystem changes: {e}")
+
+            if self.unwatched and now - last_rescan >= self.rescan_interval:
+                last_rescan = now
+                for root in self._unwatched_roots():
+                    try:
+                        self.indexer.rescan_subtree(root)
+                        self.changed_at = time.time()
+                    except Exception as e:
+                        logging.error(f"Error rescanning {root}: {e}")
+
+            if self.changed_at is not None and now - self.changed_at >= self.snapshot_delay:
+                self.changed_at = None
+                try:
+                    self.indexer.flush_snapshot()
+                except Exception as e:
+                    logging.error(f"Error writing the index snapshot: {e}")
+
+        self.inotify.close()